@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Benchmark the per-task Flask app context overhead of CELERY_APP_CONTEXT = 'task' versus 'worker'.
+
+Calls a trivial task the way a worker does (with a request pushed), so only ContextTask.__call__ and the task body are
+timed, not messaging. Teardown handlers simulate Flask extensions cleaning up after every app context; in 'worker' mode
+one of them is registered with after_task() instead, as selective per-task cleanup.
+
+Usage (from the project's root directory):
+    python benchmarks/bench_app_context.py [--iterations N] [--teardowns N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import threading
+
+from flask import Flask, g
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_single_instance import measure  # noqa
+from flask_celery import Celery  # noqa
+
+
+def make_task(mode, teardowns):
+    """Return a trivial task of a new Flask app and Celery extension.
+
+    :param str mode: CELERY_APP_CONTEXT setting.
+    :param int teardowns: Number of teardown handlers to register on the Flask app.
+    """
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_APP_CONTEXT'] = mode
+    for _ in range(teardowns):
+        flask_app.teardown_appcontext(lambda _: g.pop('session', None))
+    celery = Celery(flask_app)
+    if mode == 'worker':
+        celery.after_task(lambda _: g.pop('session', None))
+
+    @celery.task
+    def noop():
+        g.session = True
+
+    return noop
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--iterations', default=20000, type=int, help='tasks per mode')
+    parser.add_argument('-t', '--teardowns', default=3, type=int, help='teardown handlers on the Flask app')
+    options = parser.parse_args()
+
+    row = '{0:<7} {1:>10} {2:>10} {3:>12}'
+    print(row.format('mode', 'p50 (us)', 'p99 (us)', 'tasks/sec'))
+    for mode in ('task', 'worker'):
+        task = make_task(mode, options.teardowns)
+        results = list()
+
+        def worker():
+            task.push_request(called_directly=False)
+            try:
+                results.append(measure(task, options.iterations))
+            finally:
+                task.pop_request()
+
+        thread = threading.Thread(target=worker)  # Keeps the reused app context out of the main thread.
+        thread.start()
+        thread.join()
+        p50, p99, rate = results[0]
+        print(row.format(mode, '{0:.1f}'.format(p50 * 1e6), '{0:.1f}'.format(p99 * 1e6), '{0:.0f}'.format(rate)))
+
+
+if __name__ == '__main__':
+    main()
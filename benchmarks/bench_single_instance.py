@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Benchmark the per-call overhead of single_instance for each lock manager.
+
+Times every stage of the wrapped task path (timeout resolution, manager selection, lock plan construction, task
+identifier hashing, lock manager construction, lock acquire/release) as well as the whole wrapped call. Redis runs
+against an in-process stand-in, the database backend against a temporary SQLite file and file locks against a temporary
+directory, so results only measure client-side overhead plus the local store.
+
+Usage (from the project's root directory):
+    python benchmarks/bench_single_instance.py [--iterations N] [--backend redis|db|file] [--payload N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_celery import _LockPlan, _select_store, single_instance  # noqa
+from tests.fakes import FakeTask, RedisBackend, sqlite_backend  # noqa
+
+
+def measure(func, iterations):
+    """Call func() `iterations` times, timing each call.
+
+    :param func: Callable to benchmark.
+    :param int iterations: Number of calls.
+
+    :return: p50 latency (seconds), p99 latency (seconds), calls per second.
+    :rtype: tuple
+    """
+    timings = list()
+    for _ in range(iterations // 10 or 1):  # Warm up.
+        func()
+    started = default_timer()
+    for _ in range(iterations):
+        start = default_timer()
+        func()
+        timings.append(default_timer() - start)
+    total = default_timer() - started
+    timings.sort()
+    return timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.99))], iterations / total
+
+
+def stages(task, include_args, args, kwargs):
+    """Build the list of (stage name, callable) to benchmark for one task.
+
+    :param task: Bound task instance (FakeTask).
+    :param bool include_args: Passed to single_instance().
+    :param tuple args: Task positional arguments.
+    :param dict kwargs: Task keyword arguments.
+
+    :return: Stage names and callables.
+    :rtype: list
+    """
+    plan = _LockPlan(task, None, include_args)
+    manager = plan.manager(args, kwargs)
+
+    def enter_exit():
+        with manager:
+            pass
+
+    wrapped = single_instance(include_args=include_args)(lambda *_a, **_k: None)
+    return [
+        ('timeout', lambda: plan.timeout),
+        ('select_store', lambda: _select_store(task)),
+        ('build_plan', lambda: _LockPlan(task, None, include_args)),
+        ('task_identifier', lambda: plan.task_identifier(args, kwargs)),
+        ('construct', lambda: plan.manager(args, kwargs)),
+        ('enter_exit', enter_exit),
+        ('wrapped', lambda: wrapped(task, *args, **kwargs)),
+    ]
+
+
+def backends(tmp_dir):
+    """Yield (name, result backend, Celery configuration) for each benchmarked lock manager.
+
+    :param str tmp_dir: Directory for the SQLite database file and lock files.
+    """
+    yield 'redis', RedisBackend(), dict()
+    yield 'db', sqlite_backend(tmp_dir), dict()
+    yield 'file', object(), dict(CELERY_SINGLE_INSTANCE_LOCK_DIR=os.path.join(tmp_dir, 'locks'))
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--iterations', default=2000, type=int, help='calls per stage')
+    parser.add_argument('-b', '--backend', choices=('redis', 'db', 'file'), help='only benchmark this backend')
+    parser.add_argument('-p', '--payload', default=100, type=int, help='length of the list argument passed to tasks')
+    options = parser.parse_args()
+
+    args = (list(range(options.payload)), 'x' * options.payload)
+    kwargs = dict(flag=True, mapping=dict((str(i), i) for i in range(10)))
+    row = '{0:<7} {1:<13} {2:<16} {3:>10} {4:>10} {5:>12}'
+    print(row.format('backend', 'include_args', 'stage', 'p50 (us)', 'p99 (us)', 'calls/sec'))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, backend, conf in backends(tmp_dir):
+            if options.backend and options.backend != name:
+                continue
+            task = FakeTask('bench.{0}'.format(name), backend, conf=conf)
+            for include_args in (False, True):
+                for stage, func in stages(task, include_args, args, kwargs):
+                    p50, p99, rate = measure(func, options.iterations)
+                    print(row.format(name, str(include_args), stage, '{0:.1f}'.format(p50 * 1e6),
+                                     '{0:.1f}'.format(p99 * 1e6), '{0:.0f}'.format(rate)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Benchmark import time of flask_celery and the time and memory of creating Flask apps with the Celery extension.
+
+Import time is measured in new interpreters, once with only Flask and Celery imported and once with flask_celery, so the
+difference is the cost of this module. App startup creates a Flask app with `--settings` unrelated settings (like a
+real application's config), initializes the extension with init_app() the way app factories do, and reads the Celery
+configuration once.
+
+Usage (from the project's root directory):
+    python benchmarks/bench_startup.py [--iterations N] [--imports N] [--settings N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import tracemalloc
+from timeit import default_timer
+
+from flask import Flask
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_single_instance import measure  # noqa
+from flask_celery import Celery  # noqa
+
+
+def import_time(statement, runs):
+    """Return the median wall time of a new interpreter running the import statement.
+
+    :param str statement: Python statement.
+    :param int runs: Interpreters to start.
+
+    :return: Seconds.
+    :rtype: float
+    """
+    timings = list()
+    for _ in range(runs):
+        start = default_timer()
+        subprocess.check_call([sys.executable, '-c', statement], cwd=ROOT)
+        timings.append(default_timer() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def create_app(settings):
+    """Create a Flask app with unrelated settings and the Celery extension, the way an app factory does.
+
+    :param int settings: Number of unrelated settings in the Flask config.
+
+    :return: Flask app.
+    """
+    flask_app = Flask(__name__)
+    flask_app.config.update(('SETTING_{0}'.format(i), 'x' * 32) for i in range(settings))
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_RESULT_BACKEND'] = 'cache+memory://'
+    celery = Celery()
+    celery.init_app(flask_app)
+    assert celery.conf.broker_url == 'memory://'
+    return flask_app
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--iterations', default=500, type=int, help='apps created')
+    parser.add_argument('-i', '--imports', default=9, type=int, help='interpreters started per import statement')
+    parser.add_argument('-s', '--settings', default=200, type=int, help='unrelated settings in the Flask config')
+    options = parser.parse_args()
+
+    baseline = import_time('import celery, flask', options.imports)
+    total = import_time('import flask_celery', options.imports)
+    print('import flask_celery: {0:.1f} ms ({1:.1f} ms over celery and flask)'.format(
+        total * 1e3, (total - baseline) * 1e3))
+
+    p50, p99, rate = measure(lambda: create_app(options.settings), options.iterations)
+    print('create_app: p50 {0:.0f} us, p99 {1:.0f} us, {2:.0f} apps/sec'.format(p50 * 1e6, p99 * 1e6, rate))
+
+    apps = list()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(100):
+        apps.append(create_app(options.settings))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print('memory: {0:.1f} KiB per app'.format(used / 1024.0 / len(apps)))
+
+
+if __name__ == '__main__':
+    main()
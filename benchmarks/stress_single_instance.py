@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""Stress single_instance with many worker processes racing for the same and different locks.
+
+Every worker process calls a task guarded by single_instance(include_args=True) in a loop, with one of `--keys` keys
+picked at random (1 key: every process contends for one lock, more keys: less contention). The task body counts how
+many instances run for its key in shared memory, so any double execution is reported. A fraction of the attempts
+(`--abandon`) acquire the lock and never release it, like a crashed worker, so expired locks are taken over.
+
+Redis runs against the in-process stand-in served to all workers by a manager process (scripts run atomically there,
+one IPC round trip per command), the database backend against a SQLite file, with its single-statement acquire
+('db') and with the INSERT then UPDATE fallback of other databases ('db-fallback').
+
+Reported per scenario: attempts, task runs per second, rejection rate, errors (e.g. database is locked), double runs
+(must be 0) and the latency of single_instance itself (call time minus task body time) at p50, p99 and max.
+
+Usage (from the project's root directory):
+    python benchmarks/stress_single_instance.py [--processes N] [--keys 1,8,64] [--duration S] [--backend NAME]
+"""
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing.managers import BaseManager
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_celery import _LockTable, OtherInstanceError, single_instance  # noqa
+from tests.fakes import FakeRedis, FakeTask, RedisBackend, sqlite_backend  # noqa
+
+BACKENDS = ('redis', 'db', 'db-fallback')
+
+
+class SharedRedis(FakeRedis):
+    """FakeRedis living in the manager process, commands and scripts called through a proxy."""
+
+    def run_script(self, source, keys, args):
+        """Run a registered script emulation atomically."""
+        return self.register_script(source)(keys, args)
+
+    def command(self, name, args, kwargs):
+        """Run a command."""
+        return getattr(self, name)(*args, **kwargs)
+
+
+_SHARED_REDIS = list()
+
+
+def shared_redis():
+    """Return the manager process' SharedRedis, created on first use."""
+    if not _SHARED_REDIS:
+        _SHARED_REDIS.append(SharedRedis())
+    return _SHARED_REDIS[0]
+
+
+class RedisServer(BaseManager):
+    """Manager process serving one SharedRedis to every worker process."""
+
+
+RedisServer.register('redis', callable=shared_redis, exposed=('run_script', 'command'))
+
+
+class RedisClient(object):
+    """Redis client of a worker process, the subset of redis-py the Redis lock manager uses."""
+
+    def __init__(self, proxy):
+        """Constructor.
+
+        :param proxy: Proxy of the RedisServer's SharedRedis.
+        """
+        self.proxy = proxy
+
+    def register_script(self, source):
+        """Return a callable running the script in the server, like redis.client.Script."""
+        return lambda keys=(), args=(), client=None: self.proxy.run_script(source, list(keys), list(args))
+
+    def __getattr__(self, name):
+        """Any other command runs in the server."""
+        return lambda *args, **kwargs: self.proxy.command(name, args, kwargs)
+
+
+def worker(options, store, start, running, double_runs, results):
+    """Worker process: call the guarded task until the scenario's duration is over and report counters.
+
+    :param dict options: Scenario: backend, keys, duration, hold, abandon, lock_timeout.
+    :param store: Proxy of the SharedRedis or SQLite directory.
+    :param multiprocessing.Event start: Set when every worker process is ready.
+    :param multiprocessing.Array running: Instances running per key.
+    :param multiprocessing.Value double_runs: Number of times a task body found another instance running.
+    :param multiprocessing.Queue results: Receives the counters and latencies.
+    """
+    random.seed(os.getpid())
+    if options['backend'] == 'redis':
+        backend = RedisBackend(RedisClient(store))
+    else:
+        backend = sqlite_backend(store)
+        if options['backend'] == 'db-fallback':
+            _LockTable.get(backend).upsert = None
+    body_time = dict(last=0.0)
+
+    def body(key):
+        started = default_timer()
+        with running.get_lock():
+            running[key] += 1
+            if running[key] > 1:
+                double_runs.value += 1
+        time.sleep(options['hold'])
+        with running.get_lock():
+            running[key] -= 1
+        body_time['last'] = default_timer() - started
+
+    wrapped = single_instance(include_args=True, lock_timeout=options['lock_timeout'])(body)
+    task = FakeTask('stress.{0}'.format(options['backend']), backend, run=wrapped)
+    plan = wrapped.lock_plan(task)
+    ran = rejected = abandoned = 0
+    errors, latencies = list(), list()
+
+    start.wait()
+    deadline = time.time() + options['duration']
+    while time.time() < deadline:
+        key = random.randrange(options['keys'])
+        body_time['last'] = 0.0
+        begin = default_timer()
+        try:
+            if random.random() < options['abandon']:
+                plan.manager((key, ), dict()).acquire()  # Never released.
+                abandoned += 1
+            else:
+                wrapped(task, key)
+                ran += 1
+        except OtherInstanceError:
+            rejected += 1
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append('{0}: {1}'.format(exc.__class__.__name__, exc).splitlines()[0])
+        latencies.append(default_timer() - begin - body_time['last'])
+    results.put((ran, rejected, abandoned, errors, latencies))
+
+
+def run_scenario(options, processes):
+    """Start the worker processes of one scenario and aggregate what they report.
+
+    :param dict options: Scenario, see worker().
+    :param int processes: Number of worker processes.
+
+    :return: Attempts, runs, rejected, abandoned, errors, double runs and sorted latencies.
+    :rtype: dict
+    """
+    tmp_dir, server = tempfile.mkdtemp(), None
+    try:
+        if options['backend'] == 'redis':
+            server = RedisServer()
+            server.start()
+            store = server.redis()
+        else:
+            store = tmp_dir
+            _LockTable.get(sqlite_backend(tmp_dir))  # Creates the lock table before workers race to.
+        start, results = multiprocessing.Event(), multiprocessing.Queue()
+        running, double_runs = multiprocessing.Array('i', options['keys']), multiprocessing.Value('i', 0)
+        workers = [
+            multiprocessing.Process(target=worker, args=(options, store, start, running, double_runs, results))
+            for _ in range(processes)
+        ]
+        for process in workers:
+            process.start()
+        time.sleep(0.5)  # Let imports and connections settle so every worker starts racing at once.
+        start.set()
+        reports = [results.get() for _ in workers]
+        for process in workers:
+            process.join()
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+    latencies = sorted(latency for report in reports for latency in report[4])
+    errors = [error for report in reports for error in report[3]]
+    return dict(
+        attempts=len(latencies), runs=sum(r[0] for r in reports), rejected=sum(r[1] for r in reports),
+        abandoned=sum(r[2] for r in reports), errors=errors, double_runs=double_runs.value, latencies=latencies,
+    )
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-p', '--processes', default=32, type=int, help='worker processes')
+    parser.add_argument('-k', '--keys', default='1,8,64', help='comma separated numbers of distinct lock keys')
+    parser.add_argument('-d', '--duration', default=3.0, type=float, help='seconds per scenario')
+    parser.add_argument('-b', '--backend', choices=BACKENDS, action='append', help='only stress these backends')
+    parser.add_argument('--hold', default=0.001, type=float, help='seconds the task body holds the lock')
+    parser.add_argument('--abandon', default=0.01, type=float, help='fraction of locks acquired and never released')
+    parser.add_argument('--lock-timeout', default=1, type=int, help='single_instance lock_timeout (seconds)')
+    options = parser.parse_args()
+
+    row = '{0:<12} {1:>5} {2:>5} {3:>9} {4:>9} {5:>9} {6:>7} {7:>6} {8:>9} {9:>9} {10:>9}'
+    print(row.format('backend', 'procs', 'keys', 'attempts', 'runs/sec', 'rejected', 'errors', 'double',
+                     'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+    failed = False
+    for backend in options.backend or BACKENDS:
+        for keys in (int(k) for k in options.keys.split(',')):
+            scenario = dict(backend=backend, keys=keys, duration=options.duration, hold=options.hold,
+                            abandon=options.abandon, lock_timeout=options.lock_timeout)
+            result = run_scenario(scenario, options.processes)
+            latencies = result['latencies'] or [0.0]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            print(row.format(
+                backend, options.processes, keys, result['attempts'],
+                '{0:.0f}'.format(result['runs'] / options.duration),
+                '{0:.1%}'.format(result['rejected'] / float(result['attempts'] or 1)), len(result['errors']),
+                result['double_runs'], '{0:.2f}'.format(latencies[len(latencies) // 2] * 1e3),
+                '{0:.2f}'.format(p99 * 1e3), '{0:.2f}'.format(latencies[-1] * 1e3),
+            ))
+            for error in sorted(set(result['errors'])):
+                print('    {0}'.format(error))
+            failed = failed or bool(result['double_runs'])
+    if failed:
+        print('Double execution detected.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
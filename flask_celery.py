@@ -4,155 +4,2163 @@ https://github.com/Robpol86/Flask-Celery-Helper
 https://pypi.python.org/pypi/Flask-Celery-Helper
 """
 
-import hashlib
+import cProfile
+import inspect
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+import uuid
 from datetime import datetime, timedelta
 from functools import partial, wraps
 from logging import getLogger
 
-from celery import _state, Celery as CeleryClass
+from celery import Celery as CeleryClass, states
+from celery.exceptions import Retry
+from celery.utils import gen_task_name
+from celery.utils.dispatch import Signal
+
+try:
+    from celery.utils.time import rate as parse_rate
+except ImportError:  # Celery < 4.
+    from celery.utils.timeutils import rate as parse_rate
+
+try:
+    from celery.app.defaults import _OLD_SETTING_KEYS, SETTING_KEYS
+except ImportError:  # Celery < 4, only upper case setting names.
+    from celery.app.defaults import DEFAULTS as SETTING_KEYS
+    _OLD_SETTING_KEYS = ()
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2.
+    from collections import Mapping
+
+try:
+    import fcntl
+except ImportError:  # Windows.
+    fcntl = None
+
+try:
+    from hashlib import blake2b
+except ImportError:  # Python < 3.6.
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
 
 __author__ = '@Robpol86'
 __license__ = 'MIT'
 __version__ = '1.1.0'
 
 
-class OtherInstanceError(Exception):
-    """Raised when Celery task is already running, when lock exists and has not timed out."""
+class OtherInstanceError(Exception):
+    """Raised when Celery task is already running, when lock exists and has not timed out."""
+
+    pass
+
+
+# Sent by single_instance() lock managers, with the bound task as the sender. See LockStats for a receiver.
+single_instance_acquired = Signal(providing_args=['task_identifier', 'latency'])  # Seconds spent getting the lock.
+single_instance_rejected = Signal(providing_args=['task_identifier', 'latency'])  # Another instance held the lock.
+single_instance_released = Signal(providing_args=['task_identifier', 'held'])  # Seconds the lock was held.
+single_instance_reclaimed = Signal(providing_args=['task_identifier'])  # Database lock taken over after it expired.
+single_instance_error = Signal(providing_args=['task_identifier', 'exception'])  # Lock backend failure.
+
+
+_iscoroutine = getattr(inspect, 'iscoroutine', lambda _: False)  # Python 3.5+.
+_GREEN_THREADS = list()  # Cached result of _green_threads().
+
+
+def _green_threads():
+    """Return True if threads are greenlets, monkey patched by gevent or eventlet (Celery's gevent/eventlet pools).
+
+    Checked on the first call only, from a task: pools patch threads at startup, before running tasks.
+
+    :rtype: bool
+    """
+    if not _GREEN_THREADS:
+        gevent_monkey, eventlet_patcher = sys.modules.get('gevent.monkey'), sys.modules.get('eventlet.patcher')
+        green = bool(gevent_monkey and gevent_monkey.is_module_patched('threading') or
+                     eventlet_patcher and eventlet_patcher.is_monkey_patched('thread'))
+        if green:
+            getLogger(__name__).warning("CELERY_APP_CONTEXT = 'worker' is ignored on gevent and eventlet pools, which "
+                                        'run every task in a new greenlet: each task gets a new app context.')
+        _GREEN_THREADS.append(green)
+    return _GREEN_THREADS[0]
+
+
+def _new_hasher():
+    """Return a new hash object for argument fingerprints: blake2b with a 128-bit digest, on every Python version.
+
+    The algorithm is fixed, not picked from what is installed, since all workers sharing locks must compute the same
+    keys for the same arguments. Python < 3.6 needs the pyblake2 package.
+    """
+    if blake2b is None:
+        raise NotImplementedError('include_args requires hashlib.blake2b (Python 3.6+) or the pyblake2 package.')
+    return blake2b(digest_size=16)
+
+
+# Types whose repr() is canonical and unambiguous (repr(1), repr(1.0), repr(True) and repr('1') all differ).
+_REPR_TYPES = frozenset([type(None), bool, int, float, type(u''), bytes] + ([long] if str is bytes else []))  # noqa
+_STRING_TYPES = frozenset([type(u''), bytes])
+_CHUNK = 4096  # Items of a scalar-only list encoded per repr() call, bounds the size of intermediate strings.
+
+
+def _reprable(values):
+    """Return True if all values may be encoded at once with repr() without copying large strings.
+
+    :param iter values: Items of a list/tuple or values of a dict.
+
+    :return: If the values' types are all in _REPR_TYPES and their strings add up to less than 64 KiB.
+    :rtype: bool
+    """
+    types = set(map(type, values))
+    if not types <= _REPR_TYPES:
+        return False
+    if types & _STRING_TYPES:
+        return sum(len(v) for v in values if type(v) in _STRING_TYPES) < 65536
+    return True
+
+
+def _encode_scalar(write, value):
+    """Encode None/bool/int/float by repr."""
+    write('r{0!r};'.format(value).encode('ascii'))
+
+
+def _encode_text(write, value):
+    """Encode text as UTF-8 prefixed with its length in characters, converting large strings piece by piece."""
+    write('s{0}:'.format(len(value)).encode('ascii'))
+    for i in range(0, len(value), 65536):
+        write(value[i:i + 65536].encode('utf-8', 'surrogatepass'))  # Lone surrogates are valid str values.
+
+
+def _encode_bytes(write, value):
+    """Encode bytes, length-prefixed."""
+    write('b{0}:'.format(len(value)).encode('ascii'))
+    write(value)
+
+
+def _encode_sequence(write, value):
+    """Encode a list or tuple. Lists of scalars/strings are encoded by repr in chunks instead of item by item."""
+    write('l{0}:'.format(len(value)).encode('ascii'))
+    if _reprable(value):
+        value = list(value)
+        for i in range(0, len(value), _CHUNK):
+            write(repr(value[i:i + _CHUNK]).encode('utf-8'))
+        return
+    for item in value:
+        _feed(write, item)
+
+
+def _encode_mapping(write, value):
+    """Encode a dict with its entries sorted by their encoded keys, so insertion order does not matter."""
+    write('d{0}:'.format(len(value)).encode('ascii'))
+    key_types = set(map(type, value))
+    if len(key_types) < 2 and key_types <= _REPR_TYPES:  # Keys of one type are sortable by value.
+        if _reprable(value.values()):
+            write(repr(sorted(value.items())).encode('utf-8'))
+            return
+        for key in sorted(value):
+            _feed(write, key)
+            _feed(write, value[key])
+        return
+    keys = list()
+    for key in value:
+        parts = list()
+        _feed(parts.append, key)
+        keys.append((b''.join(parts), key))
+    keys.sort(key=lambda k: k[0])
+    for encoded, key in keys:
+        write(encoded)
+        _feed(write, value[key])
+
+
+def _encode_set(write, value):
+    """Encode a set with its items sorted by their encoding."""
+    items = list()
+    for item in value:
+        parts = list()
+        _feed(parts.append, item)
+        items.append(b''.join(parts))
+    write('S{0}:'.format(len(items)).encode('ascii'))
+    for encoded in sorted(items):
+        write(encoded)
+
+
+def _encode_object(write, value):
+    """Encode an object by its class and attributes instead of its repr (which may contain a memory address)."""
+    cls = type(value)
+    write('o{0}.{1}:'.format(cls.__module__, getattr(cls, '__qualname__', cls.__name__)).encode('utf-8'))
+    if hasattr(value, '__dict__'):
+        _encode_mapping(write, vars(value))
+    else:
+        _encode_text(write, repr(value))
+
+
+# Lists and tuples share an encoding since serializers such as JSON turn tuples into lists.
+_ENCODERS = dict((t, _encode_scalar) for t in _REPR_TYPES)
+_ENCODERS.update({
+    type(u''): _encode_text,
+    bytes: _encode_bytes,
+    list: _encode_sequence,
+    tuple: _encode_sequence,
+    dict: _encode_mapping,
+    set: _encode_set,
+    frozenset: _encode_set,
+})
+
+
+def _feed(write, value):
+    """Stream a canonical encoding of `value` into `write` without building it as one string.
+
+    Builtin types (and their subclasses) have a type-tagged, length-prefixed encoding. Dicts and sets are sorted so
+    ordering does not change the result. Other objects are encoded by class name and attributes.
+
+    :param write: Callable receiving bytes, usually the update() method of a hash object.
+    :param value: Value to encode.
+    """
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        encoder = next((_ENCODERS[c] for c in type(value).__mro__ if c in _ENCODERS), _encode_object)
+    encoder(write, value)
+
+
+def _fingerprint(value):
+    """Return the hex digest of the canonical encoding of `value`.
+
+    :param value: Value to fingerprint, usually a tuple of the task's args and kwargs.
+
+    :return: Hex digest.
+    :rtype: str
+    """
+    hasher = _new_hasher()
+    _feed(hasher.update, value)
+    return hasher.hexdigest()
+
+
+class _LocalLocks(object):
+    """Process-local registry of locks held by this process, in front of the lock backends.
+
+    Claims expire after the lock's timeout just like the backend's lock, so a claim leaked by a lock manager which was
+    never exited does not block the task in this process forever.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.mutex = threading.Lock()
+        self.claims = dict()  # Key: expiration time.
+
+    def claim(self, key, timeout):
+        """Claim a lock key unless already claimed.
+
+        :param key: Lock key, hashable.
+        :param int timeout: Seconds until the claim expires.
+
+        :return: True if claimed.
+        :rtype: bool
+        """
+        now = time.time()
+        with self.mutex:
+            if self.claims.get(key, 0) > now:
+                return False
+            self.claims[key] = now + timeout
+        return True
+
+    def extend(self, key, timeout):
+        """Reset a claim's expiration, if claimed.
+
+        :param key: Lock key given to claim().
+        :param int timeout: Seconds until the claim expires, counted from now.
+        """
+        with self.mutex:
+            if key in self.claims:
+                self.claims[key] = time.time() + timeout
+
+    def release(self, key):
+        """Drop a claim, if any.
+
+        :param key: Lock key given to claim().
+        """
+        with self.mutex:
+            self.claims.pop(key, None)
+
+    def reset(self):
+        """Drop all claims, e.g. in a forked child process which does not run its parent's tasks."""
+        self.mutex = threading.Lock()
+        self.claims = dict()
+
+
+_LOCAL_LOCKS = _LocalLocks()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_LOCAL_LOCKS.reset)  # pylint: disable=no-member
+
+
+class _LockManager(object):
+    """Base class for other lock managers."""
+
+    BACKOFF_INITIAL = 0.05  # Upper bound in seconds of the first random sleep while waiting for a lock.
+    BACKOFF_MAX = 2.0  # Upper bound of later sleeps, doubling from BACKOFF_INITIAL.
+    UNTRACKED_OWNER = 'untracked.{0}'  # Owner token of locks taken outside of a Celery worker, with no task id.
+    CLAIMED_OWNER = 'claim:{0}'  # Owner token of locks claimed when publishing a task id, until the task adopts them.
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        """May raise NotImplementedError if the Celery backend is not supported.
+
+        :param celery_self: From wrapped() within single_instance(). It is the `self` object specified in a binded
+            Celery task definition (implicit first argument of the Celery task when @celery.task(bind=True) is used).
+        :param int timeout: Lock's timeout value in seconds.
+        :param bool include_args: If single instance should take arguments into account.
+        :param iter args: The task instance's args.
+        :param dict kwargs: The task instance's kwargs.
+        :param _LockPlan plan: Pre-resolved settings shared by all instances of the task. Built here if not specified.
+        """
+        self.celery_self = celery_self
+        self.timeout = timeout
+        self.include_args = include_args
+        self.args = args
+        self.kwargs = kwargs
+        self.plan = plan or _LockPlan(celery_self, timeout, include_args, manager_class=self.__class__)
+        self.task_identifier = self.plan.task_identifier(args, kwargs)
+        self.store = self.plan.store
+        self.local_key = (id(self.store), self.task_identifier)  # None if instances are not claimed locally.
+        self.owner = None
+        self.other_owner = None  # Set by lock managers learning the holder's token when failing to acquire the lock.
+        self.coalesced = False
+        self.acquired_at = None
+        self.log = self.plan.log
+
+    @classmethod
+    def backend_store(cls, backend):
+        """Return the store holding locks when they are kept in the Celery result backend.
+
+        :param backend: Celery result backend instance.
+
+        :return: Object the lock manager talks to (self.store), e.g. a Redis client.
+        """
+        return backend
+
+    @classmethod
+    def open_store(cls, url):
+        """Return the store holding locks when they are kept apart from the result backend, in a lock URL.
+
+        Called once per URL and process, the store is shared by every task using it.
+
+        :raise NotImplementedError: If this lock manager can't be used with lock URLs.
+
+        :param str url: Value of CELERY_SINGLE_INSTANCE_LOCK_URL.
+
+        :return: Object the lock manager talks to (self.store), e.g. a Redis client.
+        """
+        raise NotImplementedError('{0} does not support lock URLs.'.format(cls.__name__))
+
+    @classmethod
+    def reap(cls, store, batch_size, max_batches=None):
+        """Delete expired locks from a store. Nothing to delete by default.
+
+        Locks that expire on their own (Redis) or are reused in place (files) leave nothing to delete.
+
+        :param store: Object the lock manager talks to (self.store).
+        :param int batch_size: Locks deleted per statement.
+        :param int max_batches: Stop after this many batches, None to delete every expired lock.
+
+        :return: Number of locks deleted.
+        :rtype: int
+        """
+        return 0
+
+    def send(self, signal, **named):
+        """Send one of the single_instance_* signals about this lock, if anything is connected to it.
+
+        :param celery.utils.dispatch.Signal signal: Signal to send.
+        :param dict named: Signal arguments besides task_identifier.
+        """
+        if signal.receivers:
+            signal.send(sender=self.celery_self, task_identifier=self.task_identifier, **named)
+
+    def __enter__(self):
+        """Acquire the lock, see enter_steps().
+
+        :raise OtherInstanceError: If another instance holds the lock (past the deadline).
+        """
+        self.run_steps(self.enter_steps())
+
+    def __exit__(self, exc_type, *_):
+        if exc_type == OtherInstanceError:
+            # Failed to get lock last time, not releasing.
+            return
+        self.run_steps(self.exit_steps())
+
+    def run_steps(self, steps):
+        """Run the lock I/O of enter_steps() or exit_steps(), blocking.
+
+        The asyncio lock managers run the same steps with their own I/O, so the flow of locking is only written once.
+
+        :param steps: Generator yielding the name of a lock manager method to call ('acquire', 'mark_dirty', 'release'
+            or 'follow_up') or seconds to sleep, and receiving the method's return value or exception.
+        """
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration:
+                return
+            try:
+                result, error = getattr(self, step)() if isinstance(step, str) else time.sleep(step), None
+            except Exception as exc:  # pylint: disable=broad-except
+                result, error = None, exc  # Raised in the generator, which handles it or raises it again.
+
+    def enter_steps(self):
+        """Acquire the lock, sending single_instance_acquired, single_instance_rejected or single_instance_error.
+
+        Duplicates running in the same process (thread/gevent/eventlet pools) are rejected without a round trip. When
+        coalescing, a duplicate marks the running instance's lock dirty instead and sets `coalesced`. If the task waits
+        for locks, it retries with jittered exponential backoff until its deadline (or until it coalesced).
+
+        :raise OtherInstanceError: If another instance holds the lock (past the deadline).
+        """
+        started = time.time()
+        deadline, delay, vanished = started + (self.plan.wait or 0), self.BACKOFF_INITIAL, 0
+        try:
+            while True:
+                if self.local_key is not None and not _LOCAL_LOCKS.claim(self.local_key, self.timeout):
+                    self.log.debug('Another instance is running in this process.')
+                    rejected = OtherInstanceError('Failed to acquire lock, {0} already running.'.format(
+                        self.task_identifier))
+                else:
+                    try:
+                        yield 'acquire'
+                        break
+                    except OtherInstanceError as exc:
+                        _LOCAL_LOCKS.release(self.local_key)
+                        rejected = exc
+                    except Exception:
+                        _LOCAL_LOCKS.release(self.local_key)
+                        raise
+                if self.plan.coalesce:
+                    if (yield 'mark_dirty'):
+                        self.log.debug('Coalesced into the running instance.')
+                        self.coalesced = True
+                        raise rejected  # The running instance runs once more for this one.
+                    if vanished < 2:  # Released between failing to get it and marking it, try again at once.
+                        vanished += 1
+                        continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise rejected
+                yield min(remaining, random.uniform(0, delay))
+                delay, vanished = min(delay * 2, self.BACKOFF_MAX), 0
+        except OtherInstanceError:
+            self.send(single_instance_rejected, latency=time.time() - started)
+            raise
+        except Exception as exc:
+            self.send(single_instance_error, exception=exc)
+            raise
+        self.acquired_at = time.time()
+        self.send(single_instance_acquired, latency=self.acquired_at - started)
+
+    def exit_steps(self):
+        """Release the lock, sending single_instance_released or single_instance_error, then run the follow-up if dirty.
+
+        A failure to publish the follow-up is logged and sent as single_instance_error, not raised. See run_steps().
+        """
+        self.log.debug('Releasing lock.')
+        try:
+            dirty = yield 'release'
+        except Exception as exc:
+            self.send(single_instance_error, exception=exc)
+            raise
+        finally:
+            _LOCAL_LOCKS.release(self.local_key)
+        self.send(single_instance_released, held=time.time() - self.acquired_at)
+        if dirty and self.plan.coalesce:
+            self.log.debug('Duplicates were coalesced while running, running once more.')
+            try:
+                yield 'follow_up'
+            except Exception as exc:  # pylint: disable=broad-except
+                # Not raised over the task's own outcome, it ran and released its lock.
+                self.log.warning('Failed to publish the run of coalesced duplicates.', exc_info=True)
+                self.send(single_instance_error, exception=exc)
+
+    def follow_up(self):
+        """Publish the task again with the same arguments, the run of the duplicates coalesced into this instance."""
+        self.celery_self.apply_async(self.args, self.kwargs)
+
+    def new_owner(self):
+        """Return the token identifying this lock holder: the Celery task id when running as a task, else random.
+
+        A held lock is never acquired again, not even by the same task id (e.g. a redelivered message), except to adopt
+        the lock claimed for this task when it was published, see claim_token().
+
+        :rtype: str
+        """
+        task_id = getattr(getattr(self.celery_self, 'request', None), 'id', None)
+        return task_id or self.UNTRACKED_OWNER.format(uuid.uuid4().hex)
+
+    def claim_token(self):
+        """Return the owner token of the lock claimed for this task when it was published, which acquire() adopts.
+
+        :return: None unless the task was published with publish='claim' and runs as a Celery task.
+        :rtype: str
+        """
+        if self.plan.publish != 'claim':
+            return None
+        task_id = getattr(getattr(self.celery_self, 'request', None), 'id', None)
+        return self.CLAIMED_OWNER.format(task_id) if task_id else None
+
+    def running_task_id(self):
+        """Return the Celery task id of the instance holding the lock, for joining it.
+
+        :return: None if the lock is free or held by a call made outside of a Celery worker (which has no result).
+        :rtype: str
+        """
+        owner = self.current_owner()
+        if not owner or owner.startswith(self.UNTRACKED_OWNER.format('')):
+            return None
+        claimed = self.CLAIMED_OWNER.format('')
+        return owner[len(claimed):] if owner.startswith(claimed) else owner
+
+    def current_owner(self):
+        """Return the owner token of the lock if it exists and has not timed out. Must be implemented by managers."""
+        raise NotImplementedError
+
+    def acquire(self):
+        """Try to acquire the lock once in the lock backend, as self.owner if set. Must be implemented by managers.
+
+        :raise OtherInstanceError: If another instance holds the lock.
+        """
+        raise NotImplementedError
+
+    def release(self):
+        """Release the lock in the lock backend if still owned. Must be implemented by lock managers.
+
+        :return: True if the lock was marked dirty by a coalesced duplicate (the mark is cleared with the lock).
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def mark_dirty(self):
+        """Mark the lock dirty if it exists, for coalescing. Must be implemented by lock managers supporting it.
+
+        :return: False if there was no lock to mark (it was released in the meantime).
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def remove(self):
+        """Delete the lock in the lock backend regardless of owner and timeout. Must be implemented by lock managers."""
+        raise NotImplementedError
+
+    def reset_lock(self):
+        """Removed the lock regardless of timeout."""
+        _LOCAL_LOCKS.release(self.local_key)
+        self.remove()
+
+    def extend(self):
+        """Reset the lock's timeout, used by heartbeats. Must be implemented by lock managers supporting heartbeats.
+
+        :return: False if the lock was no longer owned (it expired and was taken over or removed).
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the lock status of many task instances sharing one backend.
+
+        Subclasses answer with a single round trip, this fallback checks each lock one by one.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (running, remaining seconds or None) tuple for each manager, in order.
+        :rtype: list
+        """
+        return [(m.is_already_running, None) for m in managers]
+
+
+class _LockManagerRedis(_LockManager):
+    """Handle locking/unlocking for Redis backends.
+
+    Acquiring and releasing are one round trip each, using Lua scripts registered once per task. The lock's value is the
+    owner token so a worker never releases a lock which expired and was taken over by another worker.
+
+    Keys are namespaced with CELERY_SINGLE_INSTANCE_KEY_PREFIX. With CELERY_SINGLE_INSTANCE_HASH_TAGS (implied by Redis
+    Cluster stores, see open_store()) the task identifier is a hash tag: all keys of one lock map to the same cluster
+    slot, as multi-key scripts require, while locks of different tasks and arguments spread over every slot and node.
+    """
+
+    KEY_PREFIX = '_celery.single_instance'  # Default namespace.
+    CELERY_LOCK = '{prefix}.{task_id}'
+    CELERY_LOCK_TAGGED = '{prefix}.{{{task_id}}}'
+
+    # KEYS[1]: lock key. KEYS[2]: dirty mark key. ARGV[1]: owner token. ARGV[2]: timeout in milliseconds.
+    # ARGV[3]: claim token to adopt, empty if none. Returns 1 if acquired (or the claim was adopted, keeping its dirty
+    # mark), else the current owner's token.
+    ACQUIRE_SCRIPT = """
+        if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+            return 1
+        end
+        local owner = redis.call('get', KEYS[1])
+        if ARGV[3] ~= '' and owner == ARGV[3] then
+            redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+            redis.call('pexpire', KEYS[2], ARGV[2])
+            return 1
+        end
+        return owner
+    """
+
+    # KEYS[1]: lock key. KEYS[2]: dirty mark key. ARGV[1]: owner token.
+    # Returns 1 if released, 2 if released and marked dirty (mark deleted too), 0 if the lock was no longer owned.
+    RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            redis.call('del', KEYS[1])
+            return 1 + redis.call('del', KEYS[2])
+        end
+        return 0
+    """
+
+    # KEYS[1]: lock key. KEYS[2]: dirty mark key. Returns 1 if marked, 0 if there is no lock.
+    MARK_SCRIPT = """
+        local ttl = redis.call('pttl', KEYS[1])
+        if ttl > 0 then
+            redis.call('set', KEYS[2], 1, 'PX', ttl)
+            return 1
+        end
+        return 0
+    """
+
+    # KEYS[1]: lock key. KEYS[2]: dirty mark key. ARGV[1]: owner token. ARGV[2]: timeout in milliseconds.
+    # Returns 1 if extended, else 0. The dirty mark, if any, always expires with the lock.
+    EXTEND_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            redis.call('pexpire', KEYS[2], ARGV[2])
+            return redis.call('pexpire', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        super(_LockManagerRedis, self).__init__(celery_self, timeout, include_args, args, kwargs, plan)
+        self.redis_key = self.key_function(self.plan)(task_id=self.task_identifier)
+        self.dirty_key = self.redis_key + '.dirty'
+
+    @classmethod
+    def key_function(cls, plan):
+        """Return the function formatting the lock key of a task identifier (task_id keyword argument) for a plan.
+
+        :param _LockPlan plan: Plan of the task, its configuration and store select the key format.
+        """
+        key_function = plan.cache.get('key_function')
+        if key_function is None:
+            conf = plan.celery_self.app.conf
+            tagged = conf.get('CELERY_SINGLE_INSTANCE_HASH_TAGS') or plan.store.__class__.__name__ == 'RedisCluster'
+            template = cls.CELERY_LOCK_TAGGED if tagged else cls.CELERY_LOCK
+            prefix = conf.get('CELERY_SINGLE_INSTANCE_KEY_PREFIX') or cls.KEY_PREFIX
+            key_function = plan.cache['key_function'] = partial(template.format, prefix=prefix)
+        return key_function
+
+    @classmethod
+    def backend_store(cls, backend):
+        """Return the Redis client of a Celery RedisBackend."""
+        return backend.client
+
+    @classmethod
+    def open_store(cls, url):
+        """Return a Redis client for a redis:// (or rediss://) lock URL, connecting on first use.
+
+        redis+cluster:// (or rediss+cluster://) URLs of any node of a Redis Cluster return a cluster client (redis-py
+        4.1+), which connects right away to discover the other nodes.
+        """
+        import redis
+        scheme, address = url.split('://', 1)
+        if scheme.endswith('+cluster'):
+            from redis.cluster import RedisCluster
+            return RedisCluster.from_url(scheme[:-len('+cluster')] + '://' + address)
+        return redis.StrictRedis.from_url(url)
+
+    @property
+    def scripts(self):
+        """Return the registered (acquire, release, extend, mark) scripts, registering them on first use."""
+        scripts = self.plan.cache.get('scripts')
+        if scripts is None:
+            client = self.store
+            sources = (self.ACQUIRE_SCRIPT, self.RELEASE_SCRIPT, self.EXTEND_SCRIPT, self.MARK_SCRIPT)
+            scripts = self.plan.cache['scripts'] = tuple(client.register_script(s) for s in sources)
+        return scripts
+
+    def acquire(self):
+        """Try to acquire the lock once.
+
+        :raise OtherInstanceError: If another instance holds the lock.
+        """
+        owner, claim = (self.owner, None) if self.owner else (self.new_owner(), self.claim_token())
+        self.log.debug('Timeout %ds | Redis key %s', self.timeout, self.redis_key)
+        result = self.scripts[0](keys=[self.redis_key, self.dirty_key],
+                                 args=[owner, int(self.timeout * 1000), claim or ''])
+        if result != 1:
+            self.other_owner = result.decode('utf-8')
+            self.log.debug('Another instance is running.')
+            raise OtherInstanceError('Failed to acquire lock, {0} already running.'.format(self.task_identifier))
+        self.owner = owner
+        self.log.debug('Got lock, running.')
+
+    def release(self):
+        """Release the lock if still owned, in one round trip.
+
+        :return: True if the lock was marked dirty by a coalesced duplicate.
+        :rtype: bool
+        """
+        released = self.scripts[1](keys=[self.redis_key, self.dirty_key], args=[self.owner])
+        if not released:
+            self.log.warning('Lock timed out before the task finished, another instance may have been running.')
+        self.owner = None
+        return released == 2
+
+    def mark_dirty(self):
+        """Mark the lock dirty if it exists, in one round trip. The mark expires with the lock.
+
+        :return: False if there was no lock to mark.
+        :rtype: bool
+        """
+        return bool(self.scripts[3](keys=[self.redis_key, self.dirty_key]))
+
+    def extend(self):
+        """Reset the lock's timeout if still owned, in one round trip.
+
+        :return: False if the lock was no longer owned (it expired and was taken over or removed).
+        :rtype: bool
+        """
+        return bool(self.scripts[2](keys=[self.redis_key, self.dirty_key], args=[self.owner, int(self.timeout * 1000)]))
+
+    @property
+    def is_already_running(self):
+        """Return True if lock exists and has not timed out."""
+        return bool(self.store.exists(self.redis_key))
+
+    def current_owner(self):
+        """Return the owner token of the lock if it exists, without a round trip if acquiring it just failed.
+
+        :rtype: str
+        """
+        if self.other_owner:
+            return self.other_owner
+        owner = self.store.get(self.redis_key)
+        return None if owner is None else owner.decode('utf-8')
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the lock status of many task instances with one pipelined PTTL round trip.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (running, remaining seconds or None) tuple for each manager, in order.
+        :rtype: list
+        """
+        pipeline = managers[0].store.pipeline(transaction=False)
+        for manager in managers:
+            pipeline.pttl(manager.redis_key)
+        # PTTL is -2 if the key does not exist, -1 if it has no expiration.
+        return [(ttl != -2, ttl / 1000.0 if ttl >= 0 else None) for ttl in pipeline.execute()]
+
+    def remove(self):
+        """Delete the lock regardless of owner and timeout."""
+        self.store.delete(self.redis_key)
+
+
+class _LockManagerRedisQuorum(_LockManagerRedis):
+    """Handle locking/unlocking on several independent Redis servers, holding the lock on a majority of them.
+
+    Selected with quorum+ lock URLs listing the servers separated by semicolons, for example
+    quorum+redis://redis-a:6379/0;redis://redis-b:6379/0;redis://redis-c:6379/0. Every server runs the scripts of
+    _LockManagerRedis with the same keys. As in the Redlock algorithm, the lock is held once a majority of the servers
+    granted it within its validity time (the timeout minus the time spent acquiring and an allowance for clock drift),
+    otherwise the partial grants are released. Failing servers are logged and count as not granting the lock, so
+    locking keeps working while a minority of them is down.
+    """
+
+    CLOCK_DRIFT = 0.01  # Fraction of the timeout (plus 2 ms) deducted from the lock's validity time.
+
+    @classmethod
+    def backend_store(cls, backend):
+        """Not supported, quorum locks need several servers."""
+        raise NotImplementedError('Quorum locks require a quorum+ lock URL.')
+
+    @classmethod
+    def open_store(cls, url):
+        """Return a Redis client for each server of a quorum+ lock URL, connecting on first use."""
+        return tuple(_LockManagerRedis.open_store(u) for u in url[len('quorum+'):].split(';'))
+
+    @property
+    def quorum(self):
+        """Return the number of servers which must agree."""
+        return len(self.store) // 2 + 1
+
+    @property
+    def scripts(self):
+        """Return the registered (acquire, release, extend, mark) scripts of each server, registered on first use."""
+        scripts = self.plan.cache.get('scripts')
+        if scripts is None:
+            sources = (self.ACQUIRE_SCRIPT, self.RELEASE_SCRIPT, self.EXTEND_SCRIPT, self.MARK_SCRIPT)
+            scripts = self.plan.cache['scripts'] = [tuple(c.register_script(s) for s in sources) for c in self.store]
+        return scripts
+
+    def each(self, func):
+        """Call func on every server, one after the other.
+
+        :raise Exception: The first server's error if too many servers failed for a quorum.
+
+        :param func: Called with a server's client and registered scripts.
+
+        :return: func's return value for each server, None where it failed.
+        :rtype: list
+        """
+        results, errors = list(), list()
+        for client, scripts in zip(self.store, self.scripts):
+            try:
+                results.append(func(client, scripts))
+            except Exception as exc:  # pylint: disable=broad-except
+                self.log.warning('Lock server %d failed: %s', len(results), exc)
+                results.append(None)
+                errors.append(exc)
+        if len(errors) > len(self.store) - self.quorum:
+            raise errors[0]
+        return results
+
+    def acquire(self):
+        """Try to acquire the lock once on every server.
+
+        :raise OtherInstanceError: If no majority of the servers granted the lock in time.
+        """
+        owner, claim = (self.owner, None) if self.owner else (self.new_owner(), self.claim_token())
+        keys, args = [self.redis_key, self.dirty_key], [owner, int(self.timeout * 1000), claim or '']
+        self.log.debug('Timeout %ds | Redis key %s', self.timeout, self.redis_key)
+        started = time.time()
+        results = self.each(lambda _, scripts: scripts[0](keys=keys, args=args))
+        validity = self.timeout * (1 - self.CLOCK_DRIFT) - 0.002 - (time.time() - started)
+        if results.count(1) >= self.quorum and validity > 0:
+            self.owner = owner
+            self.log.debug('Got lock on %d of %d servers, running.', results.count(1), len(results))
+            return
+        if 1 in results:
+            self.each(lambda _, scripts: scripts[1](keys=keys, args=[owner]))
+        owners = [r.decode('utf-8') for r in results if r not in (None, 1)]
+        self.other_owner = max(set(owners), key=owners.count) if owners else None
+        self.log.debug('Another instance is running.')
+        raise OtherInstanceError('Failed to acquire lock, {0} already running.'.format(self.task_identifier))
+
+    def release(self):
+        """Release the lock on every server where still owned.
+
+        :return: True if the lock was marked dirty by a coalesced duplicate on any server.
+        :rtype: bool
+        """
+        keys, owner = [self.redis_key, self.dirty_key], self.owner
+        results = self.each(lambda _, scripts: scripts[1](keys=keys, args=[owner]))
+        if len([r for r in results if r]) < self.quorum:
+            self.log.warning('Lock timed out before the task finished, another instance may have been running.')
+        self.owner = None
+        return 2 in results
+
+    def mark_dirty(self):
+        """Mark the lock dirty on every server where it exists.
+
+        :return: False if no server had a lock to mark.
+        :rtype: bool
+        """
+        keys = [self.redis_key, self.dirty_key]
+        return 1 in self.each(lambda _, scripts: scripts[3](keys=keys))
+
+    def extend(self):
+        """Reset the lock's timeout on every server where still owned.
+
+        :return: False if the lock was no longer owned on a majority of the servers.
+        :rtype: bool
+        """
+        keys, args = [self.redis_key, self.dirty_key], [self.owner, int(self.timeout * 1000)]
+        return self.each(lambda _, scripts: scripts[2](keys=keys, args=args)).count(1) >= self.quorum
+
+    @property
+    def is_already_running(self):
+        """Return True if the lock exists on a majority of the servers."""
+        return sum(bool(r) for r in self.each(lambda client, _: client.exists(self.redis_key))) >= self.quorum
+
+    def current_owner(self):
+        """Return the owner token of the lock if a majority of the servers agree on it.
+
+        :rtype: str
+        """
+        if self.other_owner:
+            return self.other_owner
+        owners = [r for r in self.each(lambda client, _: client.get(self.redis_key)) if r]
+        owner = max(set(owners), key=owners.count) if owners else None
+        return owner.decode('utf-8') if owner and owners.count(owner) >= self.quorum else None
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the lock status of many task instances with one pipelined PTTL round trip per server.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (running, remaining seconds or None) tuple for each manager, in order. Remaining seconds are those of
+            the lock on the server making the quorum.
+        :rtype: list
+        """
+        def status(client, _):
+            pipeline = client.pipeline(transaction=False)
+            for manager in managers:
+                pipeline.pttl(manager.redis_key)
+            return pipeline.execute()
+
+        quorum = managers[0].quorum
+        servers = [ttls for ttls in managers[0].each(status) if ttls is not None]
+        statuses = list()
+        for ttls in zip(*servers):
+            ttls = sorted((t for t in ttls if t != -2), reverse=True)  # PTTL is -2 if the key does not exist.
+            if len(ttls) < quorum:
+                statuses.append((False, None))
+            else:
+                statuses.append((True, ttls[quorum - 1] / 1000.0 if ttls[quorum - 1] >= 0 else None))
+        return statuses
+
+    def remove(self):
+        """Delete the lock on every server regardless of owner and timeout."""
+        self.each(lambda client, _: client.delete(self.redis_key, self.dirty_key))
+
+
+class _LockTable(object):
+    """Dedicated lock table for database backends, with one engine (connection pool) per database URL and process.
+
+    Acquiring (including taking over an expired lock) is a single INSERT ... ON CONFLICT DO UPDATE ... WHERE expired
+    statement on PostgreSQL and SQLite >= 3.24 (with SQLAlchemy >= 1.4). Other databases INSERT and, only if the lock
+    exists, take it over with an UPDATE ... WHERE expired. Each statement is atomic on its own. Locks claimed when
+    publishing are adopted the same way, by the published task only.
+
+    The rate_limit() decorator's table is created on first use, in the same database.
+
+    Expired locks are otherwise only deleted when their key is acquired again, reap() deletes all of them (e.g. from a
+    periodic task) so keys that never repeat don't accumulate.
+    """
+
+    TABLE_NAME = 'celery_single_instance_lock'
+    RATE_TABLE_NAME = 'celery_rate_limit'
+    INSTANCES = dict()
+
+    def __init__(self, url, engine_options=None):
+        """Connect to the database and create the lock table if it does not exist.
+
+        :param str url: SQLAlchemy database URL.
+        :param dict engine_options: Keyword arguments for sqlalchemy.create_engine().
+        """
+        import sqlalchemy as sa
+        from sqlalchemy.exc import IntegrityError
+        self.integrity_error = IntegrityError
+        self.engine = sa.create_engine(url, **(engine_options or dict()))
+        metadata = sa.MetaData()
+        self.table = table = sa.Table(
+            self.TABLE_NAME, metadata,
+            sa.Column('lock_id', sa.String(255), primary_key=True),
+            sa.Column('owner', sa.String(155), nullable=False),  # Same length as Celery's task_id columns.
+            sa.Column('expires', sa.DateTime, nullable=False, index=True),
+            sa.Column('dirty', sa.Boolean, nullable=False, default=False),  # Set by coalesced duplicates.
+        )
+        metadata.create_all(self.engine)
+        modern = tuple(int(p) for p in sa.__version__.split('.')[:2]) >= (1, 4)
+
+        # Taking over an expired lock clears its dirty mark, adopting a claimed one keeps it.
+        whens = [(table.c.expires < sa.bindparam('now'), sa.false())]
+        self.keep_dirty = sa.case(*whens, else_=table.c.dirty) if modern else sa.case(whens, else_=table.c.dirty)
+        self.insert = table.insert()
+        self.takeover = table.update().where(sa.and_(
+            table.c.lock_id == sa.bindparam('b_lock_id'),
+            sa.or_(table.c.expires < sa.bindparam('now'), table.c.owner == sa.bindparam('b_adopt')),
+        )).values(owner=sa.bindparam('b_owner'), expires=sa.bindparam('b_expires'), dirty=self.keep_dirty)
+        self.release_owned = table.delete().where(
+            sa.and_(table.c.lock_id == sa.bindparam('b_lock_id'), table.c.owner == sa.bindparam('b_owner'))
+        )
+        self.release_clean = self.release_owned.where(table.c.dirty == sa.false())
+        self.mark = table.update().where(
+            sa.and_(table.c.lock_id == sa.bindparam('b_lock_id'), table.c.expires >= sa.bindparam('now'))
+        ).values(dirty=True)
+        self.renew = table.update().where(sa.and_(
+            table.c.lock_id == sa.bindparam('b_lock_id'), table.c.owner == sa.bindparam('b_owner'),
+            table.c.expires >= sa.bindparam('now'),
+        )).values(expires=sa.bindparam('b_expires'))
+        self.delete = table.delete().where(table.c.lock_id == sa.bindparam('b_lock_id'))
+        columns = [table.c.lock_id, table.c.expires]
+        if modern:
+            self.select = sa.select(*columns)
+        else:
+            self.select = sa.select(columns)
+        self.select = self.select.where(table.c.lock_id.in_(sa.bindparam('b_lock_ids', expanding=True)))
+        self.select_owner = sa.select(table.c.owner) if modern else sa.select([table.c.owner])
+        self.select_owner = self.select_owner.where(
+            sa.and_(table.c.lock_id == sa.bindparam('b_lock_id'), table.c.expires >= sa.bindparam('now'))
+        )
+        self.select_expired = sa.select(table.c.lock_id) if modern else sa.select([table.c.lock_id])
+        self.select_expired = self.select_expired.where(table.c.expires < sa.bindparam('now'))
+        self.delete_expired = table.delete().where(sa.and_(  # Unless acquired again since selected.
+            table.c.lock_id.in_(sa.bindparam('b_keys', expanding=True)), table.c.expires < sa.bindparam('now'),
+        ))
+        self.upsert = self._upsert(sa)
+        self.rate_statements = None  # Built by throttle() or reap() on first use.
+
+    def _upsert(self, sa):
+        """Return the single-statement acquire for this dialect, or None if it has none."""
+        dialect = self.engine.dialect
+        try:
+            if dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            elif dialect.name == 'sqlite' and (dialect.server_version_info or (0, )) >= (3, 24):
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                return None
+        except ImportError:  # SQLAlchemy too old.
+            return None
+        statement = insert(self.table)
+        return statement.on_conflict_do_update(
+            index_elements=[self.table.c.lock_id],
+            set_=dict(owner=statement.excluded.owner, expires=statement.excluded.expires, dirty=self.keep_dirty),
+            where=sa.or_(self.table.c.expires < sa.bindparam('now'), self.table.c.owner == sa.bindparam('adopt')),
+        )
+
+    @classmethod
+    def get(cls, backend):
+        """Return the instance for a Celery DatabaseBackend, creating it on first use in this process.
+
+        :param backend: Celery DatabaseBackend instance.
+        """
+        return cls.for_url(getattr(backend, 'url', None) or backend.dburi, getattr(backend, 'engine_options', None))
+
+    @classmethod
+    def for_url(cls, url, engine_options=None):
+        """Return the instance for a database URL, creating it on first use in this process.
+
+        :param str url: SQLAlchemy database URL.
+        :param dict engine_options: Keyword arguments for sqlalchemy.create_engine(), used on first use only.
+        """
+        key = (os.getpid(), url)  # Connection pools must not be shared with forked worker processes.
+        instance = cls.INSTANCES.get(key)
+        if instance is None:
+            instance = cls.INSTANCES[key] = cls(url, engine_options)
+        return instance
+
+    def acquire(self, lock_id, owner, timeout, adopt=None):
+        """Create the lock, or take it over if it expired or is owned by `adopt` (a claim).
+
+        :param str lock_id: Task identifier.
+        :param str owner: Token identifying this lock holder.
+        :param int timeout: Lock timeout in seconds.
+        :param str adopt: Owner token of a claimed lock to take over, None to only take over expired locks.
+
+        :return: True if the lock was acquired.
+        :rtype: bool
+        """
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=timeout)
+        if self.upsert is not None:
+            with self.engine.begin() as connection:
+                params = dict(lock_id=lock_id, owner=owner, expires=expires, now=now, adopt=adopt)
+                return connection.execute(self.upsert, params).rowcount == 1
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(self.insert, dict(lock_id=lock_id, owner=owner, expires=expires))
+            return True
+        except self.integrity_error:
+            pass
+        with self.engine.begin() as connection:
+            params = dict(b_lock_id=lock_id, b_owner=owner, b_expires=expires, now=now, b_adopt=adopt)
+            return connection.execute(self.takeover, params).rowcount == 1
+
+    def release(self, lock_id, owner):
+        """Delete the lock if still owned by `owner`.
+
+        Clean locks are deleted with one statement. Only if that deleted nothing, a second statement deletes a dirty
+        lock. A duplicate marking the lock in between finds nothing to mark and retries acquiring instead.
+
+        :param str lock_id: Task identifier.
+        :param str owner: Token given to acquire().
+
+        :return: None if the lock was no longer owned (it expired and was taken over or removed), else True if it was
+            marked dirty by a coalesced duplicate.
+        :rtype: bool
+        """
+        params = dict(b_lock_id=lock_id, b_owner=owner)
+        with self.engine.begin() as connection:
+            if connection.execute(self.release_clean, params).rowcount == 1:
+                return False
+        with self.engine.begin() as connection:
+            return True if connection.execute(self.release_owned, params).rowcount == 1 else None
+
+    def mark_dirty(self, lock_id):
+        """Mark an unexpired lock dirty.
+
+        :param str lock_id: Task identifier.
+
+        :return: False if there was no lock to mark.
+        :rtype: bool
+        """
+        with self.engine.begin() as connection:
+            return connection.execute(self.mark, dict(b_lock_id=lock_id, now=datetime.utcnow())).rowcount == 1
+
+    def extend(self, lock_id, owner, timeout):
+        """Reset the lock's expiration if still owned by `owner` and not expired.
+
+        :param str lock_id: Task identifier.
+        :param str owner: Token given to acquire().
+        :param int timeout: Lock timeout in seconds, counted from now.
+
+        :return: False if the lock was no longer owned (it expired, or was taken over or removed).
+        :rtype: bool
+        """
+        now = datetime.utcnow()
+        params = dict(b_lock_id=lock_id, b_owner=owner, b_expires=now + timedelta(seconds=timeout), now=now)
+        with self.engine.begin() as connection:
+            return connection.execute(self.renew, params).rowcount == 1
+
+    def remove(self, lock_id):
+        """Delete the lock regardless of owner and timeout.
+
+        :param str lock_id: Task identifier.
+        """
+        with self.engine.begin() as connection:
+            connection.execute(self.delete, dict(b_lock_id=lock_id))
+
+    def expiration(self, lock_ids):
+        """Look up when locks expire with one query.
+
+        :param iter lock_ids: Task identifiers.
+
+        :return: Lock expiration (naive UTC datetime) for each existing lock, expired or not.
+        :rtype: dict
+        """
+        with self.engine.begin() as connection:
+            return dict(connection.execute(self.select, dict(b_lock_ids=list(set(lock_ids)))).fetchall())
+
+    def owner(self, lock_id):
+        """Look up who holds an unexpired lock.
+
+        :param str lock_id: Task identifier.
+
+        :return: Owner token, None if there is no unexpired lock.
+        :rtype: str
+        """
+        with self.engine.begin() as connection:
+            return connection.execute(self.select_owner, dict(b_lock_id=lock_id, now=datetime.utcnow())).scalar()
+
+    def _rate_table(self):
+        """Create the rate limit table if it does not exist.
+
+        :return: Take (conditional UPDATE), insert, select, select idle and delete idle statements.
+        :rtype: tuple
+        """
+        import sqlalchemy as sa
+        metadata = sa.MetaData()
+        table = sa.Table(
+            self.RATE_TABLE_NAME, metadata,
+            sa.Column('rate_key', sa.String(255), primary_key=True),
+            sa.Column('tat', sa.BigInteger, nullable=False, index=True),  # Theoretical arrival time in microseconds.
+        )
+        metadata.create_all(self.engine)
+        now = sa.bindparam('now', type_=sa.BigInteger)
+        whens = [(table.c.tat < now, now)]
+        modern = tuple(int(p) for p in sa.__version__.split('.')[:2]) >= (1, 4)
+        start = sa.case(*whens, else_=table.c.tat) if modern else sa.case(whens, else_=table.c.tat)
+        take = table.update().where(sa.and_(
+            table.c.rate_key == sa.bindparam('b_rate_key'), table.c.tat <= sa.bindparam('ceiling'),
+        )).values(tat=start + sa.bindparam('step', type_=sa.BigInteger))
+        select = sa.select(table.c.tat) if modern else sa.select([table.c.tat])
+        select = select.where(table.c.rate_key == sa.bindparam('b_rate_key'))
+
+        # A key whose TAT has passed behaves like a missing one, its row can be deleted.
+        select_idle = sa.select(table.c.rate_key) if modern else sa.select([table.c.rate_key])
+        select_idle = select_idle.where(table.c.tat < now)
+        delete_idle = table.delete().where(sa.and_(
+            table.c.rate_key.in_(sa.bindparam('b_keys', expanding=True)), table.c.tat < now,
+        ))
+        return take, table.insert(), select, select_idle, delete_idle
+
+    def throttle(self, key, interval, burst):
+        """Count one request against a GCRA rate limit if it conforms, with one statement in the common case.
+
+        Each key has a theoretical arrival time (TAT). A request conforms if the TAT is at most (burst - 1) intervals
+        ahead of now, and then pushes it one interval further. Both happen in a single conditional UPDATE.
+
+        :param str key: Rate limit key.
+        :param float interval: Seconds between requests at the sustained rate.
+        :param int burst: Requests allowed at once after an idle period.
+
+        :return: 0 if the request conforms and was counted, else seconds until it would conform.
+        :rtype: float
+        """
+        if self.rate_statements is None:
+            self.rate_statements = self._rate_table()
+        take, insert, select = self.rate_statements[:3]
+        step = int(interval * 1000000)
+        for _ in range(3):  # Only retried if the key was created or freed in between.
+            now = int(time.time() * 1000000)
+            with self.engine.begin() as connection:
+                params = dict(b_rate_key=key, now=now, step=step, ceiling=now + step * (burst - 1))
+                if connection.execute(take, params).rowcount == 1:
+                    return 0
+                tat = connection.execute(select, dict(b_rate_key=key)).scalar()
+            if tat is None:
+                try:
+                    with self.engine.begin() as connection:
+                        connection.execute(insert, dict(rate_key=key, tat=now + step))
+                    return 0
+                except self.integrity_error:
+                    continue
+            wait = (tat - now - step * (burst - 1)) / 1000000.0
+            if wait > 0:
+                return wait
+        return interval
+
+    def reap(self, batch_size=1000, max_batches=None):
+        """Delete expired locks and idle rate limits, each batch in its own short transaction.
+
+        Rows are found with the expires (and tat) indexes, then deleted by primary key only if still expired, so a lock
+        acquired again in between is kept. Rows expiring while reaping are left for the next call.
+
+        :param int batch_size: Rows deleted per statement.
+        :param int max_batches: Stop after this many batches per table, None to delete every expired row.
+
+        :return: Number of rows deleted.
+        :rtype: int
+        """
+        if self.rate_statements is None:
+            self.rate_statements = self._rate_table()
+        deleted = self._reap(self.select_expired, self.delete_expired, datetime.utcnow(), batch_size, max_batches)
+        select_idle, delete_idle = self.rate_statements[3:]
+        return deleted + self._reap(select_idle, delete_idle, int(time.time() * 1000000), batch_size, max_batches)
+
+    def _reap(self, select, delete, now, batch_size, max_batches):
+        """Delete the rows `select` finds in batches with `delete`. Returns the number of rows deleted."""
+        deleted = batches = 0
+        select = select.limit(batch_size)
+        while max_batches is None or batches < max_batches:
+            with self.engine.begin() as connection:
+                keys = [r[0] for r in connection.execute(select, dict(now=now)).fetchall()]
+                if keys:
+                    deleted += connection.execute(delete, dict(b_keys=keys, now=now)).rowcount
+            batches += 1
+            if len(keys) < batch_size:
+                break
+        return deleted
+
+
+class _LockManagerDB(_LockManager):
+    """Handle locking/unlocking for SQLite/MySQL/PostgreSQL/etc backends, in a dedicated lock table."""
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        super(_LockManagerDB, self).__init__(celery_self, timeout, include_args, args, kwargs, plan)
+        self.lock_table = self.store
+
+    @classmethod
+    def backend_store(cls, backend):
+        """Return the lock table in the database of a Celery DatabaseBackend."""
+        return _LockTable.get(backend)
+
+    @classmethod
+    def open_store(cls, url):
+        """Return the lock table for a lock URL: an SQLAlchemy URL prefixed with db+, like Celery's result backend."""
+        return _LockTable.for_url(url[3:] if url.startswith('db+') else url)
+
+    @classmethod
+    def reap(cls, store, batch_size, max_batches=None):
+        """Delete expired locks and idle rate limits from the lock table's database, in batches."""
+        return store.reap(batch_size, max_batches)
+
+    def acquire(self):
+        """Try to acquire the lock once.
+
+        :raise OtherInstanceError: If another instance holds the lock.
+        """
+        owner, claim = (self.owner, None) if self.owner else (self.new_owner(), self.claim_token())
+        self.log.debug('Timeout %ds', self.timeout)
+        expires = None
+        if single_instance_reclaimed.receivers:  # Costs one query, only while monitored.
+            expires = self.lock_table.expiration([self.task_identifier]).get(self.task_identifier)
+        if not self.lock_table.acquire(self.task_identifier, owner, self.timeout, claim):
+            self.log.debug('Another instance is running.')
+            raise OtherInstanceError('Failed to acquire lock, {0} already running.'.format(self.task_identifier))
+        self.owner = owner
+        self.log.debug('Got lock, running.')
+        if expires and expires < datetime.utcnow():
+            self.log.debug('Reclaimed expired lock.')
+            self.send(single_instance_reclaimed)
+
+    def release(self):
+        """Release the lock if still owned.
+
+        :return: True if the lock was marked dirty by a coalesced duplicate.
+        :rtype: bool
+        """
+        dirty = self.lock_table.release(self.task_identifier, self.owner)
+        if dirty is None:
+            self.log.warning('Lock timed out before the task finished, another instance may have been running.')
+        self.owner = None
+        return bool(dirty)
+
+    def mark_dirty(self):
+        """Mark the lock dirty if it exists and has not timed out.
+
+        :return: False if there was no lock to mark.
+        :rtype: bool
+        """
+        return self.lock_table.mark_dirty(self.task_identifier)
+
+    @property
+    def is_already_running(self):
+        """Return True if lock exists and has not timed out."""
+        expires = self.lock_table.expiration([self.task_identifier]).get(self.task_identifier)
+        return bool(expires and expires > datetime.utcnow())
+
+    def current_owner(self):
+        """Return the owner token of the lock if it exists and has not timed out.
+
+        :rtype: str
+        """
+        return self.lock_table.owner(self.task_identifier)
+
+    def extend(self):
+        """Reset the lock's timeout if still owned.
+
+        :return: False if the lock was no longer owned (it expired and was taken over or removed).
+        :rtype: bool
+        """
+        return self.lock_table.extend(self.task_identifier, self.owner, self.timeout)
+
+    def remove(self):
+        """Delete the lock regardless of owner and timeout."""
+        self.lock_table.remove(self.task_identifier)
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the lock status of many task instances with one IN (...) query on the lock table.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (running, remaining seconds or None) tuple for each manager, in order.
+        :rtype: list
+        """
+        expiration = managers[0].lock_table.expiration(m.task_identifier for m in managers)
+        now = datetime.utcnow()
+        statuses = list()
+        for manager in managers:
+            expires = expiration.get(manager.task_identifier)
+            if expires and expires > now:
+                statuses.append((True, (expires - now).total_seconds()))
+            else:
+                statuses.append((False, None))
+        return statuses
+
+
+class _LockManagerFile(_LockManager):
+    """Handle locking/unlocking with lock files in a local directory, for deployments running all workers on one host.
+
+    Selected for any result backend when CELERY_SINGLE_INSTANCE_LOCK_DIR is set, or with a file:// lock URL. A lock is a
+    lease written in the task's lock file: owner token, expiration time and dirty mark. It is read and updated under an
+    exclusive fcntl.flock() of the file, held for the few microseconds of the update and never while the task runs, so
+    crashed workers' locks expire after the lock timeout like on other backends. Lock files are emptied, not deleted,
+    when released.
+    """
+
+    RECORD_SIZE = 256  # Lease records are padded to this size.
+    SAFE_NAME = re.compile(r'^[\w.-]{1,200}$')
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        if fcntl is None:
+            raise NotImplementedError('File locks require fcntl (POSIX).')
+        super(_LockManagerFile, self).__init__(celery_self, timeout, include_args, args, kwargs, plan)
+        name = self.task_identifier
+        if not self.SAFE_NAME.match(name):
+            name = _fingerprint(name)
+        self.path = os.path.join(self.store, name + '.lock')
+
+    @classmethod
+    def backend_store(cls, backend):
+        """Not supported, lock files are not kept in result backends."""
+        raise NotImplementedError('File locks require CELERY_SINGLE_INSTANCE_LOCK_DIR or a file:// lock URL.')
+
+    @classmethod
+    def open_store(cls, url):
+        """Return the lock directory of a file:// lock URL, created if it does not exist.
+
+        Absolute paths have three slashes (file:///var/lock/celery), relative ones two (file://locks).
+        """
+        directory = url[len('file://'):]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+
+    def update(self, func, shared=False, path=None):
+        """Read the lock file's lease under a file lock, passing it to func, and write back what func returns.
+
+        :param func: Called with the unexpired lease (owner, expires, dirty) or None. Returns the new lease (None to
+            free the lock) and its own return value as a tuple. The file is written only if the lease is another one.
+        :param bool shared: Only read the lease, with a shared file lock. func must return the lease it was given.
+        :param str path: Lock file to update instead of self.path.
+
+        :return: func's own return value.
+        """
+        fd = os.open(path or self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            data = os.read(fd, 4096)
+            lease = data.decode('utf-8').rstrip().rsplit(' ', 2)  # Owner tokens (task ids) may contain whitespace.
+            lease = (lease[0], float(lease[1]), lease[2] == '1') if len(lease) == 3 else None
+            if lease is not None and lease[1] < time.time():
+                lease = None  # Expired.
+            new_lease, value = func(lease)
+            if new_lease is lease:
+                return value
+            # Overwritten in place with a padded record, truncating files is much slower on some filesystems.
+            record = '' if new_lease is None else '{0} {1!r} {2}'.format(new_lease[0], new_lease[1], int(new_lease[2]))
+            record = record.ljust(self.RECORD_SIZE).encode('utf-8')
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, record)
+            if len(data) > len(record):
+                os.ftruncate(fd, len(record))
+            return value
+        finally:
+            os.close(fd)  # Also releases the file lock.
+
+    def acquire(self):
+        """Try to acquire the lock once.
+
+        :raise OtherInstanceError: If another instance holds the lock.
+        """
+        owner, claim = (self.owner, None) if self.owner else (self.new_owner(), self.claim_token())
+
+        def take(lease):
+            if lease is not None and (claim is None or lease[0] != claim):
+                return lease, lease[0]
+            dirty = lease is not None and lease[2]  # Adopting a claimed lock keeps its mark, a free one has none.
+            return (owner, time.time() + self.timeout, dirty), None
+
+        other_owner = self.update(take)
+        if other_owner is not None:
+            self.other_owner = other_owner
+            self.log.debug('Another instance is running.')
+            raise OtherInstanceError('Failed to acquire lock, {0} already running.'.format(self.task_identifier))
+        self.owner = owner
+        self.log.debug('Got lock, running.')
+
+    def release(self):
+        """Release the lock if still owned.
+
+        :return: True if the lock was marked dirty by a coalesced duplicate.
+        :rtype: bool
+        """
+        owner = self.owner
+        dirty = self.update(lambda lease: (None, lease[2]) if lease and lease[0] == owner else (lease, None))
+        if dirty is None:
+            self.log.warning('Lock timed out before the task finished, another instance may have been running.')
+        self.owner = None
+        return bool(dirty)
+
+    def mark_dirty(self):
+        """Mark the lock dirty if it exists and has not timed out.
+
+        :return: False if there was no lock to mark.
+        :rtype: bool
+        """
+        return self.update(lambda lease: (None, False) if lease is None else ((lease[0], lease[1], True), True))
+
+    def extend(self):
+        """Reset the lock's timeout if still owned.
+
+        :return: False if the lock was no longer owned (it expired and was taken over or removed).
+        :rtype: bool
+        """
+        owner, expires = self.owner, time.time() + self.timeout
+
+        def renew(lease):
+            if lease is None or lease[0] != owner:
+                return lease, False
+            return (owner, expires, lease[2]), True
+
+        return self.update(renew)
+
+    @property
+    def is_already_running(self):
+        """Return True if lock exists and has not timed out."""
+        return self.current_owner() is not None
+
+    def current_owner(self):
+        """Return the owner token of the lock if it exists and has not timed out.
+
+        :rtype: str
+        """
+        return self.update(lambda lease: (lease, lease and lease[0]), shared=True)
+
+    def remove(self):
+        """Delete the lock regardless of owner and timeout."""
+        self.update(lambda lease: (None, None))
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the lock status of many task instances, reading each lock file.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (running, remaining seconds or None) tuple for each manager, in order.
+        :rtype: list
+        """
+        statuses = list()
+        for manager in managers:
+            lease = manager.update(lambda lease: (lease, lease), shared=True)
+            statuses.append((False, None) if lease is None else (True, lease[1] - time.time()))
+        return statuses
+
+
+class _SemaphoreManager(object):
+    """Mixin turning a lock manager into a counting semaphore: up to plan.max_instances instances hold a slot each.
+
+    Slots expire after the lock timeout like locks, so a crashed worker's slot is reclaimed by the next instance.
+    Holders have no single owner token, so coalescing, joining and claiming when publishing are not supported. Slots
+    are not claimed locally, several instances may run in one worker process.
+    """
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        super(_SemaphoreManager, self).__init__(celery_self, timeout, include_args, args, kwargs, plan)
+        self.local_key = None
+        self.limit = self.plan.max_instances
+
+    def new_owner(self):
+        """Return a random token: every holder has its own, a redelivered message (same task id) needs another slot.
+
+        :rtype: str
+        """
+        return self.UNTRACKED_OWNER.format(uuid.uuid4().hex)
+
+    def rejected(self):
+        """Return the OtherInstanceError raised when all slots are taken."""
+        self.log.debug('All %d slots are taken.', self.limit)
+        return OtherInstanceError('Failed to acquire lock, {0} already running {1} times.'.format(
+            self.task_identifier, self.limit))
+
+    def current_owner(self):
+        """Return None, semaphores have no single owner."""
+        return None
+
+
+class _SemaphoreManagerRedis(_SemaphoreManager, _LockManagerRedis):
+    """Redis semaphore: a sorted set of owner tokens scored by their lease's expiration (server time in milliseconds).
+
+    Acquiring drops expired leases then adds one if fewer than max_instances remain, in one Lua script call. The sorted
+    set itself expires with its last lease.
+    """
+
+    # KEYS[1]: sorted set. ARGV[1]: owner token. ARGV[2]: timeout in milliseconds. ARGV[3]: max instances.
+    # Returns 1 if a slot was taken, else 0.
+    ACQUIRE_SCRIPT = """
+        redis.replicate_commands()
+        local time = redis.call('time')
+        local now = time[1] * 1000 + math.floor(time[2] / 1000)
+        redis.call('zremrangebyscore', KEYS[1], '-inf', now)
+        if redis.call('zcard', KEYS[1]) < tonumber(ARGV[3]) then
+            redis.call('zadd', KEYS[1], now + ARGV[2], ARGV[1])
+            if redis.call('pttl', KEYS[1]) < tonumber(ARGV[2]) then
+                redis.call('pexpire', KEYS[1], ARGV[2])
+            end
+            return 1
+        end
+        return 0
+    """
+
+    # KEYS[1]: sorted set. ARGV[1]: owner token. Returns 1 if the owner's lease had not expired, else 0.
+    RELEASE_SCRIPT = """
+        redis.replicate_commands()
+        local time = redis.call('time')
+        local expires = redis.call('zscore', KEYS[1], ARGV[1])
+        redis.call('zrem', KEYS[1], ARGV[1])
+        if expires and tonumber(expires) > time[1] * 1000 + math.floor(time[2] / 1000) then
+            return 1
+        end
+        return 0
+    """
+
+    # KEYS[1]: sorted set. ARGV[1]: owner token. ARGV[2]: timeout in milliseconds. Returns 1 if extended, else 0.
+    EXTEND_SCRIPT = """
+        redis.replicate_commands()
+        local time = redis.call('time')
+        local now = time[1] * 1000 + math.floor(time[2] / 1000)
+        local expires = redis.call('zscore', KEYS[1], ARGV[1])
+        if expires and tonumber(expires) > now then
+            redis.call('zadd', KEYS[1], now + ARGV[2], ARGV[1])
+            if redis.call('pttl', KEYS[1]) < tonumber(ARGV[2]) then
+                redis.call('pexpire', KEYS[1], ARGV[2])
+            end
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        super(_SemaphoreManagerRedis, self).__init__(celery_self, timeout, include_args, args, kwargs, plan)
+        self.redis_key += '.slots'  # Not the key of a plain lock, which has another type.
+
+    def acquire(self):
+        """Try to take a slot once.
+
+        :raise OtherInstanceError: If max_instances other instances hold a slot.
+        """
+        owner = self.owner or self.new_owner()
+        self.log.debug('Timeout %ds | Redis key %s', self.timeout, self.redis_key)
+        if self.scripts[0](keys=[self.redis_key], args=[owner, int(self.timeout * 1000), self.limit]) != 1:
+            raise self.rejected()
+        self.owner = owner
+        self.log.debug('Got slot, running.')
+
+    @property
+    def is_already_running(self):
+        """Return True if all slots are taken, by this host's clock."""
+        return self.store.zcount(self.redis_key, time.time() * 1000, '+inf') >= self.limit
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the semaphore status of many task instances with one pipelined round trip.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (all slots taken, seconds until the first slot expires or None) tuple for each manager, in order.
+        :rtype: list
+        """
+        now = time.time() * 1000
+        pipeline = managers[0].store.pipeline(transaction=False)
+        for manager in managers:
+            pipeline.zrangebyscore(manager.redis_key, now, '+inf', start=0, num=manager.limit, withscores=True)
+        statuses = list()
+        for manager, leases in zip(managers, pipeline.execute()):
+            if len(leases) < manager.limit:
+                statuses.append((False, None))
+            else:
+                statuses.append((True, (leases[0][1] - now) / 1000.0))
+        return statuses
+
+
+class _SemaphoreManagerDB(_SemaphoreManager, _LockManagerDB):
+    """Database semaphore: max_instances slot rows in the lock table, named after the task identifier.
+
+    Acquiring reads the slots' expiration with one query, then tries the free or expired slots in random order (one
+    statement each, usually one in all) so concurrent instances rarely compete for the same row.
+    """
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        super(_SemaphoreManagerDB, self).__init__(celery_self, timeout, include_args, args, kwargs, plan)
+        self.slots = ['{0}.slot.{1}'.format(self.task_identifier, i) for i in range(self.limit)]
+        self.slot = None  # Slot held.
+
+    def acquire(self):
+        """Try to take a slot once.
+
+        :raise OtherInstanceError: If max_instances other instances hold a slot.
+        """
+        owner = self.owner or self.new_owner()
+        self.log.debug('Timeout %ds', self.timeout)
+        expiration = self.lock_table.expiration(self.slots)
+        now = datetime.utcnow()
+        free = [s for s in self.slots if s not in expiration or expiration[s] < now]
+        random.shuffle(free)
+        for slot in free:
+            if self.lock_table.acquire(slot, owner, self.timeout):
+                self.owner, self.slot = owner, slot
+                self.log.debug('Got slot %s, running.', slot)
+                if slot in expiration:
+                    self.log.debug('Reclaimed expired slot.')
+                    self.send(single_instance_reclaimed)
+                return
+        raise self.rejected()
+
+    def release(self):
+        """Release the slot if still owned.
+
+        :return: False, semaphores are never marked dirty.
+        :rtype: bool
+        """
+        if self.lock_table.release(self.slot, self.owner) is None:
+            self.log.warning('Slot timed out before the task finished, another instance may have been running.')
+        self.owner = self.slot = None
+        return False
+
+    def extend(self):
+        """Reset the slot's timeout if still owned.
+
+        :return: False if the slot was no longer owned (it expired and was taken over or removed).
+        :rtype: bool
+        """
+        return self.lock_table.extend(self.slot, self.owner, self.timeout)
+
+    @property
+    def is_already_running(self):
+        """Return True if all slots are taken."""
+        now = datetime.utcnow()
+        return sum(e > now for e in self.lock_table.expiration(self.slots).values()) >= self.limit
+
+    def remove(self):
+        """Delete all slots regardless of owner and timeout."""
+        for slot in self.slots:
+            self.lock_table.remove(slot)
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the semaphore status of many task instances with one IN (...) query on the lock table.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (all slots taken, seconds until the first slot expires or None) tuple for each manager, in order.
+        :rtype: list
+        """
+        expiration = managers[0].lock_table.expiration(s for m in managers for s in m.slots)
+        now = datetime.utcnow()
+        statuses = list()
+        for manager in managers:
+            taken = sorted(e for e in (expiration.get(s) for s in manager.slots) if e and e > now)
+            statuses.append((True, (taken[0] - now).total_seconds()) if len(taken) >= manager.limit else (False, None))
+        return statuses
+
+
+class _SemaphoreManagerFile(_SemaphoreManager, _LockManagerFile):
+    """File semaphore: max_instances slot files, each holding one lease. self.path is the slot file held."""
+
+    def __init__(self, celery_self, timeout, include_args, args, kwargs, plan=None):
+        super(_SemaphoreManagerFile, self).__init__(celery_self, timeout, include_args, args, kwargs, plan)
+        prefix = self.path[:-len('.lock')]
+        self.paths = ['{0}.slot.{1}.lock'.format(prefix, i) for i in range(self.limit)]
+
+    def acquire(self):
+        """Try to take a slot once, trying the slot files starting at a random one.
+
+        :raise OtherInstanceError: If max_instances other instances hold a slot.
+        """
+        start = random.randrange(self.limit)
+        for path in self.paths[start:] + self.paths[:start]:
+            self.path = path
+            try:
+                return super(_SemaphoreManagerFile, self).acquire()
+            except OtherInstanceError:
+                continue
+        raise self.rejected()
+
+    def leases(self):
+        """Return the unexpired lease of each slot, None for free slots.
+
+        :rtype: list
+        """
+        return [self.update(lambda lease: (lease, lease), shared=True, path=p) for p in self.paths]
+
+    @property
+    def is_already_running(self):
+        """Return True if all slots are taken."""
+        return all(self.leases())
+
+    def remove(self):
+        """Delete all slots regardless of owner and timeout."""
+        for path in self.paths:
+            self.update(lambda lease: (None, None), path=path)
+
+    @classmethod
+    def bulk_status(cls, managers):
+        """Return the semaphore status of many task instances, reading each slot file.
+
+        :param list managers: Lock manager instances of this class, all using the same store.
+
+        :return: (all slots taken, seconds until the first slot expires or None) tuple for each manager, in order.
+        :rtype: list
+        """
+        statuses = list()
+        for manager in managers:
+            leases = manager.leases()
+            if all(leases):
+                statuses.append((True, min(lease[1] for lease in leases) - time.time()))
+            else:
+                statuses.append((False, None))
+        return statuses
+
+
+_SEMAPHORE_MANAGERS = {
+    _LockManagerRedis: _SemaphoreManagerRedis,
+    _LockManagerDB: _SemaphoreManagerDB,
+    _LockManagerFile: _SemaphoreManagerFile,
+}
+
+
+_LOCK_MANAGERS = dict(
+    RedisBackend=_LockManagerRedis, DatabaseBackend=_LockManagerDB,  # Celery result backend class names.
+    redis=_LockManagerRedis, rediss=_LockManagerRedis, db=_LockManagerDB, file=_LockManagerFile,  # Lock URL schemes.
+    quorum=_LockManagerRedisQuorum,
+)
+_LOCK_STORES = dict()  # Stores opened from lock URLs, by (process id, lock manager class, URL).
+
+
+def register_lock_manager(name, manager_class):
+    """Register a lock manager class for single_instance() tasks, replacing any previous one of the same name.
+
+    Lock managers subclass flask_celery._LockManager and implement acquire(), release(), mark_dirty(), extend(),
+    remove(), current_owner() and is_already_running against self.store, which open_store() returns for lock URLs and
+    backend_store() for result backends.
+
+    :param str name: Scheme of the CELERY_SINGLE_INSTANCE_LOCK_URL values it handles (the part before any '+' and
+        '://', e.g. 'etcd' for etcd://host:2379), or class name of the Celery result backend it keeps locks in when no
+        lock URL is set.
+    :param manager_class: Lock manager class.
+
+    :return: manager_class.
+    """
+    _LOCK_MANAGERS[name] = manager_class
+    return manager_class
 
-    pass
 
+def _select_manager(backend_name):
+    """Select the proper LockManager based on the current backend used by Celery.
 
-class _LockManager(object):
-    """Base class for other lock managers."""
+    :raise NotImplementedError: If Celery is using an unsupported backend.
+
+    :param str backend_name: Class name of the current Celery backend. Usually value of
+        current_app.extensions['celery'].celery.backend.__class__.__name__.
+
+    :return: Class definition object (not instance). One of the registered lock manager classes.
+    """
+    lock_manager = _LOCK_MANAGERS.get(backend_name)
+    if lock_manager is None:
+        raise NotImplementedError
+    return lock_manager
+
+
+def _select_store(celery_self, manager_class=None):
+    """Select the lock manager of a task and its store: the lock URL's if set, else the result backend's.
+
+    CELERY_SINGLE_INSTANCE_LOCK_DIR is short for a file:// lock URL.
+
+    :raise NotImplementedError: If no lock manager is registered for the lock URL's scheme or the result backend.
+
+    :param celery_self: Bound Celery task instance.
+    :param manager_class: Lock manager class to use instead of the registered one.
+
+    :return: Lock manager class and store tuple.
+    :rtype: tuple
+    """
+    conf = celery_self.app.conf
+    url = conf.get('CELERY_SINGLE_INSTANCE_LOCK_URL')
+    if not url and conf.get('CELERY_SINGLE_INSTANCE_LOCK_DIR'):
+        url = 'file://' + conf['CELERY_SINGLE_INSTANCE_LOCK_DIR']
+    if not url:
+        manager_class = manager_class or _select_manager(celery_self.backend.__class__.__name__)
+        return manager_class, manager_class.backend_store(celery_self.backend)
+    if manager_class is None:
+        scheme = url.split('://', 1)[0].split('+', 1)[0]
+        manager_class = _LOCK_MANAGERS.get(scheme)
+        if manager_class is None:
+            raise NotImplementedError('No lock manager registered for {0} URLs.'.format(scheme))
+    key = (os.getpid(), manager_class, url)  # Connection pools must not be shared with forked worker processes.
+    store = _LOCK_STORES.get(key)
+    if store is None:
+        store = _LOCK_STORES[key] = manager_class.open_store(url)
+    return manager_class, store
+
+
+def _lock_timeout(celery_self, lock_timeout=None):
+    """Resolve the lock timeout of a task, falling back to its time limits, then global limits, then 5 minutes.
+
+    :param celery_self: Bound Celery task instance.
+    :param int lock_timeout: Timeout given to single_instance(), if any.
+
+    :return: Lock timeout in seconds.
+    :rtype: int
+    """
+    return (
+        lock_timeout or celery_self.soft_time_limit or celery_self.time_limit
+        or celery_self.app.conf.get('CELERYD_TASK_SOFT_TIME_LIMIT')
+        or celery_self.app.conf.get('CELERYD_TASK_TIME_LIMIT')
+        or (60 * 5)
+    )
+
+
+class _Heartbeat(threading.Thread):
+    """Background thread extending a held lock's timeout at a fixed interval until stopped.
+
+    Stops on its own, logging a warning, if the lock was lost (e.g. the worker was paused longer than the timeout and
+    another worker took over) or if the lock backend fails.
+    """
 
-    def __init__(self, celery_self, timeout, include_args, args, kwargs):
+    def __init__(self, lock_manager, interval):
+        """Start the thread.
+
+        :param _LockManager lock_manager: Lock manager holding the lock.
+        :param float interval: Seconds between two extensions.
+        """
+        super(_Heartbeat, self).__init__(name='single_instance heartbeat {0}'.format(lock_manager.task_identifier))
+        self.daemon = True
+        self.lock_manager = lock_manager
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        """Extend the lock until stopped."""
+        log = self.lock_manager.log
+        while not self.stopped.wait(self.interval):
+            try:
+                if not self.lock_manager.extend():
+                    log.warning('Lost lock while running, another instance may be running.')
+                    return
+            except Exception as exc:
+                log.warning('Failed to extend lock, stopping heartbeat.')
+                self.lock_manager.send(single_instance_error, exception=exc)
+                raise
+            _LOCAL_LOCKS.extend(self.lock_manager.local_key, self.lock_manager.timeout)
+            log.debug('Extended lock.')
+
+    def stop(self):
+        """Stop extending the lock and wait for the thread to exit."""
+        self.stopped.set()
+        self.join()
+
+
+class _LockPlan(object):
+    """Locking settings of one single_instance() task, resolved once and shared by every invocation of the task.
+
+    Only the task identifier (which depends on the arguments) is computed per call. The global time limits are the only
+    part of the timeout fallback chain still read on every call, since they may be changed with app.conf.update().
+    """
+
+    def __init__(self, celery_self, lock_timeout=None, include_args=False, manager_class=None, key_func=None,
+                 heartbeat=None, wait=None, publish=None, coalesce=False, join=False, max_instances=1):
+        # pylint: disable=too-many-arguments
         """May raise NotImplementedError if the Celery backend is not supported.
 
-        :param celery_self: From wrapped() within single_instance(). It is the `self` object specified in a binded
-            Celery task definition (implicit first argument of the Celery task when @celery.task(bind=True) is used).
-        :param int timeout: Lock's timeout value in seconds.
+        :param celery_self: Bound Celery task instance.
+        :param int lock_timeout: Timeout given to single_instance(), if any.
         :param bool include_args: If single instance should take arguments into account.
-        :param iter args: The task instance's args.
-        :param dict kwargs: The task instance's kwargs.
+        :param manager_class: Lock manager class to use. Selected from the lock URL or result backend if not specified.
+        :param key_func: Called with the task's arguments, only its return value is fingerprinted. Implies include_args.
+        :param float heartbeat: Seconds between lock extensions while the task runs. Timeout defaults to 3 heartbeats.
+        :param float wait: Seconds to wait for the lock before giving up.
+        :param str publish: 'check' or 'claim' the lock before publishing the task, see single_instance().
+        :param bool coalesce: Duplicates mark the running instance's lock, which then runs the task once more.
+        :param bool join: Duplicates return the running instance's AsyncResult instead of raising OtherInstanceError.
+        :param int max_instances: Instances allowed to run at once. Above 1, a semaphore manager is selected.
         """
         self.celery_self = celery_self
-        self.timeout = timeout
-        self.include_args = include_args
-        self.args = args
-        self.kwargs = kwargs
-        self.log = getLogger('{0}:{1}'.format(self.__class__.__name__, self.task_identifier))
+        self.include_args = include_args or key_func is not None
+        self.key_func = key_func
+        self.heartbeat = heartbeat
+        self.wait = wait
+        self.publish = publish
+        self.coalesce = coalesce
+        self.join = join
+        self.max_instances = max_instances
+        self.manager_class, self.store = _select_store(celery_self, manager_class)
+        if max_instances > 1 and not issubclass(self.manager_class, _SemaphoreManager):
+            if self.manager_class not in _SEMAPHORE_MANAGERS:
+                raise NotImplementedError('{0} does not support max_instances.'.format(self.manager_class.__name__))
+            self.manager_class = _SEMAPHORE_MANAGERS[self.manager_class]
+        if heartbeat:
+            # The lock only has to outlive a few missed heartbeats, not the task.
+            self.static_timeout = lock_timeout or heartbeat * 3
+        else:
+            self.static_timeout = lock_timeout or celery_self.soft_time_limit or celery_self.time_limit
+        self.log = getLogger('{0}:{1}'.format(self.manager_class.__name__, celery_self.name))
+        self.cache = dict()  # Objects lock managers build once per task and reuse, e.g. registered Redis scripts.
 
     @property
-    def task_identifier(self):
-        """Return the unique identifier (string) of a task instance."""
-        task_id = self.celery_self.name
-        if self.include_args:
-            merged_args = str(self.args) + str([(k, self.kwargs[k]) for k in sorted(self.kwargs)])
-            task_id += '.args.{0}'.format(hashlib.md5(merged_args.encode('utf-8')).hexdigest())
-        return task_id
+    def timeout(self):
+        """Return the lock timeout in seconds."""
+        return self.static_timeout or _lock_timeout(self.celery_self)
 
+    def task_identifier(self, args, kwargs):
+        """Return the unique identifier (string) of a task instance.
 
-class _LockManagerRedis(_LockManager):
-    """Handle locking/unlocking for Redis backends."""
+        :param iter args: The task instance's args.
+        :param dict kwargs: The task instance's kwargs.
 
-    CELERY_LOCK = '_celery.single_instance.{task_id}'
+        :return: Task name, followed by the fingerprint of the arguments (or key_func's result) if include_args is set.
+        :rtype: str
+        """
+        if not self.include_args:
+            return self.celery_self.name
+        value = self.key_func(*args, **kwargs) if self.key_func else (args, kwargs)
+        return '{0}.args.{1}'.format(self.celery_self.name, _fingerprint(value))
 
-    def __init__(self, celery_self, timeout, include_args, args, kwargs):
-        super(_LockManagerRedis, self).__init__(celery_self, timeout, include_args, args, kwargs)
-        self.lock = None
+    def manager(self, args, kwargs):
+        """Instantiate the lock manager for one task invocation.
 
-    def __enter__(self):
-        redis_key = self.CELERY_LOCK.format(task_id=self.task_identifier)
-        self.lock = self.celery_self.backend.client.lock(redis_key, timeout=self.timeout)
-        self.log.debug('Timeout %ds | Redis key %s', self.timeout, redis_key)
-        if not self.lock.acquire(blocking=False):
-            self.log.debug('Another instance is running.')
-            raise OtherInstanceError('Failed to acquire lock, {0} already running.'.format(self.task_identifier))
-        else:
-            self.log.debug('Got lock, running.')
+        :param iter args: The task instance's args.
+        :param dict kwargs: The task instance's kwargs.
 
-    def __exit__(self, exc_type, *_):
-        if exc_type == OtherInstanceError:
-            # Failed to get lock last time, not releasing.
-            return
-        self.log.debug('Releasing lock.')
-        self.lock.release()
+        :return: Lock manager instance.
+        """
+        return self.manager_class(self.celery_self, self.timeout, self.include_args, args, kwargs, plan=self)
 
-    @property
-    def is_already_running(self):
-        """Return True if lock exists and has not timed out."""
-        redis_key = self.CELERY_LOCK.format(task_id=self.task_identifier)
-        return self.celery_self.backend.client.exists(redis_key)
+    def joined(self, lock_manager):
+        """Return the AsyncResult of the instance holding the lock a duplicate failed to get, if joining it.
 
-    def reset_lock(self):
-        """Removed the lock regardless of timeout."""
-        redis_key = self.CELERY_LOCK.format(task_id=self.task_identifier)
-        self.celery_self.backend.client.delete(redis_key)
+        :param _LockManager lock_manager: The duplicate's lock manager.
 
+        :return: None if not joining or the running instance can't be joined (it does not run as a Celery task).
+        """
+        task_id = self.join and lock_manager.running_task_id()
+        if not task_id:
+            return None
+        self.log.debug('Joining running instance %s.', task_id)
+        return self.celery_self.AsyncResult(task_id)
 
-class _LockManagerDB(_LockManager):
-    """Handle locking/unlocking for SQLite/MySQL/PostgreSQL/etc backends."""
+    def apply_async(self, apply_async, args=None, kwargs=None, task_id=None, **options):
+        """Publish the task unless another instance is running, checking or claiming its lock before publishing.
 
-    def __init__(self, celery_self, timeout, include_args, args, kwargs):
-        super(_LockManagerDB, self).__init__(celery_self, timeout, include_args, args, kwargs)
-        self.save_group = getattr(self.celery_self.backend, '_save_group')
-        self.restore_group = getattr(self.celery_self.backend, '_restore_group')
-        self.delete_group = getattr(self.celery_self.backend, '_delete_group')
+        With publish='claim' the lock is held on behalf of the new task id, which adopts it once it runs. If the message
+        is lost, the lock expires after the lock timeout. The running task publishing itself again with its own id
+        (retry(), rate_limit() rescheduling) is not checked: it holds the lock itself until it returns.
 
-    def __enter__(self):
-        self.log.debug('Timeout %ds', self.timeout)
+        :raise OtherInstanceError: If another instance is already running (or queued, with publish='claim'), unless it
+            is joined.
+
+        :param apply_async: The task class' original apply_async(), bound to the task.
+        :param iter args: The task instance's args.
+        :param dict kwargs: The task instance's kwargs.
+        :param str task_id: Task id to publish with, generated if not specified.
+        :param dict options: Other apply_async() options.
+
+        :return: AsyncResult of the published task, or of the running instance if joined.
+        """
+        if task_id is not None and task_id == getattr(getattr(self.celery_self, 'request', None), 'id', None):
+            return apply_async(args, kwargs, task_id=task_id, **options)
+        lock_manager = self.manager(args or (), kwargs or dict())
+        if self.publish == 'check':
+            if lock_manager.is_already_running:
+                joined = self.joined(lock_manager)
+                if joined is not None:
+                    return joined
+                raise OtherInstanceError('Not publishing, {0} already running.'.format(lock_manager.task_identifier))
+            return apply_async(args, kwargs, task_id=task_id, **options)
+        task_id = task_id or str(uuid.uuid4())
+        lock_manager.owner = lock_manager.CLAIMED_OWNER.format(task_id)  # Adopted by this task id only.
         try:
-            self.save_group(self.task_identifier, None)
-        except Exception as exc:  # pylint: disable=broad-except
-            if 'IntegrityError' not in str(exc) and 'ProgrammingError' not in str(exc):
-                raise
-            difference = datetime.utcnow() - self.restore_group(self.task_identifier)['date_done']
-            if difference < timedelta(seconds=self.timeout):
-                self.log.debug('Another instance is running.')
-                raise OtherInstanceError('Failed to acquire lock, {0} already running.'.format(self.task_identifier))
-            self.log.debug('Timeout expired, stale lock found, releasing lock.')
-            self.delete_group(self.task_identifier)
-            self.save_group(self.task_identifier, None)
-            self.log.debug('Got lock, running.')
+            lock_manager.acquire()
+        except OtherInstanceError:
+            joined = self.joined(lock_manager)
+            if joined is not None:
+                return joined
+            raise
+        try:
+            return apply_async(args, kwargs, task_id=task_id, **options)
+        except Exception:
+            lock_manager.release()
+            raise
 
-    def __exit__(self, exc_type, *_):
-        if exc_type == OtherInstanceError:
-            # Failed to get lock last time, not releasing.
-            return
-        self.log.debug('Releasing lock.')
-        self.delete_group(self.task_identifier)
+
+class _BatchBuffer(object):
+    """Items submitted to a batch task in this process, published as one message when full or after an interval."""
+
+    def __init__(self, task):
+        """Constructor.
+
+        :param task: Bound batch task instance.
+        """
+        self.task = task
+        self.mutex = threading.Lock()
+        self.items = list()
+        self.timer = None
+
+    def add(self, args, kwargs):
+        """Buffer one item, publishing the batch if it is full.
+
+        :param iter args: Item positional arguments.
+        :param dict kwargs: Item keyword arguments.
+
+        :return: AsyncResult of the item.
+        """
+        item_id = str(uuid.uuid4())
+        with self.mutex:
+            self.items.append((item_id, list(args), dict(kwargs)))
+            full = len(self.items) >= self.task.batch_size
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.task.batch_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+        return self.task.AsyncResult(item_id)
+
+    def flush(self):
+        """Publish buffered items now, if any.
+
+        :return: AsyncResult of the published batch, None if there was nothing to publish.
+        """
+        with self.mutex:
+            items, self.items = self.items, list()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not items:
+            return None
+        return self.task.apply_async((items, ))
+
+
+class _BatchTaskMixin(object):
+    """Methods of tasks created with Celery.batch_task()."""
+
+    batch_size = 100
+    batch_interval = 1.0
+    _batch_buffers = dict()  # (PID, id of the task instance): _BatchBuffer.
+    _batch_buffers_mutex = threading.Lock()
 
     @property
-    def is_already_running(self):
-        """Return True if lock exists and has not timed out."""
-        date_done = (self.restore_group(self.task_identifier) or dict()).get('date_done')
-        if not date_done:
-            return False
-        difference = datetime.utcnow() - date_done
-        return difference < timedelta(seconds=self.timeout)
+    def batch_buffer(self):
+        """Return this process' _BatchBuffer of the task."""
+        buffers = _BatchTaskMixin._batch_buffers
+        key = (os.getpid(), id(self))  # Forked processes start with an empty buffer.
+        if key not in buffers:
+            with _BatchTaskMixin._batch_buffers_mutex:
+                buffers.setdefault(key, _BatchBuffer(self))
+        return buffers[key]
 
-    def reset_lock(self):
-        """Removed the lock regardless of timeout."""
-        self.delete_group(self.task_identifier)
+    def submit(self, *args, **kwargs):
+        """Add one item to the next batch. Published when batch_size items are buffered or after batch_interval seconds.
 
+        :return: AsyncResult of the item, reporting its own result or exception.
+        """
+        return self.batch_buffer.add(args, kwargs)
 
-def _select_manager(backend_name):
-    """Select the proper LockManager based on the current backend used by Celery.
+    def flush(self):
+        """Publish buffered items now, e.g. before the process exits.
 
-    :raise NotImplementedError: If Celery is using an unsupported backend.
+        :return: AsyncResult of the published batch, None if there was nothing to publish.
+        """
+        return self.batch_buffer.flush()
 
-    :param str backend_name: Class name of the current Celery backend. Usually value of
-        current_app.extensions['celery'].celery.backend.__class__.__name__.
 
-    :return: Class definition object (not instance). One of the _LockManager* classes.
+class _CeleryConfig(Mapping):
+    """Read-only view of the Celery settings in a Flask config, without copying it.
+
+    Only Celery setting names (old and new style) and names starting with CELERY are visible, so unrelated Flask
+    settings never end up in Celery's configuration. Celery looks settings up in the view, so later changes to the Flask
+    config are seen by Celery unless overridden with celery.conf.update().
     """
-    if backend_name == 'RedisBackend':
-        lock_manager = _LockManagerRedis
-    elif backend_name == 'DatabaseBackend':
-        lock_manager = _LockManagerDB
-    else:
-        raise NotImplementedError
-    return lock_manager
+
+    SETTINGS = frozenset(SETTING_KEYS) | frozenset(_OLD_SETTING_KEYS)
+
+    def __init__(self, config):
+        """Constructor.
+
+        :param dict config: Flask application config.
+        """
+        self.config = config
+
+    def __getitem__(self, key):
+        if key not in self.SETTINGS and not key.startswith('CELERY'):
+            raise KeyError(key)
+        return self.config[key]
+
+    def __iter__(self):
+        return iter([k for k in self.config if k in self.SETTINGS or k.startswith('CELERY')])
+
+    def __len__(self):
+        return len(list(iter(self)))
 
 
 class _CeleryState(object):
@@ -163,22 +2171,51 @@ class _CeleryState(object):
         self.app = app
 
 
+class TaskProfile(object):
+    """cProfile profile and timings of one task execution, kept when the task is slower than CELERY_PROFILE_THRESHOLD.
+
+    Timings (seconds): app_context (pushing the Flask app context, 0 when reused), lock (acquiring single_instance()
+    locks) and body (the task and after_task() functions, without lock acquisition).
+    """
+
+    def __init__(self, task_name, task_id):
+        """Constructor.
+
+        :param str task_name: Celery task name.
+        :param str task_id: Celery task id, None when called directly.
+        """
+        self.task_name = task_name
+        self.task_id = task_id
+        self.duration = None
+        self.timings = dict(app_context=0.0, lock=0.0, body=0.0)
+        self.profiler = cProfile.Profile()
+
+    def dump(self, directory):
+        """Write the profile (pstats format) to a file named after the task name and id.
+
+        :param str directory: Directory to write to, created if missing.
+
+        :return: File path.
+        :rtype: str
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = '{0}.{1}.prof'.format(self.task_name, self.task_id or 'direct-{0}'.format(uuid.uuid4().hex[:8]))
+        path = os.path.join(directory, re.sub(r'[^\w.-]', '_', name))
+        self.profiler.dump_stats(path)
+        return path
+
+
 # noinspection PyProtectedMember
 class Celery(CeleryClass):
     """Celery extension for Flask applications.
 
-    Involves a hack to allow views and tests importing the celery instance from extensions.py to access the regular
-    Celery instance methods. This is done by subclassing celery.Celery and overwriting celery._state._register_app()
-    with a lambda/function that does nothing at all.
+    Subclasses celery.Celery so views and tests importing the celery instance from extensions.py can use the regular
+    Celery instance methods (e.g. the task decorator) before the Flask application is available.
 
-    That way, on the first super() in this class' __init__(), all of the required instance objects are initialized, but
-    the Celery application is not registered. This class will be initialized in extensions.py but at that moment the
-    Flask application is not yet available.
-
-    Then, once the Flask application is available, this class' init_app() method will be called, with the Flask
-    application as an argument. init_app() will again call celery.Celery.__init__() but this time with the
-    celery._state._register_app() restored to its original functionality. in init_app() the actual Celery application is
-    initialized like normal.
+    celery.Celery.__init__() runs once, when the extension is instantiated. Once the Flask application is available,
+    this class' init_app() method is called with it and configures the same instance in place: app name, broker and a
+    read-only view of the Celery settings in the Flask config. Celery reads its configuration lazily, on first use.
     """
 
     def __init__(self, app=None):
@@ -188,8 +2225,8 @@ class Celery(CeleryClass):
 
         :param app: Flask application instance.
         """
-        self.original_register_app = _state._register_app  # Backup Celery app registration function.
-        _state._register_app = lambda _: None  # Upon Celery app registration attempt, do nothing.
+        self.after_task_funcs = list()
+        self.slow_task_funcs = list()
         super(Celery, self).__init__()
         if app is not None:
             self.init_app(app)
@@ -197,35 +2234,222 @@ class Celery(CeleryClass):
     def init_app(self, app):
         """Actual method to read celery settings from app configuration and initialize the celery instance.
 
+        Tasks run in a Flask app context. With CELERY_APP_CONTEXT = 'task' (default) a new one is pushed and popped
+        around every task, running the app's teardown handlers each time. With 'worker', every worker thread (or
+        process, with the prefork pool) pushes one on its first task and keeps it for all later tasks, so flask.g is
+        shared between tasks and per-task cleanup must be registered with after_task(). Eager tasks, tasks called
+        directly and tasks of gevent and eventlet pools (a new greenlet per task) always get a new app context. Tasks
+        defined with async def run to completion in a new event loop.
+
+        Setting CELERY_PROFILE_THRESHOLD (seconds) profiles task executions with cProfile, or only a fraction of them
+        with CELERY_PROFILE_SAMPLE (default 1). Profiles of executions lasting at least the threshold are written to
+        CELERY_PROFILE_DIR if set and passed to on_slow_task() functions as TaskProfile instances.
+
+        :raise ValueError: If CELERY_APP_CONTEXT is not 'task' or 'worker'.
+
         :param app: Flask application instance.
         """
-        _state._register_app = self.original_register_app  # Restore Celery app registration function.
+        reuse_context = app.config.get('CELERY_APP_CONTEXT', 'task')
+        if reuse_context not in ('task', 'worker'):
+            raise ValueError("CELERY_APP_CONTEXT must be 'task' or 'worker', not {0!r}.".format(reuse_context))
+        reuse_context = reuse_context == 'worker'
         if not hasattr(app, 'extensions'):
             app.extensions = dict()
         if 'celery' in app.extensions:
             raise ValueError('Already registered extension CELERY.')
         app.extensions['celery'] = _CeleryState(self, app)
 
-        # Instantiate celery and read config.
-        super(Celery, self).__init__(app.import_name, broker=app.config['CELERY_BROKER_URL'])
+        # Configure celery, read lazily on first use of self.conf.
+        self.main = app.import_name
+        self._preconf['BROKER_URL'] = app.config['CELERY_BROKER_URL']  # Renamed by Celery 4+ if needed.
+        self.config_from_object(_CeleryConfig(app.config))
+        task_base = self.Task
+        after_task_funcs = self.after_task_funcs
+        worker_contexts = threading.local()
+        profile_threshold = app.config.get('CELERY_PROFILE_THRESHOLD')
+        profile_sample = app.config.get('CELERY_PROFILE_SAMPLE', 1)
+        profile_dir = app.config.get('CELERY_PROFILE_DIR')
+        slow_task_funcs = self.slow_task_funcs
+        profiles = threading.local()  # TaskProfile of the task running in this thread, if profiled.
 
-        # Set result backend default.
-        if 'CELERY_RESULT_BACKEND' in app.config:
-            self._preconf['CELERY_RESULT_BACKEND'] = app.config['CELERY_RESULT_BACKEND']
+        def run_task(task, args, kwargs):
+            """Run the task then the after_task() functions, with the task's exception or None.
 
-        self.conf.update(app.config)
-        task_base = self.Task
+            Tasks defined with async def are run to completion in an event loop, still in the app context.
+            """
+            exception = None
+            try:
+                result = task_base.__call__(task, *args, **kwargs)
+                if _iscoroutine(result):
+                    from flask_celery_asyncio import run_coroutine
+                    result = run_coroutine(result, app)
+                return result
+            except Exception as exc:
+                exception = exc
+                raise
+            finally:
+                for func in after_task_funcs:
+                    func(exception)
+
+        def call_task(task, args, kwargs, run=run_task):
+            """Run the task in a new app context, or the thread's one with CELERY_APP_CONTEXT = 'worker'."""
+            if not reuse_context or task.request.called_directly or task.request.is_eager or _green_threads():
+                with app.app_context():
+                    return run(task, args, kwargs)
+            if getattr(worker_contexts, 'context', None) is None:
+                worker_contexts.context = app.app_context()
+                worker_contexts.context.push()
+            return run(task, args, kwargs)
+
+        def profile_task(task, args, kwargs):
+            """Run the task under cProfile, keeping the profile if the task took at least CELERY_PROFILE_THRESHOLD."""
+            profile = TaskProfile(task.name, task.request.id)
+            try:
+                profile.profiler.enable()
+            except Exception:  # pylint: disable=broad-except
+                # E.g. ValueError on Python 3.12+ if another profiler is active: only one per interpreter.
+                getLogger('{0}:{1}'.format(__name__, task.name)).debug('Not profiled.', exc_info=True)
+                return call_task(task, args, kwargs)
+            profiles.current = profile
+            started = time.time()
+
+            def run(*run_args):
+                body_started = time.time()
+                profile.timings['app_context'] = body_started - started
+                try:
+                    return run_task(*run_args)
+                finally:
+                    profile.timings['body'] = time.time() - body_started - profile.timings['lock']
+
+            try:
+                return call_task(task, args, kwargs, run)
+            finally:
+                profile.profiler.disable()
+                profiles.current = None
+                profile.duration = time.time() - started
+                if profile.duration >= profile_threshold:
+                    log = getLogger('{0}:{1}'.format(__name__, task.name))
+                    log.info('Slow task %s: %.3fs (app context %.3fs, lock %.3fs, body %.3fs).', task.request.id,
+                             profile.duration, profile.timings['app_context'], profile.timings['lock'],
+                             profile.timings['body'])
+                    if profile_dir:
+                        profile.dump(profile_dir)
+                    for func in slow_task_funcs:
+                        func(profile)
+
+        def record_lock(latency, **_):
+            """Add single_instance() lock acquisition time to the profiled task's timings. Signal receiver."""
+            profile = getattr(profiles, 'current', None)
+            if profile is not None:
+                profile.timings['lock'] += latency
+
+        if profile_threshold is not None:
+            self.lock_receiver = record_lock  # Signals only keep weak references.
+            single_instance_acquired.connect(record_lock)
+            single_instance_rejected.connect(record_lock)
 
         # Add Flask app context to celery instance.
         class ContextTask(task_base):
             def __call__(self, *_args, **_kwargs):
-                with app.app_context():
-                    return task_base.__call__(self, *_args, **_kwargs)
+                if profile_threshold is not None and getattr(profiles, 'current', None) is None and (
+                        profile_sample >= 1 or random.random() < profile_sample):
+                    return profile_task(self, _args, _kwargs)  # Nested tasks are part of the outer profile.
+                return call_task(self, _args, _kwargs)
+
+            def apply_async(self, args=None, kwargs=None, task_id=None, **options):
+                lock_plan = getattr(self.run, 'lock_plan', None)
+                if not getattr(lock_plan, 'publish', None):  # Only build the plan (lock store) when publishing uses it.
+                    return task_base.apply_async(self, args, kwargs, task_id=task_id, **options)
+                return lock_plan(self).apply_async(partial(task_base.apply_async, self), args, kwargs, task_id,
+                                                   **options)
+
         setattr(ContextTask, 'abstract', True)
         setattr(self, 'Task', ContextTask)
 
+    def batch_task(self, size=100, interval=1.0, lock=None, **options):
+        """Decorator creating a task executing items in batches. Items are added with task.submit(*args, **kwargs).
+
+        Items are buffered in the submitting process and published as one message when `size` items are buffered or
+        `interval` seconds after the first one. The worker runs the whole batch as one task: one app context, at most
+        one single_instance() lock, and the decorated function called once per item. Each item's return value or
+        exception is stored in the result backend under the item's own id (the AsyncResult returned by submit()). If
+        the batch fails before running its items, e.g. another instance holds its lock, every item fails with it.
+
+        :param int size: Maximum items per batch.
+        :param float interval: Maximum seconds an item waits in the buffer.
+        :param lock: single_instance() keyword arguments (or True for defaults) to hold one lock for the whole batch.
+        :param dict options: Other Celery task options.
+
+        :return: Decorator.
+        """
+        def decorator(func):
+            batches = threading.local()  # Whether the batch running in this thread got to its items.
+
+            def store_failure(item_id, exc):
+                self.backend.store_result(item_id, exc, states.FAILURE,
+                                          traceback=''.join(traceback.format_exception(*sys.exc_info())))
+
+            def run_batch(items):
+                """Run every item of a batch, storing its result. Returns the number of items."""
+                batches.started = True
+                for item_id, args, kwargs in items:
+                    try:
+                        result = func(*args, **kwargs)
+                    except Exception as exc:  # pylint: disable=broad-except
+                        store_failure(item_id, exc)
+                    else:
+                        self.backend.store_result(item_id, result, states.SUCCESS)
+                return len(items)
+
+            if lock is not None:
+                locked = single_instance(**(dict() if lock is True else lock))(run_batch)
 
-def single_instance(func=None, lock_timeout=None, include_args=False):
+                @wraps(locked)
+                def run_batch(celery_self, items):
+                    """Run the batch under its lock. If it fails before running any item, each item fails with it."""
+                    batches.started = False
+                    try:
+                        return locked(celery_self, items)
+                    except Exception as exc:
+                        if not batches.started:  # E.g. OtherInstanceError, another instance holds the lock.
+                            for item_id, _, _ in items:
+                                store_failure(item_id, exc)
+                        raise
+                options['bind'] = True
+            base = type('BatchTask', (_BatchTaskMixin, options.pop('base', self.Task)), dict(abstract=True))
+            options.setdefault('name', gen_task_name(self, func.__name__, func.__module__))
+            options.setdefault('ignore_result', True)  # Items have their own results.
+            return self.task(base=base, batch_size=size, batch_interval=interval, **options)(run_batch)
+        return decorator
+
+    def after_task(self, func):
+        """Register a function to call after every task, in the task's app context. Usable as a decorator.
+
+        The function is called with the exception raised by the task, or None. Meant for per-task cleanup when app
+        contexts are reused (CELERY_APP_CONTEXT = 'worker'), e.g. db.session.remove().
+
+        :param func: Function to register.
+
+        :return: func.
+        """
+        self.after_task_funcs.append(func)
+        return func
+
+    def on_slow_task(self, func):
+        """Register a function to call with the TaskProfile of slow profiled tasks. Usable as a decorator.
+
+        Profiling is enabled with CELERY_PROFILE_THRESHOLD, see init_app().
+
+        :param func: Function to register.
+
+        :return: func.
+        """
+        self.slow_task_funcs.append(func)
+        return func
+
+
+def single_instance(func=None, lock_timeout=None, include_args=False, key_func=None, heartbeat=None, wait=None,
+                    publish=None, coalesce=False, join=False, max_instances=1):  # pylint: disable=too-many-arguments
     """Celery task decorator. Forces the task to have only one running instance at a time.
 
     Use with binded tasks (@celery.task(bind=True)).
@@ -237,33 +2461,411 @@ def single_instance(func=None, lock_timeout=None, include_args=False):
     Written by @Robpol86.
 
     :raise OtherInstanceError: If another instance is already running.
+    :raise ValueError: If max_instances is invalid or combined with an incompatible option.
 
     :param function func: The function to decorate, must be also decorated by @celery.task.
     :param int lock_timeout: Lock timeout in seconds plus five more seconds, in-case the task crashes and fails to
         release the lock. If not specified, the values of the task's soft/hard limits are used. If all else fails,
         timeout will be 5 minutes.
-    :param bool include_args: Include the md5 checksum of the arguments passed to the task in the Redis key. This allows
+    :param bool include_args: Include a fingerprint of the arguments passed to the task in the lock key. This allows
         the same task to run with different arguments, only stopping a task from running if another instance of it is
         running with the same arguments.
+    :param key_func: Only fingerprint the return value of this callable, called with the task's arguments. Implies
+        include_args. E.g. `lambda account_id, **_: account_id` to allow one instance per account.
+    :param float heartbeat: Extend the lock every `heartbeat` seconds from a background thread while the task runs, so
+        lock_timeout can be short and a crashed worker's lock expires quickly. Without lock_timeout, the timeout is
+        three heartbeats (task time limits are ignored).
+    :param float wait: Wait up to this many seconds for another instance to finish instead of failing right away,
+        polling the lock with jittered exponential backoff. Avoids a round trip through the broker for short overlaps.
+    :param str publish: Deduplicate when publishing with apply_async()/delay() (tasks of the Celery extension only), so
+        duplicates never reach the broker. 'check' raises OtherInstanceError if an instance is running. 'claim' also
+        takes the lock on behalf of the published task, so duplicates published before it starts are rejected too.
+    :param bool coalesce: Instead of raising OtherInstanceError, duplicates return None after marking the running
+        instance's lock. When the running instance finishes and its lock was marked, it publishes itself (same
+        arguments) exactly once more. N duplicates during a run become one follow-up run.
+    :param bool join: Instead of raising OtherInstanceError, duplicates return the AsyncResult of the running instance
+        (its Celery task id is the lock owner), so identical requests share one computation. With `publish`, duplicates
+        are joined when published and never reach the broker. Instances not running as Celery tasks (called directly)
+        have no result to join, their duplicates still raise.
+    :param int max_instances: Allow up to this many instances to run at once (per task, or per arguments with
+        include_args) instead of one, e.g. to use more workers without overloading a downstream system. Each instance
+        holds one of `max_instances` slots: a sorted set of leases on Redis, slot rows on databases, slot files with
+        file locks. Not compatible with coalesce, join and publish='claim'.
+
+    Coroutine functions (async def, Python 3.5+) are wrapped in a coroutine function locking with async with, so lock
+    I/O does not block the event loop: natively with redis.asyncio on Redis backends, in the loop's default executor on
+    other backends.
     """
+    if max_instances < 1:
+        raise ValueError('max_instances must be at least 1.')
+    if max_instances > 1 and (coalesce or join or publish == 'claim'):
+        raise ValueError("max_instances is not compatible with coalesce, join and publish='claim'.")
     if func is None:
-        return partial(single_instance, lock_timeout=lock_timeout, include_args=include_args)
+        return partial(single_instance, lock_timeout=lock_timeout, include_args=include_args, key_func=key_func,
+                       heartbeat=heartbeat, wait=wait, publish=publish, coalesce=coalesce, join=join,
+                       max_instances=max_instances)
+    cache = [None]
+
+    def lock_plan(celery_self):
+        """Return the task's _LockPlan, building it on first use (or if the task instance changed)."""
+        plan = cache[0]
+        if plan is None or plan.celery_self is not celery_self:
+            plan = cache[0] = _LockPlan(celery_self, lock_timeout, include_args, key_func=key_func,
+                                        heartbeat=heartbeat, wait=wait, publish=publish, coalesce=coalesce,
+                                        join=join, max_instances=max_instances)
+        return plan
+    lock_plan.publish = publish
+
+    if getattr(inspect, 'iscoroutinefunction', lambda _: False)(func):
+        from flask_celery_asyncio import single_instance_async
+        return single_instance_async(func, lock_plan)
 
     @wraps(func)
     def wrapped(celery_self, *args, **kwargs):
         """Wrapped Celery task, for single_instance()."""
-        # Select the manager and get timeout.
-        timeout = (
-            lock_timeout or celery_self.soft_time_limit or celery_self.time_limit
-            or celery_self.app.conf.get('CELERYD_TASK_SOFT_TIME_LIMIT')
-            or celery_self.app.conf.get('CELERYD_TASK_TIME_LIMIT')
-            or (60 * 5)
-        )
-        manager_class = _select_manager(celery_self.backend.__class__.__name__)
-        lock_manager = manager_class(celery_self, timeout, include_args, args, kwargs)
+        plan = lock_plan(celery_self)
+        lock_manager = plan.manager(args, kwargs)
 
         # Lock and execute.
-        with lock_manager:
-            ret_value = func(*args, **kwargs)
-        return ret_value
+        try:
+            with lock_manager:
+                if not plan.heartbeat:
+                    return func(*args, **kwargs)
+                heartbeat_thread = _Heartbeat(lock_manager, plan.heartbeat)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    heartbeat_thread.stop()
+        except OtherInstanceError:
+            if lock_manager.coalesced:
+                return None
+            joined = plan.joined(lock_manager)
+            if joined is None:
+                raise
+            return joined
+    wrapped.lock_plan = lock_plan
+    return wrapped
+
+
+def reap_expired_locks(celery_self, batch_size=1000, max_batches=None):
+    """Delete the expired locks of the lock store (e.g. database table) used by a task, in bounded batches.
+
+    Database locks are otherwise only deleted when their key is acquired again, so locks of crashed tasks pile up,
+    especially with include_args. Meant to be run as a periodic task: `celery.task(bind=True)(reap_expired_locks)`.
+
+    :raise NotImplementedError: If the task's result backend or lock URL has no lock manager.
+
+    :param celery_self: Bound Celery task instance, the lock store is selected like single_instance() does for it.
+    :param int batch_size: Locks deleted per statement (and transaction).
+    :param int max_batches: Stop after this many batches, None to delete every expired lock.
+
+    :return: Number of locks (and idle rate limits) deleted.
+    :rtype: int
+    """
+    manager_class, store = _select_store(celery_self)
+    deleted = manager_class.reap(store, batch_size, max_batches)
+    if deleted:
+        getLogger('{0}:{1}'.format(manager_class.__name__, celery_self.name)).info('Deleted %d expired locks.', deleted)
+    return deleted
+
+
+def single_instance_status(queries):
+    """Return the lock status of many single_instance() task instances at once, e.g. for a dashboard.
+
+    Locks are looked up with one round trip per store (a pipeline on Redis, one IN (...) query on databases) instead
+    of one per task instance.
+
+    :raise ValueError: If a task is not decorated with single_instance().
+
+    :param iter queries: (task, args, kwargs) tuples. Tasks are the registered task instances (e.g. celery.tasks[name]).
+
+    :return: (running, remaining seconds or None) tuple for each query, in order. Remaining seconds are None when the
+        task is not running.
+    :rtype: list
+    """
+    managers = list()
+    groups = dict()  # Managers grouped by (class, store), each group is answered in one round trip.
+    for task, args, kwargs in queries:
+        lock_plan = getattr(task.run, 'lock_plan', None)
+        if lock_plan is None:
+            raise ValueError('{0} is not a single_instance task.'.format(task.name))
+        manager = lock_plan(task).manager(args, kwargs)
+        managers.append(manager)
+        groups.setdefault((manager.__class__, id(manager.store)), list()).append(manager)
+    statuses = dict()
+    for group in groups.values():
+        statuses.update(zip(map(id, group), group[0].bulk_status(group)))
+    return [statuses[id(m)] for m in managers]
+
+
+class _RateLimiterRedis(object):
+    """GCRA rate limiter on Redis: each key holds its theoretical arrival time (TAT), checked and pushed by one script.
+
+    Time is read from the Redis server, so worker clocks don't have to agree. Keys are the task's lock key suffixed with
+    .rate, and expire once their TAT is past.
+    """
+
+    # KEYS[1]: TAT key. ARGV[1]: interval in milliseconds. ARGV[2]: burst.
+    # Returns 0 if the request conforms and was counted, else the milliseconds until it would (as a string).
+    THROTTLE_SCRIPT = """
+        redis.replicate_commands()
+        local time = redis.call('time')
+        local now = time[1] * 1000 + time[2] / 1000
+        local interval = tonumber(ARGV[1])
+        local tat = math.max(tonumber(redis.call('get', KEYS[1]) or 0), now)
+        local wait = tat - now - interval * (tonumber(ARGV[2]) - 1)
+        if wait > 0 then
+            return tostring(wait)
+        end
+        redis.call('set', KEYS[1], tostring(tat + interval), 'PX', math.ceil(tat + interval - now))
+        return 0
+    """
+
+    def __init__(self, plan, interval, burst):
+        """Constructor.
+
+        :param _LockPlan plan: Plan of the rate limited task, providing its store and key scheme.
+        :param float interval: Seconds between requests at the sustained rate.
+        :param int burst: Requests allowed at once after an idle period.
+        """
+        self.plan = plan
+        self.interval = interval
+        self.burst = burst
+        self.script = plan.store.register_script(self.THROTTLE_SCRIPT)
+        self.key_function = _LockManagerRedis.key_function(plan)
+
+    def throttle(self, identifier):
+        """Count one request if it conforms to the rate limit, in one round trip.
+
+        :param str identifier: Task identifier (task name, with an arguments fingerprint if include_args).
+
+        :return: 0 if the request conforms and was counted, else seconds until it would conform.
+        :rtype: float
+        """
+        key = self.key_function(task_id=identifier) + '.rate'
+        return float(self.script(keys=[key], args=[self.interval * 1000, self.burst])) / 1000.0
+
+
+class _RateLimiterDB(object):
+    """GCRA rate limiter in a database table next to the lock table, see _LockTable.throttle()."""
+
+    def __init__(self, plan, interval, burst):
+        """Constructor.
+
+        :param _LockPlan plan: Plan of the rate limited task, providing its store and key scheme.
+        :param float interval: Seconds between requests at the sustained rate.
+        :param int burst: Requests allowed at once after an idle period.
+        """
+        self.plan = plan
+        self.interval = interval
+        self.burst = burst
+
+    def throttle(self, identifier):
+        """Count one request if it conforms to the rate limit.
+
+        :param str identifier: Task identifier (task name, with an arguments fingerprint if include_args).
+
+        :return: 0 if the request conforms and was counted, else seconds until it would conform.
+        :rtype: float
+        """
+        return self.plan.store.throttle(identifier, self.interval, self.burst)
+
+
+_RATE_LIMITERS = {_LockManagerRedisQuorum: None, _LockManagerRedis: _RateLimiterRedis, _LockManagerDB: _RateLimiterDB}
+
+
+def rate_limit(func=None, rate=None, burst=1, include_args=False, key_func=None, delay=0):
+    # pylint: disable=too-many-arguments
+    """Celery task decorator. Limits how often the task runs across all workers, unlike Celery's per-worker rate_limit.
+
+    Use with binded tasks (@celery.task(bind=True)), like single_instance(). Limits are kept in the same store as
+    single_instance() locks (the lock URL's or the result backend's, Redis or database) under the same task identifier.
+    The limit is a generic cell rate algorithm (GCRA): `burst` runs may start at once, then one per 1/rate seconds.
+
+    A throttled task is never rejected. It sleeps if it may run within `delay` seconds, otherwise it is published again
+    with a countdown to the moment it may run (same task id and options, its retries count is unchanged) and the
+    current run ends in the RETRY state. Tasks called directly or eagerly always sleep.
+
+    :raise ValueError: If the rate is invalid.
+
+    :param function func: The function to decorate, must be also decorated by @celery.task.
+    :param rate: Runs per second as a number, or a Celery rate string: '10/s', '100/m' or '1000/h'.
+    :param int burst: Runs allowed at once after an idle period.
+    :param bool include_args: Limit each set of arguments separately, see single_instance().
+    :param key_func: Only fingerprint the return value of this callable, see single_instance().
+    :param float delay: Seconds the task may sleep waiting for its turn before it is rescheduled instead.
+    """
+    if func is None:
+        return partial(rate_limit, rate=rate, burst=burst, include_args=include_args, key_func=key_func, delay=delay)
+    per_second = parse_rate(rate)
+    if not per_second or per_second <= 0 or burst < 1:
+        raise ValueError('rate_limit() needs a positive rate and burst.')
+    cache = [None]
+
+    def limiter(celery_self):
+        """Return the task's rate limiter, building it on first use (or if the task instance changed)."""
+        instance = cache[0]
+        if instance is None or instance.plan.celery_self is not celery_self:
+            plan = _LockPlan(celery_self, include_args=include_args, key_func=key_func)
+            limiter_class = next((_RATE_LIMITERS[c] for c in plan.manager_class.__mro__ if c in _RATE_LIMITERS), None)
+            if limiter_class is None:
+                raise NotImplementedError('{0} has no rate limiter.'.format(plan.manager_class.__name__))
+            instance = cache[0] = limiter_class(plan, 1.0 / per_second, burst)
+        return instance
+
+    @wraps(func)
+    def wrapped(celery_self, *args, **kwargs):
+        """Wrapped Celery task, for rate_limit()."""
+        instance = limiter(celery_self)
+        identifier = instance.plan.task_identifier(args, kwargs)
+        request = getattr(celery_self, 'request', None)
+        in_worker = not getattr(request, 'called_directly', True) and not getattr(request, 'is_eager', False)
+        deadline = time.time() + delay
+        while True:
+            wait = instance.throttle(identifier)
+            if not wait:
+                return func(*args, **kwargs)
+            if in_worker and time.time() + wait > deadline:
+                instance.plan.log.debug('Throttled, running again in %.3fs.', wait)
+                from_request = getattr(celery_self, 'signature_from_request', None)
+                if from_request is None:  # Celery < 4.
+                    from_request = celery_self.subtask_from_request
+                signature = from_request(countdown=wait)
+                signature.apply_async()
+                retry = Retry(when=wait)
+                retry.sig = signature  # Not a Retry() argument before Celery 4.
+                raise retry
+            instance.plan.log.debug('Throttled, waiting %.3fs.', wait)
+            time.sleep(wait)
+    wrapped.rate_limiter = limiter
     return wrapped
+
+
+class LockStats(object):
+    """In-memory collector of the single_instance_* signals, broken down by task name, with text exporters.
+
+    Usage (e.g. in each worker process):
+        stats = LockStats().connect()
+        ...
+        text = stats.prometheus()  # Serve on a /metrics endpoint, or:
+        lines = stats.statsd()  # Send to a statsd daemon periodically.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)  # Histogram upper bounds in seconds.
+    COUNTERS = (  # Metric name, signal, help.
+        ('acquired', single_instance_acquired, 'Locks acquired.'),
+        ('rejected', single_instance_rejected, 'Invocations rejected because another instance held the lock.'),
+        ('reclaimed', single_instance_reclaimed, 'Expired database locks taken over.'),
+        ('errors', single_instance_error, 'Lock backend errors.'),
+    )
+    HISTOGRAMS = (  # Metric name, signal, signal argument, help.
+        ('acquire_latency_seconds', single_instance_acquired, 'latency', 'Time spent acquiring locks.'),
+        ('hold_seconds', single_instance_released, 'held', 'Time locks were held.'),
+    )
+
+    def __init__(self):
+        """Constructor."""
+        self.mutex = threading.Lock()
+        self.counters = dict()  # Metric name: {task name: count}.
+        self.histograms = dict()  # Metric name: {task name: [count per bucket..., count, sum]}.
+        self.receivers = list()
+
+    def connect(self):
+        """Start collecting. Nothing is measured while no receiver is connected to a signal.
+
+        :return: self.
+        :rtype: LockStats
+        """
+        for name, signal, _ in self.COUNTERS:
+            self.receivers.append((signal, partial(self.increment, name)))
+        for name, signal, argument, _ in self.HISTOGRAMS:
+            self.receivers.append((signal, partial(self.observe, name, argument)))
+        for signal, receiver in self.receivers:
+            signal.connect(receiver, weak=False)
+        return self
+
+    def disconnect(self):
+        """Stop collecting."""
+        for signal, receiver in self.receivers:
+            signal.disconnect(receiver)
+        self.receivers = list()
+
+    def increment(self, name, sender, **_):
+        """Count a signal. Signal receiver.
+
+        :param str name: Metric name.
+        :param sender: Task sending the signal.
+        """
+        with self.mutex:
+            per_task = self.counters.setdefault(name, dict())
+            per_task[sender.name] = per_task.get(sender.name, 0) + 1
+
+    def observe(self, name, argument, sender, **named):
+        """Record a duration in a histogram. Signal receiver.
+
+        :param str name: Metric name.
+        :param str argument: Signal argument holding the duration.
+        :param sender: Task sending the signal.
+        :param dict named: Signal arguments.
+        """
+        value = named[argument]
+        with self.mutex:
+            histogram = self.histograms.setdefault(name, dict()).get(sender.name)
+            if histogram is None:
+                histogram = self.histograms[name][sender.name] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def prometheus(self, prefix='single_instance'):
+        """Export in the Prometheus text exposition format.
+
+        :param str prefix: Metric name prefix.
+
+        :rtype: str
+        """
+        def label(task_name):
+            return task_name.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        lines = list()
+        with self.mutex:
+            for name, _, description in self.COUNTERS:
+                metric = '{0}_{1}_total'.format(prefix, name)
+                lines.extend(['# HELP {0} {1}'.format(metric, description), '# TYPE {0} counter'.format(metric)])
+                for task_name, count in sorted(self.counters.get(name, dict()).items()):
+                    lines.append('{0}{{task="{1}"}} {2}'.format(metric, label(task_name), count))
+            for name, _, _, description in self.HISTOGRAMS:
+                metric = '{0}_{1}'.format(prefix, name)
+                lines.extend(['# HELP {0} {1}'.format(metric, description), '# TYPE {0} histogram'.format(metric)])
+                for task_name, histogram in sorted(self.histograms.get(name, dict()).items()):
+                    task_label = label(task_name)
+                    for bound, count in zip(self.BUCKETS, histogram):
+                        lines.append('{0}_bucket{{task="{1}",le="{2}"}} {3}'.format(metric, task_label, bound, count))
+                    lines.append('{0}_bucket{{task="{1}",le="+Inf"}} {2}'.format(metric, task_label, histogram[-2]))
+                    lines.append('{0}_sum{{task="{1}"}} {2!r}'.format(metric, task_label, histogram[-1]))
+                    lines.append('{0}_count{{task="{1}"}} {2}'.format(metric, task_label, histogram[-2]))
+        return '\n'.join(lines) + '\n'
+
+    def statsd(self, prefix='single_instance'):
+        """Export as statsd gauges, one line per metric and task. Histograms are exported as their count and mean.
+
+        :param str prefix: Metric name prefix.
+
+        :rtype: list
+        """
+        def bucket(*parts):
+            return '.'.join(p.replace(':', '_').replace('|', '_') for p in parts)
+
+        lines = list()
+        with self.mutex:
+            for name, per_task in sorted(self.counters.items()):
+                for task_name, count in sorted(per_task.items()):
+                    lines.append('{0}:{1}|g'.format(bucket(prefix, task_name, name), count))
+            for name, per_task in sorted(self.histograms.items()):
+                for task_name, histogram in sorted(per_task.items()):
+                    lines.append('{0}:{1}|g'.format(bucket(prefix, task_name, name, 'count'), histogram[-2]))
+                    mean = histogram[-1] / histogram[-2]
+                    lines.append('{0}:{1:.6f}|g'.format(bucket(prefix, task_name, name, 'mean'), mean))
+        return lines
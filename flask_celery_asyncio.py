@@ -0,0 +1,330 @@
+"""asyncio support for single_instance(), used automatically when decorating tasks defined with async def.
+
+Python 3.5+ only, kept out of flask_celery so that module still imports on Python 2. Not meant to be imported directly.
+"""
+
+import asyncio
+import inspect
+import weakref
+from functools import partial, wraps
+
+from flask_celery import _LOCAL_LOCKS, _LockManagerRedis, OtherInstanceError, single_instance_error
+
+
+class _AsyncLockManager(object):
+    """Asynchronous counterpart of a lock manager, for async with.
+
+    The wrapped synchronous lock manager keeps the lock's state (owner, coalesced, etc.), decides what to do (its
+    enter_steps() and exit_steps()) and provides the backend I/O, which runs in the event loop's default executor so it
+    never blocks the loop. Subclasses replace the I/O with native asyncio clients.
+    """
+
+    def __init__(self, lock_manager):
+        """Constructor.
+
+        :param _LockManager lock_manager: Synchronous lock manager of the task invocation.
+        """
+        self.lock_manager = lock_manager
+        self.plan = lock_manager.plan
+        self.log = lock_manager.log
+
+    @staticmethod
+    def run_in_executor(func, *args):
+        """Run a blocking call in the event loop's default executor.
+
+        :param func: Callable.
+        :param iter args: Positional arguments.
+
+        :return: Awaitable of func's return value.
+        """
+        return asyncio.get_event_loop().run_in_executor(None, partial(func, *args))
+
+    async def __aenter__(self):
+        """Acquire the lock, see _LockManager.enter_steps().
+
+        :raise OtherInstanceError: If another instance holds the lock (past the deadline).
+        """
+        await self.run_steps(self.lock_manager.enter_steps())
+
+    async def __aexit__(self, exc_type, *_):
+        if exc_type == OtherInstanceError:
+            # Failed to get lock last time, not releasing.
+            return
+        await self.run_steps(self.lock_manager.exit_steps())
+
+    async def run_steps(self, steps):
+        """Run the lock I/O of the synchronous lock manager's enter_steps() or exit_steps(), awaiting it.
+
+        :param steps: Generator yielding the name of a method of this class to await or seconds to sleep. See
+            _LockManager.run_steps().
+        """
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration:
+                return
+            try:
+                result, error = await (getattr(self, step)() if isinstance(step, str) else asyncio.sleep(step)), None
+            except Exception as exc:  # pylint: disable=broad-except
+                result, error = None, exc  # Raised in the generator, which handles it or raises it again.
+
+    def acquire(self):
+        """Try to acquire the lock once in the lock backend. See _LockManager.acquire()."""
+        return self.run_in_executor(self.lock_manager.acquire)
+
+    def release(self):
+        """Release the lock in the lock backend if still owned. See _LockManager.release()."""
+        return self.run_in_executor(self.lock_manager.release)
+
+    def mark_dirty(self):
+        """Mark the lock dirty if it exists, for coalescing. See _LockManager.mark_dirty()."""
+        return self.run_in_executor(self.lock_manager.mark_dirty)
+
+    def extend(self):
+        """Reset the lock's timeout if still owned. See _LockManager.extend()."""
+        return self.run_in_executor(self.lock_manager.extend)
+
+    def follow_up(self):
+        """Publish the task again with the same arguments. See _LockManager.follow_up()."""
+        return self.run_in_executor(self.lock_manager.follow_up)
+
+    def joined(self):
+        """Return the AsyncResult of the running instance to join, if any. See _LockPlan.joined()."""
+        return self.run_in_executor(self.plan.joined, self.lock_manager)
+
+
+async def _closing(client):
+    """Yield a redis.asyncio client once, closing it when finalized.
+
+    Event loops finalize the asynchronous generators they started when they shut down (asyncio.run() does), while the
+    loop still runs, so a client kept for a loop is closed with it instead of leaking its connections.
+
+    :param client: redis.asyncio client.
+    """
+    try:
+        yield client
+    finally:
+        close = getattr(client, 'aclose', None) or client.close  # redis-py < 5.0.1 only has close().
+        await close()
+
+
+class _AsyncLockManagerRedis(_AsyncLockManager):
+    """Redis lock I/O with the redis.asyncio client (redis-py 4.2+), running the same Lua scripts as _LockManagerRedis.
+
+    Connections belong to the event loop that opened them, so one client (and its registered scripts) is kept per loop
+    and per task.
+    """
+
+    # Connection options holding objects that only work with synchronous connections (retry policy, callbacks, etc.).
+    SYNC_OPTIONS = frozenset(['retry', 'redis_connect_func', 'event_dispatcher', 'himport_registry',
+                              'maint_notifications_config', 'maint_notifications_pool_handler'])
+
+    @classmethod
+    def new_client(cls, client):
+        """Return a new redis.asyncio client with the connection options of the lock manager's Redis client.
+
+        The asyncio counterpart of the client's connection class (TCP, TLS or Unix socket) gets the options of the
+        client's connection pool it supports (address, credentials, TLS settings, timeouts, keepalive, etc.), with the
+        same connection limit.
+
+        :param client: Synchronous redis-py client, the lock manager's store.
+        """
+        import redis.asyncio
+        pool = client.connection_pool
+        connection_class = getattr(redis.asyncio.connection, pool.connection_class.__name__, None)
+        if connection_class is None:
+            connection_class = redis.asyncio.connection.Connection
+        supported = set()
+        for klass in connection_class.__mro__:
+            if '__init__' in vars(klass):
+                supported.update(inspect.signature(klass.__init__).parameters)
+        options = dict((k, v) for k, v in pool.connection_kwargs.items()
+                       if k in supported and k not in cls.SYNC_OPTIONS)
+        async_pool = redis.asyncio.ConnectionPool(connection_class=connection_class,
+                                                  max_connections=pool.max_connections, **options)
+        return redis.asyncio.Redis(connection_pool=async_pool)
+
+    async def scripts(self):
+        """Return this event loop's client's registered (acquire, release, extend, mark) scripts.
+
+        The client is created on first use in the loop and closed when the loop shuts down, see _closing().
+        """
+        clients = self.plan.cache.get('async_scripts')
+        if clients is None:
+            clients = self.plan.cache['async_scripts'] = weakref.WeakKeyDictionary()
+        loop = asyncio.get_event_loop()
+        entry = clients.get(loop)
+        if entry is None:
+            client = self.new_client(self.lock_manager.store)
+            closing = _closing(client)
+            await closing.__anext__()
+            sources = (_LockManagerRedis.ACQUIRE_SCRIPT, _LockManagerRedis.RELEASE_SCRIPT,
+                       _LockManagerRedis.EXTEND_SCRIPT, _LockManagerRedis.MARK_SCRIPT)
+            entry = clients[loop] = (closing, tuple(client.register_script(s) for s in sources))
+        return entry[1]
+
+    async def run_script(self, index, args=()):
+        """Run one of the scripts (see scripts()) on the lock's keys.
+
+        :param int index: Index of the script in scripts().
+        :param iter args: Script arguments.
+
+        :return: Script's return value.
+        """
+        scripts = await self.scripts()
+        return await scripts[index](keys=[self.lock_manager.redis_key, self.lock_manager.dirty_key], args=args)
+
+    async def acquire(self):
+        """Try to acquire the lock once.
+
+        :raise OtherInstanceError: If another instance holds the lock.
+        """
+        manager = self.lock_manager
+        owner, claim = (manager.owner, None) if manager.owner else (manager.new_owner(), manager.claim_token())
+        result = await self.run_script(0, [owner, int(manager.timeout * 1000), claim or ''])
+        if result != 1:
+            manager.other_owner = result.decode('utf-8')
+            self.log.debug('Another instance is running.')
+            raise OtherInstanceError('Failed to acquire lock, {0} already running.'.format(manager.task_identifier))
+        manager.owner = owner
+        self.log.debug('Got lock, running.')
+
+    async def release(self):
+        """Release the lock if still owned.
+
+        :return: True if the lock was marked dirty by a coalesced duplicate.
+        :rtype: bool
+        """
+        manager = self.lock_manager
+        released = await self.run_script(1, [manager.owner])
+        if not released:
+            self.log.warning('Lock timed out before the task finished, another instance may have been running.')
+        manager.owner = None
+        return released == 2
+
+    async def mark_dirty(self):
+        """Mark the lock dirty if it exists.
+
+        :return: False if there was no lock to mark.
+        :rtype: bool
+        """
+        return bool(await self.run_script(3))
+
+    async def extend(self):
+        """Reset the lock's timeout if still owned.
+
+        :return: False if the lock was no longer owned.
+        :rtype: bool
+        """
+        manager = self.lock_manager
+        return bool(await self.run_script(2, [manager.owner, int(manager.timeout * 1000)]))
+
+    async def joined(self):
+        """Return the AsyncResult of the running instance to join, if any, without blocking when its owner is known."""
+        if self.lock_manager.other_owner or not self.plan.join:
+            return self.plan.joined(self.lock_manager)
+        return await super(_AsyncLockManagerRedis, self).joined()
+
+
+_ASYNC_MANAGERS = {_LockManagerRedis: _AsyncLockManagerRedis}  # Others run their blocking I/O in the executor.
+
+
+def _async_manager(lock_manager):
+    """Return the asynchronous counterpart of a lock manager.
+
+    :param _LockManager lock_manager: Synchronous lock manager of the task invocation.
+    """
+    if lock_manager.store.__class__.__name__ == 'RedisCluster':
+        return _AsyncLockManager(lock_manager)  # Cluster clients have no connection pool to derive a client from.
+    return _ASYNC_MANAGERS.get(lock_manager.__class__, _AsyncLockManager)(lock_manager)
+
+
+async def _heartbeat(lock_manager, interval):
+    """Extend a held lock's timeout at a fixed interval until cancelled. The asyncio counterpart of _Heartbeat.
+
+    :param _AsyncLockManager lock_manager: Lock manager holding the lock.
+    :param float interval: Seconds between two extensions.
+    """
+    log = lock_manager.log
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            if not await lock_manager.extend():
+                log.warning('Lost lock while running, another instance may be running.')
+                return
+        except Exception as exc:
+            log.warning('Failed to extend lock, stopping heartbeat.')
+            lock_manager.lock_manager.send(single_instance_error, exception=exc)
+            raise
+        _LOCAL_LOCKS.extend(lock_manager.lock_manager.local_key, lock_manager.lock_manager.timeout)
+        log.debug('Extended lock.')
+
+
+async def _in_app_context(coroutine, app):
+    """Await a coroutine in a new app context.
+
+    :param coroutine: Coroutine of the task's body.
+    :param app: Flask application instance.
+    """
+    with app.app_context():
+        return await coroutine
+
+
+def run_coroutine(coroutine, app):
+    """Run the coroutine returned by an async def task to completion in a new event loop, the way Celery runs tasks.
+
+    The loop is shut down afterwards (asynchronous generators finalized, so Redis clients kept for it are closed). If
+    an event loop already runs in this thread (the task was called directly from a coroutine), a coroutine awaiting
+    the task in its own app context is returned for the caller to await instead.
+
+    :param coroutine: Coroutine of the task's body.
+    :param app: Flask application instance.
+
+    :return: The coroutine's return value.
+    """
+    if getattr(asyncio, '_get_running_loop', lambda: None)() is not None:  # Python 3.5.3+, None if no loop runs.
+        return _in_app_context(coroutine, app)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+
+def single_instance_async(func, lock_plan):
+    """Wrap a coroutine function the way single_instance() wraps regular task functions.
+
+    :param func: The task's coroutine function.
+    :param lock_plan: Returns the task's _LockPlan, given the bound task instance.
+
+    :return: Coroutine function.
+    """
+    @wraps(func)
+    async def wrapped(celery_self, *args, **kwargs):
+        """Wrapped Celery task, for single_instance()."""
+        plan = lock_plan(celery_self)
+        lock_manager = _async_manager(plan.manager(args, kwargs))
+
+        # Lock and execute.
+        try:
+            async with lock_manager:
+                if not plan.heartbeat:
+                    return await func(*args, **kwargs)
+                heartbeat = asyncio.ensure_future(_heartbeat(lock_manager, plan.heartbeat))
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    heartbeat.cancel()
+        except OtherInstanceError:
+            if lock_manager.lock_manager.coalesced:
+                return None
+            joined = await lock_manager.joined()
+            if joined is None:
+                raise
+            return joined
+    wrapped.lock_plan = lock_plan
+    return wrapped
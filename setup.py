@@ -101,7 +101,7 @@ if __name__ == '__main__':
         license=LICENSE,
         long_description=readme(),
         name=NAME,
-        py_modules=[IMPORT],
+        py_modules=[IMPORT, IMPORT + '_asyncio'],
         url='https://github.com/Robpol86/' + NAME,
         version=VERSION,
         zip_safe=False,
@@ -6,6 +6,7 @@ import time
 import pytest
 from celery.signals import worker_ready
 
+from tests.fakes import RedisBackend, sqlite_backend
 from tests.instances import app, celery
 
 WORKER_READY = list()
@@ -40,3 +41,11 @@ def celery_worker():
         if WORKER_READY:
             break
         time.sleep(1)
+
+
+@pytest.fixture(params=['redis', 'db'])
+def backend(request, tmpdir):
+    """Return each lock backend: the Redis stand-in and a SQLite database."""
+    if request.param == 'redis':
+        return RedisBackend()
+    return sqlite_backend(str(tmpdir))
@@ -0,0 +1,324 @@
+"""In-process stand-ins for Redis and Celery task objects, used by benchmarks and backend-independent tests."""
+
+import os
+import threading
+import time
+
+from celery import Celery as CeleryClass
+from celery.backends.database import DatabaseBackend
+
+from flask_celery import _LockManagerRedis, _RateLimiterRedis, _SemaphoreManagerRedis
+
+
+def to_bytes(value):
+    """Convert a Redis argument to bytes, like redis-py does before sending it."""
+    return value if hasattr(value, 'decode') else str(value).encode('utf-8')
+
+
+class FakePipeline(object):
+    """Buffer commands and run them in one "round trip" on execute()."""
+
+    def __init__(self, redis):
+        """Constructor.
+
+        :param FakeRedis redis: Client to run commands on.
+        """
+        self.redis = redis
+        self.queue = list()
+
+    def __getattr__(self, name):
+        """Queue a command instead of running it."""
+        def queue(*args, **kwargs):
+            self.queue.append((name, args, kwargs))
+            return self
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.queue = list()
+
+    def execute(self):
+        """Run queued commands atomically.
+
+        :return: Return value of each command.
+        :rtype: list
+        """
+        with self.redis.mutex:
+            self.redis.round_trips += 1
+            queue, self.queue = self.queue, list()
+            return [getattr(self.redis, '_' + n)(*a, **k) for n, a, k in queue]
+
+
+class FakeScript(object):
+    """Mimic redis.client.Script, dispatching to a Python emulation registered in FakeRedis.SCRIPTS."""
+
+    def __init__(self, redis, source):
+        """Constructor.
+
+        :param FakeRedis redis: Client the script was registered with.
+        :param str source: Lua source code.
+        """
+        self.redis = redis
+        self.source = source
+        self.emulation = FakeRedis.SCRIPTS[source]
+
+    def __call__(self, keys=(), args=(), client=None):
+        """Run the script atomically in one round trip.
+
+        :param iter keys: KEYS table.
+        :param iter args: ARGV table.
+        :param client: Unused, accepted for redis-py compatibility.
+        """
+        with self.redis.mutex:
+            self.redis.round_trips += 1
+            return self.emulation(self.redis, list(keys), list(args))
+
+
+class FakeRedis(object):
+    """Minimal thread-safe in-process Redis with key expiration.
+
+    Every public command counts as one round trip in `round_trips`, so tests and benchmarks can tell how chatty a lock
+    manager is. Lua scripts are not interpreted; a Python emulation must be registered in SCRIPTS under the script's
+    source.
+    """
+
+    SCRIPTS = dict()
+
+    def __init__(self):
+        """Constructor."""
+        self.mutex = threading.RLock()
+        self.data = dict()  # Key: (value, expires_at or None).
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        """Public command: count a round trip and run the private implementation under the mutex."""
+        if name.startswith('_'):
+            raise AttributeError(name)
+        command = getattr(self, '_' + name)
+
+        def run(*args, **kwargs):
+            with self.mutex:
+                self.round_trips += 1
+                return command(*args, **kwargs)
+        return run
+
+    def _alive(self, name):
+        """Return the (value, expires_at) tuple of an unexpired key or None."""
+        item = self.data.get(name)
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            del self.data[name]
+            item = None
+        return item
+
+    def _get(self, name):
+        item = self._alive(name)
+        return None if item is None else item[0]
+
+    def _mget(self, names):
+        return [self._get(n) for n in names]
+
+    def _set(self, name, value, ex=None, px=None, nx=False, xx=False):
+        exists = self._alive(name) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        expires_at = time.time() + (ex if ex else (px / 1000.0 if px else 0)) if (ex or px) else None
+        self.data[name] = (to_bytes(value), expires_at)
+        return True
+
+    def _delete(self, *names):
+        return sum(1 for n in names if self._alive(n) is not None and self.data.pop(n))
+
+    def _exists(self, *names):
+        return sum(1 for n in names if self._alive(n) is not None)
+
+    def _pexpire(self, name, milliseconds):
+        item = self._alive(name)
+        if item is None:
+            return False
+        self.data[name] = (item[0], time.time() + milliseconds / 1000.0)
+        return True
+
+    def _pttl(self, name):
+        item = self._alive(name)
+        if item is None:
+            return -2
+        if item[1] is None:
+            return -1
+        return int((item[1] - time.time()) * 1000)
+
+    def _zset(self, name):
+        """Return the {member: score} dict of a sorted set, empty if it does not exist."""
+        item = self._alive(name)
+        return dict() if item is None else item[0]
+
+    def _zrangebyscore(self, name, minimum, maximum, start=None, num=None, withscores=False):
+        minimum, maximum = float(minimum), float(maximum)
+        items = sorted((s, m) for m, s in self._zset(name).items() if minimum <= s <= maximum)
+        items = items[start or 0:(start or 0) + num if num is not None else None]
+        return [(m, s) if withscores else m for s, m in items]
+
+    def _zcount(self, name, minimum, maximum):
+        return len(self._zrangebyscore(name, minimum, maximum))
+
+    def _flushdb(self):
+        self.data.clear()
+        return True
+
+    def pipeline(self, transaction=True):  # pylint: disable=unused-argument
+        """Return a FakePipeline."""
+        return FakePipeline(self)
+
+    def register_script(self, source):
+        """Return a FakeScript for `source`. Raises KeyError if the script has no emulation."""
+        return FakeScript(self, source)
+
+
+class RedisBackend(object):
+    """Stand-in for celery.backends.redis.RedisBackend, same class name so _select_manager() picks it up."""
+
+    def __init__(self, client=None):
+        """Constructor.
+
+        :param FakeRedis client: Redis client, a new FakeRedis if not specified.
+        """
+        self.client = client or FakeRedis()
+
+
+def sqlite_backend(directory):
+    """Return a real Celery DatabaseBackend storing results in a SQLite file.
+
+    :param str directory: Directory for the database file.
+    """
+    url = 'sqlite:///' + os.path.join(directory, 'results.sqlite')
+    return DatabaseBackend(url=url, app=CeleryClass(set_as_current=False))
+
+
+class FakeTask(object):
+    """Stand-in for a bound Celery task instance (the `self` of @celery.task(bind=True))."""
+
+    def __init__(self, name, backend, conf=None, soft_time_limit=None, time_limit=None, run=None):
+        """Constructor.
+
+        :param str name: Task name.
+        :param backend: Celery result backend (or stand-in).
+        :param dict conf: Celery configuration.
+        :param int soft_time_limit: Task soft time limit.
+        :param int time_limit: Task hard time limit.
+        :param run: Task body, usually decorated with single_instance().
+        """
+        self.name = name
+        self.run = run
+        self.request = type('FakeRequest', (object, ), dict(id=None))()
+        self.backend = backend
+        self.app = type('FakeApp', (object,), dict(conf=dict(conf or dict())))()
+        self.soft_time_limit = soft_time_limit
+        self.time_limit = time_limit
+
+
+def emulate(source):
+    """Register the decorated function as the Python emulation of a Lua script.
+
+    :param str source: Lua source code, as registered by the lock manager.
+    """
+    def decorator(func):
+        FakeRedis.SCRIPTS[source] = func
+        return func
+    return decorator
+
+
+@emulate(_LockManagerRedis.ACQUIRE_SCRIPT)
+def redis_acquire(redis, keys, args):
+    """Emulate _LockManagerRedis.ACQUIRE_SCRIPT."""
+    if redis._set(keys[0], args[0], px=int(args[1]), nx=True):
+        return 1
+    owner = redis._get(keys[0])
+    if args[2] != '' and owner == to_bytes(args[2]):
+        redis._set(keys[0], args[0], px=int(args[1]))
+        redis._pexpire(keys[1], int(args[1]))
+        return 1
+    return owner
+
+
+@emulate(_LockManagerRedis.RELEASE_SCRIPT)
+def redis_release(redis, keys, args):
+    """Emulate _LockManagerRedis.RELEASE_SCRIPT."""
+    if redis._get(keys[0]) == to_bytes(args[0]):
+        redis._delete(keys[0])
+        return 1 + redis._delete(keys[1])
+    return 0
+
+
+@emulate(_LockManagerRedis.MARK_SCRIPT)
+def redis_mark(redis, keys, _):
+    """Emulate _LockManagerRedis.MARK_SCRIPT."""
+    ttl = redis._pttl(keys[0])
+    if ttl > 0:
+        redis._set(keys[1], 1, px=ttl)
+        return 1
+    return 0
+
+
+@emulate(_LockManagerRedis.EXTEND_SCRIPT)
+def redis_extend(redis, keys, args):
+    """Emulate _LockManagerRedis.EXTEND_SCRIPT."""
+    if redis._get(keys[0]) == to_bytes(args[0]):
+        redis._pexpire(keys[1], int(args[1]))
+        return int(redis._pexpire(keys[0], int(args[1])))
+    return 0
+
+
+def now_ms():
+    """Return the current time in milliseconds, like the TIME command read by scripts."""
+    return int(time.time() * 1000)
+
+
+def redis_zadd(redis, name, zset, member, score, timeout):
+    """Store a sorted set with a member's score set, extending the set's expiration to at least `timeout` ms."""
+    zset[member] = score
+    item = redis._alive(name)
+    redis.data[name] = (zset, item and item[1])
+    if redis._pttl(name) < timeout:
+        redis._pexpire(name, timeout)
+
+
+@emulate(_SemaphoreManagerRedis.ACQUIRE_SCRIPT)
+def redis_semaphore_acquire(redis, keys, args):
+    """Emulate _SemaphoreManagerRedis.ACQUIRE_SCRIPT."""
+    now, owner, timeout = now_ms(), to_bytes(args[0]), int(args[1])
+    zset = dict((m, s) for m, s in redis._zset(keys[0]).items() if s > now)
+    if len(zset) < int(args[2]):
+        redis_zadd(redis, keys[0], zset, owner, now + timeout, timeout)
+        return 1
+    return 0
+
+
+@emulate(_SemaphoreManagerRedis.RELEASE_SCRIPT)
+def redis_semaphore_release(redis, keys, args):
+    """Emulate _SemaphoreManagerRedis.RELEASE_SCRIPT."""
+    expires = redis._zset(keys[0]).pop(to_bytes(args[0]), None)
+    return int(expires is not None and expires > now_ms())
+
+
+@emulate(_SemaphoreManagerRedis.EXTEND_SCRIPT)
+def redis_semaphore_extend(redis, keys, args):
+    """Emulate _SemaphoreManagerRedis.EXTEND_SCRIPT."""
+    now, owner, timeout = now_ms(), to_bytes(args[0]), int(args[1])
+    zset = redis._zset(keys[0])
+    if zset.get(owner, 0) > now:
+        redis_zadd(redis, keys[0], zset, owner, now + timeout, timeout)
+        return 1
+    return 0
+
+
+@emulate(_RateLimiterRedis.THROTTLE_SCRIPT)
+def redis_throttle(redis, keys, args):
+    """Emulate _RateLimiterRedis.THROTTLE_SCRIPT."""
+    now, interval = time.time() * 1000, float(args[0])
+    tat = max(float(redis._get(keys[0]) or 0), now)
+    wait = tat - now - interval * (int(args[1]) - 1)
+    if wait > 0:
+        return repr(wait).encode('ascii')
+    redis._set(keys[0], repr(tat + interval), px=int(tat + interval - now) + 1)
+    return 0
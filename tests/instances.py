@@ -67,6 +67,7 @@ def generate_context(config):
     if 'SQLALCHEMY_DATABASE_URI' in flask_app.config:
         db = SQLAlchemy(flask_app)
         db.engine.execute('DROP TABLE IF EXISTS celery_tasksetmeta;')
+        db.engine.execute('DROP TABLE IF EXISTS celery_single_instance_lock;')
     elif 'REDIS_URL' in flask_app.config:
         redis = Redis(flask_app)
         redis.flushdb()
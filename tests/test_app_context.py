@@ -0,0 +1,109 @@
+"""Test the Flask app context tasks run in."""
+
+import sys
+import threading
+
+import pytest
+from flask import Flask, g
+
+import flask_celery
+from flask_celery import Celery
+
+
+def make_celery(mode=None):
+    """Return a Celery extension with a counting teardown handler and a task returning its flask.g counter.
+
+    :param str mode: CELERY_APP_CONTEXT setting, default if None.
+    """
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    if mode is not None:
+        flask_app.config['CELERY_APP_CONTEXT'] = mode
+    flask_app.teardowns = list()
+    flask_app.teardown_appcontext(flask_app.teardowns.append)
+    celery = Celery(flask_app)
+
+    @celery.task
+    def count(fail=False):
+        g.count = getattr(g, 'count', 0) + 1
+        if fail:
+            raise ValueError('Failed.')
+        return g.count
+
+    return flask_app, celery, count
+
+
+def in_worker(task, *args, **kwargs):
+    """Call a task the way a worker does, with a request pushed.
+
+    :param task: Task to call.
+    :param iter args: Task positional arguments.
+    :param dict kwargs: Task keyword arguments.
+    """
+    task.push_request(called_directly=False)
+    try:
+        return task(*args, **kwargs)
+    finally:
+        task.pop_request()
+
+
+def in_thread(func):
+    """Run func in a new thread, like a worker thread, so its app context does not leak into other tests.
+
+    :param func: Callable.
+
+    :return: func's return value.
+    """
+    results = list()
+    thread = threading.Thread(target=lambda: results.append(func()))
+    thread.start()
+    thread.join()
+    return results[0]
+
+
+def test_per_task():
+    """Test the default: a new app context for every task."""
+    flask_app, _, count = make_celery()
+    assert [1, 1, 1] == [in_worker(count) for _ in range(3)]
+    assert 3 == len(flask_app.teardowns)
+
+
+def test_per_worker():
+    """Test that worker threads keep one app context and only run after_task() functions per task."""
+    flask_app, celery, count = make_celery('worker')
+    cleanups = list()
+    assert celery.after_task(cleanups.append) == cleanups.append
+
+    def worker():
+        counts = [in_worker(count) for _ in range(3)]
+        with pytest.raises(ValueError):
+            in_worker(count, fail=True)
+        return counts + [in_worker(count)]
+
+    assert [1, 2, 3, 5] == in_thread(worker)
+    assert [] == flask_app.teardowns
+    assert [None, None, None, ValueError, None] == [c and c.__class__ for c in cleanups]
+
+    # Other threads get their own.
+    assert 1 == in_thread(lambda: in_worker(count))
+
+    # Direct and eager calls don't leave an app context behind.
+    assert 1 == count()
+    assert 1 == count.apply().get()
+    assert 2 == len(flask_app.teardowns)
+
+
+def test_green_threads(monkeypatch):
+    """Test that worker app contexts are not kept on gevent/eventlet pools, where every task runs in a new greenlet."""
+    monkeypatch.setattr(flask_celery, '_GREEN_THREADS', list())
+    monkeypatch.setitem(sys.modules, 'gevent.monkey', type('Monkey', (object, ), dict(
+        is_module_patched=staticmethod(lambda name: name == 'threading'))))
+    flask_app, _, count = make_celery('worker')
+    assert [1, 1] == in_thread(lambda: [in_worker(count) for _ in range(2)])
+    assert 2 == len(flask_app.teardowns)
+
+
+def test_invalid():
+    """Test that unknown modes are rejected."""
+    with pytest.raises(ValueError):
+        make_celery('request')
@@ -0,0 +1,227 @@
+"""Test single_instance() on coroutine functions."""
+
+import asyncio
+
+import pytest
+from flask import current_app, Flask
+
+from flask_celery import Celery, OtherInstanceError, single_instance
+from flask_celery_asyncio import _async_manager, _AsyncLockManager, _AsyncLockManagerRedis
+from tests.fakes import FakeTask, RedisBackend
+
+
+class AsyncFakeScript(object):
+    """Mimic redis.commands.core.AsyncScript on top of a FakeScript."""
+
+    def __init__(self, script):
+        """Constructor.
+
+        :param tests.fakes.FakeScript script: Synchronous script.
+        """
+        self.script = script
+
+    async def __call__(self, keys=(), args=()):
+        """Run the script, yielding to the event loop first like a real round trip."""
+        await asyncio.sleep(0)
+        return self.script(keys=keys, args=args)
+
+
+class AsyncFakeRedis(object):
+    """Mimic a redis.asyncio client sharing a FakeRedis' data."""
+
+    def __init__(self, redis):
+        """Constructor.
+
+        :param tests.fakes.FakeRedis redis: Synchronous client.
+        """
+        self.redis = redis
+        self.closed = False
+
+    def register_script(self, source):
+        """Return an AsyncFakeScript for `source`."""
+        return AsyncFakeScript(self.redis.register_script(source))
+
+    async def aclose(self):
+        """Close the client."""
+        self.closed = True
+
+
+@pytest.fixture
+def backend(backend, monkeypatch):
+    """Return each lock backend, with redis.asyncio clients sharing the Redis stand-in's data."""
+    if backend.__class__ is RedisBackend:
+        monkeypatch.setattr(_AsyncLockManagerRedis, 'new_client', staticmethod(AsyncFakeRedis))
+    return backend
+
+
+def test_detected(backend):
+    """Test that coroutine functions get a coroutine function wrapper using the matching async lock manager."""
+    async def double(x):
+        return x * 2
+
+    task = FakeTask('tests.fake.double', backend, run=single_instance(double))
+    assert asyncio.iscoroutinefunction(task.run)
+    assert 'double' == task.run.__name__
+    assert 8 == asyncio.run(task.run(task, 4))
+    assert 8 == asyncio.run(task.run(task, 4))  # New loop, new client.
+    assert not task.run.lock_plan(task).manager((4, ), dict()).is_already_running
+
+    manager = _async_manager(task.run.lock_plan(task).manager((4, ), dict()))
+    assert manager.__class__ is (_AsyncLockManagerRedis if backend.__class__ is RedisBackend else _AsyncLockManager)
+
+
+def test_collision(backend):
+    """Test that a duplicate is rejected while the first instance awaits, and that the loop is not blocked."""
+    started = list()
+
+    async def body():
+        started.append(True)
+        await asyncio.sleep(0.2)
+        return 'done'
+
+    task = FakeTask('tests.fake.body', backend, run=single_instance(body))
+
+    async def main():
+        first = asyncio.ensure_future(task.run(task))
+        while not started:
+            await asyncio.sleep(0.01)
+        with pytest.raises(OtherInstanceError):
+            await task.run(task)
+        return await first
+
+    assert 'done' == asyncio.run(main())
+
+
+def test_concurrent_other_work(backend):
+    """Test that other coroutines make progress while tasks lock and unlock."""
+    async def noop(x):
+        return x
+
+    task = FakeTask('tests.fake.noop', backend, run=single_instance(include_args=True)(noop))
+    ticks = list()
+
+    async def ticker():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0)
+
+    async def main():
+        tick = asyncio.ensure_future(ticker())
+        results = await asyncio.gather(*[task.run(task, i) for i in range(10)])
+        tick.cancel()
+        return results
+
+    assert list(range(10)) == asyncio.run(main())
+    assert ticks
+
+
+def test_heartbeat(backend):
+    """Test that the lock is extended past its timeout while the coroutine runs."""
+    async def body():
+        await asyncio.sleep(0.5)
+
+    task = FakeTask('tests.fake.body', backend, run=single_instance(heartbeat=0.1)(body))
+    plan = task.run.lock_plan(task)
+
+    async def main():
+        first = asyncio.ensure_future(task.run(task))
+        await asyncio.sleep(0.4)  # Past the 0.3 second timeout.
+        loop = asyncio.get_event_loop()
+        running = await loop.run_in_executor(None, lambda: plan.manager((), dict()).is_already_running)
+        await first
+        return running
+
+    assert asyncio.run(main()) is True
+    assert not plan.manager((), dict()).is_already_running
+
+
+def test_coalesce_wait(backend):
+    """Test that a waiting duplicate stops waiting once coalesced, so it runs only as the follow-up."""
+    runs = list()
+
+    async def body():
+        runs.append(None)
+        await asyncio.sleep(0.3)
+        return 'done'
+
+    task = FakeTask('tests.fake.body', backend, run=single_instance(coalesce=True, wait=5)(body))
+    task.published = list()
+    task.apply_async = lambda args=None, kwargs=None, **_: task.published.append((args, kwargs))
+
+    async def main():
+        first = asyncio.ensure_future(task.run(task))
+        while not runs:
+            await asyncio.sleep(0.01)
+        assert await task.run(task) is None
+        return await first
+
+    assert 'done' == asyncio.run(main())
+    assert 1 == len(runs)
+    assert [((), dict())] == task.published
+
+
+def test_client_closed(monkeypatch):
+    """Test that the redis.asyncio client kept for an event loop is closed when the loop shuts down."""
+    clients = list()
+    monkeypatch.setattr(_AsyncLockManagerRedis, 'new_client',
+                        staticmethod(lambda client: clients.append(AsyncFakeRedis(client)) or clients[-1]))
+
+    async def double(x):
+        return x * 2
+
+    task = FakeTask('tests.fake.double', RedisBackend(), run=single_instance(double))
+
+    async def main():
+        result = await task.run(task, 4) + await task.run(task, 4)
+        return result, [c.closed for c in clients]
+
+    assert (16, [False]) == asyncio.run(main())  # One client per loop, open while the loop runs.
+    assert 8 == asyncio.run(task.run(task, 4))
+    assert [True, True] == [c.closed for c in clients]
+
+
+@pytest.mark.parametrize('url,connection_class', [
+    ('rediss://:secret@redis.example:6380/2?socket_timeout=3&ssl_cert_reqs=none', 'SSLConnection'),
+    ('redis://redis.example:6379/1?socket_connect_timeout=2&max_connections=7', 'Connection'),
+    ('unix:///var/run/redis.sock?db=3', 'UnixDomainSocketConnection'),
+])
+def test_new_client(url, connection_class):
+    """Test that redis.asyncio clients keep the connection class and options of the synchronous client."""
+    redis = pytest.importorskip('redis')
+    pytest.importorskip('redis.asyncio')
+    client = redis.Redis.from_url(url)
+    async_client = _AsyncLockManagerRedis.new_client(client)
+    pool = async_client.connection_pool
+    assert connection_class == pool.connection_class.__name__
+    assert pool.connection_class.__module__.startswith('redis.asyncio')
+    assert pool.max_connections == client.connection_pool.max_connections
+    expected = client.connection_pool.connection_kwargs
+    for name in ('host', 'port', 'db', 'password', 'path', 'socket_timeout', 'socket_connect_timeout', 'ssl_cert_reqs'):
+        assert expected.get(name) == pool.connection_kwargs.get(name)
+
+
+def test_extension(tmpdir):
+    """Test that async def tasks of the extension run to completion in the app context, locked, when executed."""
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_SINGLE_INSTANCE_LOCK_DIR'] = str(tmpdir.join('locks'))
+    celery = Celery(flask_app)
+
+    @celery.task(bind=True)
+    @single_instance
+    async def double(x):
+        await asyncio.sleep(0)
+        return current_app.name, x * 2
+
+    assert (flask_app.name, 8) == double.apply(args=(4, )).get()
+    assert (flask_app.name, 10) == double(5)
+    plan = double.run.lock_plan(double)
+    with plan.manager((), dict()):
+        result = double.apply(args=(4, ))
+        assert result.failed() and isinstance(result.result, OtherInstanceError)
+    assert not plan.manager((), dict()).is_already_running
+
+    async def main():  # Called directly in a coroutine: awaited by the caller.
+        return await double(6)
+
+    assert (flask_app.name, 12) == asyncio.run(main())
@@ -0,0 +1,85 @@
+"""Test batch tasks, in eager mode with a SQLite result backend."""
+
+import os
+import time
+
+import pytest
+from flask import Flask, g
+
+from flask_celery import Celery, OtherInstanceError
+
+
+@pytest.fixture
+def celery(tmpdir):
+    """Return a Celery extension running tasks eagerly, storing results in SQLite."""
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_RESULT_BACKEND'] = 'db+sqlite:///' + os.path.join(str(tmpdir), 'results.sqlite')
+    flask_app.config['CELERY_ALWAYS_EAGER'] = True
+    return Celery(flask_app)
+
+
+def test_size(celery):
+    """Test that a full batch runs as one task in one app context, reporting per-item results and exceptions."""
+    contexts = list()
+
+    @celery.batch_task(size=3, interval=60)
+    def div(x, y):
+        contexts.append(id(g._get_current_object()))
+        return x // y
+
+    assert 'tests.test_batch.div' == div.name
+    first = div.submit(8, 2)
+    second = div.submit(8, y=0)
+    assert [] == contexts
+    third = div.submit(9, 3)
+    assert 3 == len(contexts)
+    assert 1 == len(set(contexts))
+
+    assert 4 == first.get()
+    assert 3 == third.get()
+    with pytest.raises(ZeroDivisionError):
+        second.get()
+    assert 'ZeroDivisionError' in second.traceback
+
+
+def test_interval_and_flush(celery):
+    """Test that partial batches are published after the interval, or when flushed."""
+    calls = list()
+
+    @celery.batch_task(size=100, interval=0.1)
+    def add(x, y):
+        calls.append((x, y))
+        return x + y
+
+    result = add.submit(4, 4)
+    assert [] == calls
+    for _ in range(50):
+        if result.ready():
+            break
+        time.sleep(0.05)
+    assert [(4, 4)] == calls
+    assert 8 == result.get()
+
+    add.submit(1, 1)
+    add.submit(2, 2)
+    assert add.flush() is not None
+    assert [(4, 4), (1, 1), (2, 2)] == calls
+    assert add.flush() is None
+
+
+def test_lock(celery):
+    """Test that one lock covers the whole batch."""
+    @celery.batch_task(size=2, lock=dict(lock_timeout=20))
+    def double(x):
+        return x * 2
+
+    assert 20 == double.run.lock_plan(double).timeout
+    with double.run.lock_plan(double).manager((), dict()):
+        with pytest.raises(OtherInstanceError):
+            double.apply(args=([['item-id', [4], dict()]], ), throw=True)
+        results = [double.submit(4), double.submit(5)]
+    assert ['FAILURE', 'FAILURE'] == [r.state for r in results]
+    assert all(isinstance(r.result, OtherInstanceError) for r in results)
+    results = [double.submit(4), double.submit(5)]
+    assert [8, 10] == [r.get() for r in results]
@@ -0,0 +1,57 @@
+"""Test single_instance_status()."""
+
+import pytest
+
+from flask_celery import single_instance, single_instance_status
+from tests.fakes import FakeTask, RedisBackend, sqlite_backend
+
+
+def make_task(name, backend, **kwargs):
+    """Return a FakeTask whose body is decorated with single_instance()."""
+    return FakeTask(name, backend, run=single_instance(**kwargs)(lambda *_: None))
+
+
+def test_redis():
+    """Test that many Redis locks are looked up in one round trip."""
+    backend = RedisBackend()
+    add = make_task('tests.fake.add', backend, lock_timeout=20)
+    mul = make_task('tests.fake.mul', backend, lock_timeout=20, include_args=True)
+    add.run.lock_plan(add).manager((), dict()).__enter__()
+    mul.run.lock_plan(mul).manager((4, 4), dict()).__enter__()
+
+    before = backend.client.round_trips
+    statuses = single_instance_status([(add, (), dict()), (mul, (4, 4), dict()), (mul, (5, 4), dict())])
+    assert 1 == backend.client.round_trips - before
+    assert [True, True, False] == [s[0] for s in statuses]
+    assert 19 < statuses[0][1] <= 20
+    assert statuses[2][1] is None
+
+
+def test_database(tmpdir):
+    """Test that many database locks are looked up in one query, honoring each task's timeout."""
+    backend = sqlite_backend(str(tmpdir))
+    add = make_task('tests.fake.add', backend, lock_timeout=20)
+    mul = make_task('tests.fake.mul', backend, lock_timeout=20, include_args=True)
+    add.run.lock_plan(add).manager((), dict()).__enter__()
+    mul.run.lock_plan(mul).manager((4, 4), dict()).__enter__()
+
+    statuses = single_instance_status([(add, (), dict()), (mul, (4, 4), dict()), (mul, (5, 4), dict())])
+    assert [True, True, False] == [s[0] for s in statuses]
+    assert 19 < statuses[1][1] <= 20
+    assert statuses[2][1] is None
+
+
+def test_mixed(tmpdir):
+    """Test queries spanning several backends, results keep the queries' order."""
+    redis = make_task('tests.fake.redis', RedisBackend())
+    database = make_task('tests.fake.db', sqlite_backend(str(tmpdir)))
+    database.run.lock_plan(database).manager((), dict()).__enter__()
+    statuses = single_instance_status([(database, (), dict()), (redis, (), dict()), (database, (), dict())])
+    assert [True, False, True] == [s[0] for s in statuses]
+
+
+def test_not_single_instance():
+    """Test tasks not decorated with single_instance()."""
+    task = FakeTask('tests.fake.plain', RedisBackend(), run=lambda: None)
+    with pytest.raises(ValueError):
+        single_instance_status([(task, (), dict())])
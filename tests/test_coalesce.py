@@ -0,0 +1,123 @@
+"""Test coalescing duplicates into one follow-up run."""
+
+import threading
+import time
+
+import pytest
+
+from flask_celery import OtherInstanceError, single_instance, single_instance_error
+from tests.fakes import FakeTask
+
+
+def coalescing_task(backend, body):
+    """Return a FakeTask running `body` with coalesce=True, recording its apply_async() calls.
+
+    :param backend: Celery result backend (or stand-in).
+    :param body: Task body.
+    """
+    task = FakeTask('tests.fake.refresh', backend, run=single_instance(coalesce=True)(body))
+    task.published = list()
+    task.apply_async = lambda args=None, kwargs=None, **_: task.published.append((args, kwargs))
+    return task
+
+
+def test_no_duplicates(backend):
+    """Test that a run without duplicates does not publish a follow-up."""
+    task = coalescing_task(backend, lambda x: x * 2)
+    assert 8 == task.run(task, 4)
+    assert 8 == task.run(task, 4)
+    assert [] == task.published
+
+
+def test_one_follow_up(backend):
+    """Test that any number of duplicates during a run result in exactly one follow-up run, with the same arguments."""
+    started, finish = threading.Event(), threading.Event()
+
+    def body(x):
+        started.set()
+        finish.wait(10)
+        return x
+
+    task = coalescing_task(backend, body)
+    thread = threading.Thread(target=task.run, args=(task, 4))
+    thread.start()
+    assert started.wait(10)
+    for _ in range(5):
+        assert task.run(task, 4) is None
+    assert [] == task.published
+    finish.set()
+    thread.join()
+    assert [((4, ), dict())] == task.published
+
+    # The mark was cleared with the lock.
+    assert 4 == task.run(task, 4)
+    assert 1 == len(task.published)
+
+
+def test_not_coalescing(backend):
+    """Test that duplicates still raise without coalesce=True."""
+    task = FakeTask('tests.fake.refresh', backend, run=single_instance(lambda: None))
+    plan = task.run.lock_plan(task)
+    with plan.manager((), dict()):
+        with pytest.raises(OtherInstanceError):
+            task.run(task)
+
+
+def test_vanished(backend):
+    """Test that a duplicate finding no lock to mark acquires it and runs instead."""
+    task = coalescing_task(backend, lambda: 'ran')
+    manager = task.run.lock_plan(task).manager((), dict())
+    assert manager.mark_dirty() is False
+    assert 'ran' == task.run(task)
+    assert [] == task.published
+
+
+def test_wait(backend):
+    """Test that a waiting duplicate stops waiting once coalesced, so it runs only as the follow-up."""
+    started, finish = threading.Event(), threading.Event()
+    runs = list()
+
+    def body(x):
+        runs.append(x)
+        started.set()
+        finish.wait(10)
+        return x
+
+    task = FakeTask('tests.fake.refresh', backend, run=single_instance(coalesce=True, wait=5)(body))
+    task.published = list()
+    task.apply_async = lambda args=None, kwargs=None, **_: task.published.append((args, kwargs))
+    thread = threading.Thread(target=task.run, args=(task, 4))
+    thread.start()
+    assert started.wait(10)
+    start = time.time()
+    assert task.run(task, 4) is None
+    assert time.time() - start < 1
+    finish.set()
+    thread.join()
+    assert [4] == runs
+    assert [((4, ), dict())] == task.published
+
+
+def test_follow_up_failed(backend):
+    """Test that failing to publish the follow-up is reported as a lock error without failing the finished task."""
+    errors = list()
+
+    def on_error(exception, **_):
+        errors.append(exception)
+
+    def body(x):
+        assert task.run(task, x) is None  # A duplicate, coalesced.
+        return x * 2
+
+    def fail(*_, **__):
+        raise IOError('Broker unreachable.')
+
+    task = FakeTask('tests.fake.refresh', backend, run=single_instance(coalesce=True)(body))
+    task.apply_async = fail
+    single_instance_error.connect(on_error)
+    try:
+        assert 8 == task.run(task, 4)
+    finally:
+        single_instance_error.disconnect(on_error)
+    assert [IOError] == [e.__class__ for e in errors]
+    assert task.run.lock_plan(task).manager((4, ), dict()).is_already_running is False
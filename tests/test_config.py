@@ -0,0 +1,49 @@
+"""Test how the Celery extension is initialized and configured from the Flask config."""
+
+import pytest
+from celery import Celery as CeleryClass
+from flask import Flask
+
+from flask_celery import _CeleryConfig, Celery
+
+
+def test_view():
+    """Test that only Celery settings of the Flask config are visible, and that the view is live."""
+    config = dict(CELERY_BROKER_URL='memory://', BROKER_POOL_LIMIT=3, task_serializer='json', SECRET_KEY='s', DEBUG=1)
+    view = _CeleryConfig(config)
+    assert dict(CELERY_BROKER_URL='memory://', BROKER_POOL_LIMIT=3, task_serializer='json') == dict(view)
+    assert 3 == len(view)
+    assert 'SECRET_KEY' not in view
+    with pytest.raises(KeyError):
+        view['DEBUG']  # pylint: disable=pointless-statement
+    config['CELERY_SINGLE_INSTANCE_KEY_PREFIX'] = 'app'
+    assert 'app' == view['CELERY_SINGLE_INSTANCE_KEY_PREFIX']
+
+
+def test_init_app(monkeypatch):
+    """Test that celery.Celery is initialized once and that tasks declared before init_app() are kept."""
+    calls = list()
+    original = CeleryClass.__init__
+    monkeypatch.setattr(CeleryClass, '__init__', lambda *a, **kw: calls.append(a[1:]) or original(*a, **kw))
+    celery = Celery()
+
+    @celery.task
+    def add(x, y):
+        return x + y
+
+    flask_app = Flask(__name__)
+    flask_app.config.update(CELERY_BROKER_URL='memory://', CELERY_RESULT_BACKEND='cache+memory://', SECRET_KEY='s')
+    celery.init_app(flask_app)
+    flask_app.config['CELERY_TASK_SERIALIZER'] = 'pickle'  # Celery looks settings up in the Flask config.
+    assert [()] == calls
+
+    assert __name__ == celery.main
+    assert 'memory://' == celery.conf.broker_url
+    assert 'cache+memory://' == celery.conf.result_backend
+    assert 'pickle' == celery.conf.task_serializer
+    assert celery.conf.get('SECRET_KEY') is None
+    assert 8 == add.apply(args=(4, 4)).get()
+    assert add.name in celery.tasks
+
+    with pytest.raises(ValueError):
+        celery.init_app(flask_app)
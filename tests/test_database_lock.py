@@ -0,0 +1,121 @@
+"""Test the database lock manager against SQLite."""
+
+import threading
+import time
+
+import pytest
+
+from flask_celery import _LockTable, OtherInstanceError, reap_expired_locks, single_instance
+from tests.fakes import FakeTask, RedisBackend, sqlite_backend
+
+
+@pytest.fixture(params=['upsert', 'fallback'])
+def make_plan(request, tmpdir):
+    """Return a function building lock plans sharing one SQLite backend, with and without the upsert statement."""
+    backend = sqlite_backend(str(tmpdir))
+    lock_table = _LockTable.get(backend)
+    if request.param == 'fallback':
+        lock_table.upsert = None
+    else:
+        assert lock_table.upsert is not None
+
+    def make(lock_timeout=20, include_args=False):
+        task = FakeTask('tests.fake.add', backend)
+        return single_instance(lock_timeout=lock_timeout, include_args=include_args)(lambda: None).lock_plan(task)
+    return make
+
+
+def test_pooled(tmpdir):
+    """Test that lock managers of a database share one lock table instance (and engine)."""
+    backend = sqlite_backend(str(tmpdir))
+    plan = single_instance(lambda: None).lock_plan(FakeTask('tests.fake.add', backend))
+    assert plan.manager((), dict()).lock_table is _LockTable.get(backend)
+    assert plan.manager((), dict()).lock_table is plan.manager((), dict()).lock_table
+
+
+def test_collision(make_plan):
+    """Test that a second instance is rejected while the first holds the lock."""
+    plan = make_plan()
+    first, second = plan.manager((), dict()), plan.manager((), dict())
+    with first:
+        with pytest.raises(OtherInstanceError) as exc:
+            with second:
+                pass
+        assert 'Failed to acquire lock, tests.fake.add already running.' == str(exc.value)
+        assert first.is_already_running is True
+    assert first.is_already_running is False
+    with second:
+        pass
+
+
+def test_takeover(make_plan):
+    """Test that an expired lock is taken over and the previous owner does not release the new owner's lock."""
+    plan = make_plan(lock_timeout=0.2)
+    first, second = plan.manager((), dict()), plan.manager((), dict())
+    first.__enter__()
+    with pytest.raises(OtherInstanceError):
+        second.__enter__()
+    time.sleep(0.3)
+    assert first.is_already_running is False
+    second.__enter__()
+    first.__exit__(None, None, None)
+    assert second.is_already_running is True
+    second.__exit__(None, None, None)
+    assert second.is_already_running is False
+
+
+def test_reset(make_plan):
+    """Test reset_lock()."""
+    plan = make_plan(include_args=True)
+    manager = plan.manager((1, 2), dict())
+    manager.__enter__()
+    assert manager.is_already_running is True
+    assert plan.manager((2, 1), dict()).is_already_running is False
+    manager.reset_lock()
+    assert manager.is_already_running is False
+    with plan.manager((1, 2), dict()):
+        pass
+
+
+def test_contention(make_plan):
+    """Test that exactly one of many racing threads gets the lock."""
+    plan = make_plan()
+    winners = list()
+    start = threading.Event()
+
+    def race():
+        manager = plan.manager((), dict())
+        start.wait()
+        try:
+            manager.__enter__()
+        except OtherInstanceError:
+            return
+        winners.append(manager)
+
+    threads = [threading.Thread(target=race) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    assert 1 == len(winners)
+
+
+def test_reap(tmpdir):
+    """Test that expired locks and idle rate limits are deleted in batches, keeping live ones."""
+    task = FakeTask('tests.fake.add', sqlite_backend(str(tmpdir)))
+    lock_table = _LockTable.get(task.backend)
+    for i in range(7):
+        assert lock_table.acquire('expired.{0}'.format(i), 'crashed', -1)
+    assert lock_table.acquire('live', 'running', 20)
+    assert 0 == lock_table.throttle('idle', 0.001, 1)
+    assert 0 == lock_table.throttle('busy', 60, 1)
+    time.sleep(0.01)
+
+    assert 4 == reap_expired_locks(task, batch_size=3, max_batches=1)  # 3 locks, 1 rate limit.
+    assert 4 == len(lock_table.expiration(['expired.{0}'.format(i) for i in range(7)]))
+    assert 4 == reap_expired_locks(task, batch_size=3)
+    assert ['live'] == list(lock_table.expiration(['live', 'expired.6']))
+    assert 0 == reap_expired_locks(task)
+    assert lock_table.throttle('busy', 60, 1) > 0  # Not reset.
+    assert 0 == reap_expired_locks(FakeTask('tests.fake.add', RedisBackend()))  # Redis keys expire on their own.
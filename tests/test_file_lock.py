@@ -0,0 +1,140 @@
+"""Test the local filesystem lock manager."""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from flask_celery import _LockManagerFile, OtherInstanceError, single_instance, single_instance_status
+from tests.fakes import FakeTask
+
+
+@pytest.fixture
+def task(tmpdir):
+    """Return a task using file locks in a temporary directory, with a result backend no other manager supports."""
+    conf = dict(CELERY_SINGLE_INSTANCE_LOCK_DIR=str(tmpdir.join('locks')))
+    return FakeTask('tests.fake.add', object(), conf=conf, run=single_instance(include_args=True)(lambda x, y: x + y))
+
+
+def test_selected(task):
+    """Test that the directory setting selects file locks and that lock files are named after the task."""
+    manager = task.run.lock_plan(task).manager((4, 4), dict())
+    assert manager.__class__ is _LockManagerFile
+    assert os.path.basename(manager.path) == manager.task_identifier + '.lock'
+    assert 8 == task.run(task, 4, 4)
+    assert os.path.exists(manager.path)
+
+    # Identifiers unsafe as file names are hashed.
+    task.name = 'tests/fake add'
+    manager = single_instance(lambda: None).lock_plan(task).manager((), dict())
+    assert os.path.dirname(manager.path) == task.app.conf['CELERY_SINGLE_INSTANCE_LOCK_DIR']
+    assert '/' not in os.path.basename(manager.path)
+
+
+def test_collision(task):
+    """Test that a held lock rejects duplicates and that single_instance_status() reports it."""
+    plan = task.run.lock_plan(task)
+    manager = plan.manager((4, 4), dict())
+    assert [(False, None)] == single_instance_status([(task, (4, 4), dict())])
+    with manager:
+        assert manager.is_already_running is True
+        other = plan.manager((4, 4), dict())
+        with pytest.raises(OtherInstanceError):
+            other.acquire()
+        assert manager.owner == other.other_owner
+        assert 9 == task.run(task, 5, 4)
+        running, remaining = single_instance_status([(task, (4, 4), dict())])[0]
+        assert running is True
+        assert 0 < remaining <= plan.timeout
+    assert manager.is_already_running is False
+
+
+def test_expired(task):
+    """Test that an expired lock is taken over and the previous owner does not release the new owner's lock."""
+    plan = single_instance(lock_timeout=0.2)(lambda: None).lock_plan(task)
+    first, second = plan.manager((), dict()), plan.manager((), dict())
+    first.acquire()
+    with pytest.raises(OtherInstanceError):
+        second.acquire()
+    time.sleep(0.3)
+    second.acquire()
+    assert first.release() is False  # Logs a warning, lock no longer owned.
+    assert second.is_already_running is True
+    assert first.extend() is False
+    assert second.extend() is True
+    second.release()
+    assert second.is_already_running is False
+
+
+def test_coalesce(task):
+    """Test that the dirty mark is kept in the lease and cleared on release."""
+    manager = single_instance(coalesce=True)(lambda: None).lock_plan(task).manager((), dict())
+    assert manager.mark_dirty() is False
+    manager.acquire()
+    assert manager.mark_dirty() is True
+    assert manager.release() is True
+    manager.acquire()
+    assert manager.release() is False
+
+
+def hold(directory, seconds, queue):
+    """Child process: hold the lock of tests.fake.sleep for a while.
+
+    :param str directory: Lock directory.
+    :param float seconds: Seconds to hold the lock.
+    :param multiprocessing.Queue queue: Receives 'held' once the lock is acquired.
+    """
+    task = FakeTask('tests.fake.sleep', object(), conf=dict(CELERY_SINGLE_INSTANCE_LOCK_DIR=directory))
+    with single_instance(lambda: None).lock_plan(task).manager((), dict()):
+        queue.put('held')
+        time.sleep(seconds)
+
+
+def test_other_process(task):
+    """Test that locks are shared between processes."""
+    directory = task.app.conf['CELERY_SINGLE_INSTANCE_LOCK_DIR']
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=hold, args=(directory, 0.5, queue))
+    process.start()
+    try:
+        assert 'held' == queue.get(timeout=10)
+        task.name = 'tests.fake.sleep'
+        wrapped = single_instance(lambda: 'ran')
+        with pytest.raises(OtherInstanceError):
+            wrapped(task)
+    finally:
+        process.join()
+    assert 'ran' == wrapped(task)
+
+
+def test_long_owner(task):
+    """Test that a lease longer than the padded record size is not misread after a shorter one replaces it."""
+    plan = single_instance(lambda: None).lock_plan(task)
+    manager = plan.manager((), dict())
+    manager.owner = 'x' * 400
+    manager.acquire()
+    assert manager.current_owner() == 'x' * 400
+    manager.release()
+    assert manager.is_already_running is False
+    with plan.manager((), dict()):
+        assert plan.manager((), dict()).is_already_running is True
+    assert os.path.getsize(manager.path) == _LockManagerFile.RECORD_SIZE
+
+
+def test_whitespace_owner(task):
+    """Test that a lock owned by a task id containing whitespace is held, and only released by its owner."""
+    plan = single_instance(lambda: None).lock_plan(task)
+    task.request.id = ' my task\tid 2 '
+    manager = plan.manager((), dict())
+    manager.acquire()
+    assert manager.current_owner() == ' my task\tid 2 '
+    other = plan.manager((), dict())
+    assert other.is_already_running is True
+    task.request.id = 'my'
+    with pytest.raises(OtherInstanceError):
+        other.acquire()
+    other.release()
+    assert manager.is_already_running is True
+    manager.release()
+    assert manager.is_already_running is False
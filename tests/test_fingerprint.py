@@ -0,0 +1,71 @@
+"""Test argument fingerprinting for include_args."""
+
+from collections import OrderedDict
+
+import pytest
+
+from flask_celery import _feed, _fingerprint, single_instance
+from tests.fakes import FakeTask, RedisBackend
+
+
+class Point(object):
+    """Object without a stable repr."""
+
+    def __init__(self, x, y):
+        """Constructor."""
+        self.x = x
+        self.y = y
+
+
+def encode(value):
+    """Return the canonical encoding of value as one bytes object."""
+    parts = list()
+    _feed(parts.append, value)
+    return b''.join(parts)
+
+
+@pytest.mark.parametrize('first,second', [
+    (dict(a=1, b=2), OrderedDict([('b', 2), ('a', 1)])),
+    ((1, [2, 3]), [1, (2, 3)]),
+    (set(['a', 'b', 'c']), frozenset(['c', 'b', 'a'])),
+    (Point(1, 2), Point(1, 2)),
+])
+def test_equal(first, second):
+    """Test values which must share a fingerprint."""
+    assert encode(first) == encode(second)
+    assert _fingerprint(first) == _fingerprint(second)
+
+
+@pytest.mark.parametrize('first,second', [
+    (1, '1'), (1, 1.0), (True, 1), (None, 'None'), (b'a', u'a'), (['ab'], ['a', 'b']), (dict(a=1), [('a', 1)]),
+    (Point(1, 2), Point(2, 1)), (dict(k=set([u'\ud800'])), dict(k=set([u'\ud801']))),
+])
+def test_different(first, second):
+    """Test values which must not share a fingerprint."""
+    assert _fingerprint(first) != _fingerprint(second)
+
+
+def test_stable():
+    """Test that fingerprints are blake2b digests of the encoding, whatever hash libraries are installed."""
+    assert '44489380f4e79610ead05a45fdb6cf80' == _fingerprint((('a', 1), dict(b=[2.5, None])))
+    assert b's1:\xed\xa0\x80' == encode(u'\ud800')  # Lone surrogates are encoded, not rejected.
+
+
+def test_key_func():
+    """Test that key_func limits the fingerprint to what it returns, and implies include_args."""
+    task = FakeTask('tests.fake.sync', RedisBackend())
+    plan = single_instance(key_func=lambda account_id, **_: account_id)(lambda **_: None).lock_plan(task)
+    assert plan.include_args is True
+    first = plan.task_identifier((), dict(account_id=7, since='2014-01-01'))
+    assert first.startswith('tests.fake.sync.args.')
+    assert first == plan.task_identifier((), dict(account_id=7, since='2015-01-01'))
+    assert first != plan.task_identifier((), dict(account_id=8, since='2014-01-01'))
+
+
+def test_once():
+    """Test that key_func (and therefore fingerprinting) runs once per invocation."""
+    calls = list()
+    task = FakeTask('tests.fake.sync', RedisBackend())
+    wrapped = single_instance(key_func=lambda x: calls.append(x) or x)(lambda x: x * 2)
+    assert 8 == wrapped(task, 4)
+    assert [4] == calls
@@ -0,0 +1,48 @@
+"""Test lock heartbeats."""
+
+import threading
+import time
+
+import pytest
+
+from flask_celery import OtherInstanceError, single_instance
+from tests.fakes import FakeTask
+
+
+def test_timeout(backend):
+    """Test that the timeout defaults to three heartbeats and ignores task time limits."""
+    task = FakeTask('tests.fake.sleep', backend, time_limit=600)
+    assert 3 == single_instance(heartbeat=1)(lambda: None).lock_plan(task).timeout
+    assert 10 == single_instance(heartbeat=1, lock_timeout=10)(lambda: None).lock_plan(task).timeout
+    assert 600 == single_instance(lambda: None).lock_plan(task).timeout
+
+
+def test_extended(backend):
+    """Test that a task running longer than its lock timeout keeps its lock, and releases it when done."""
+    task = FakeTask('tests.fake.sleep', backend)
+    wrapped = single_instance(heartbeat=0.1)(time.sleep)
+    plan = wrapped.lock_plan(task)
+    assert abs(plan.timeout - 0.3) < 1e-9
+
+    thread = threading.Thread(target=wrapped, args=(task, 1))
+    thread.start()
+    time.sleep(0.1)
+    for _ in range(4):  # Well past the 0.3 second timeout.
+        time.sleep(0.2)
+        with pytest.raises(OtherInstanceError):
+            wrapped(task, 0)
+    thread.join()
+    assert plan.manager((), dict()).is_already_running is False
+    assert wrapped(task, 0) is None
+
+
+def test_crashed(backend):
+    """Test that a lock is not extended once the heartbeat stopped, e.g. the worker crashed."""
+    task = FakeTask('tests.fake.sleep', backend)
+    plan = single_instance(heartbeat=0.1)(time.sleep).lock_plan(task)
+    manager = plan.manager((), dict())
+    manager.__enter__()  # Never released.
+    assert manager.is_already_running is True
+    time.sleep(0.4)
+    assert manager.is_already_running is False
+    assert manager.extend() is False
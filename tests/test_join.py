@@ -0,0 +1,61 @@
+"""Test joining the running instance instead of failing."""
+
+import pytest
+
+from flask_celery import OtherInstanceError, single_instance
+from tests.fakes import FakeTask
+
+
+def joining_task(backend, **options):
+    """Return a FakeTask decorated with join=True, with AsyncResult() returning the task id it was given.
+
+    :param backend: Celery result backend (or stand-in).
+    :param dict options: Other single_instance() options.
+    """
+    task = FakeTask('tests.fake.compute', backend, run=single_instance(join=True, **options)(lambda x: x * 2))
+    task.AsyncResult = lambda task_id: ('AsyncResult', task_id)
+    return task
+
+
+def test_duplicate(backend):
+    """Test that a duplicate returns the running task's AsyncResult."""
+    task = joining_task(backend)
+    plan = task.run.lock_plan(task)
+    task.request.id = 'running-task-id'
+    with plan.manager((4, ), dict()):
+        task.request.id = 'duplicate-task-id'
+        assert ('AsyncResult', 'running-task-id') == task.run(task, 4)
+    assert 8 == task.run(task, 4)
+
+
+def test_untracked(backend):
+    """Test that a lock not held by a Celery task can't be joined, the duplicate still raises."""
+    task = joining_task(backend)
+    plan = task.run.lock_plan(task)
+    manager = plan.manager((4, ), dict())
+    with manager:
+        assert manager.owner.startswith('untracked.')
+        with pytest.raises(OtherInstanceError):
+            task.run(task, 4)
+
+
+def test_publish_check(backend):
+    """Test that publishing a duplicate returns the running task's AsyncResult without publishing."""
+    task = joining_task(backend, publish='check')
+    plan = task.run.lock_plan(task)
+    published = list()
+    task.request.id = 'running-task-id'
+    with plan.manager((4, ), dict()):
+        assert ('AsyncResult', 'running-task-id') == plan.apply_async(lambda *a, **k: published.append(a), (4, ))
+    assert [] == published
+
+
+def test_publish_claim(backend):
+    """Test that duplicates published while the first one is queued join it."""
+    task = joining_task(backend, publish='claim')
+    plan = task.run.lock_plan(task)
+    published = list()
+    assert 'queued-task-id' == plan.apply_async(lambda *a, **k: published.append(k) or k['task_id'], (4, ),
+                                                task_id='queued-task-id')
+    assert ('AsyncResult', 'queued-task-id') == plan.apply_async(lambda *a, **k: published.append(k), (4, ))
+    assert 1 == len(published)
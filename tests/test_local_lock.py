@@ -0,0 +1,61 @@
+"""Test the process-local lock tier in front of lock backends."""
+
+import threading
+import time
+
+import pytest
+
+from flask_celery import _LOCAL_LOCKS, OtherInstanceError, single_instance
+from tests.fakes import FakeTask, RedisBackend
+
+
+def test_no_round_trip():
+    """Test that duplicates in the same process are rejected without touching the backend."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    client = task.backend.client
+    running = threading.Event()
+    finish = threading.Event()
+
+    def body():
+        running.set()
+        finish.wait()
+    wrapped = single_instance(body)
+    thread = threading.Thread(target=wrapped, args=(task, ))
+    thread.start()
+    running.wait()
+
+    before = client.round_trips
+    for _ in range(10):
+        with pytest.raises(OtherInstanceError):
+            wrapped(task)
+    assert before == client.round_trips
+    finish.set()
+    thread.join()
+    wrapped(task)
+
+
+def test_other_process():
+    """Test that locks held by other processes (only in the backend) are still rejected."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    plan = single_instance(lambda: None).lock_plan(task)
+    holder = plan.manager((), dict())
+    holder.acquire()  # Backend only, like another worker process.
+    with pytest.raises(OtherInstanceError):
+        plan.manager((), dict()).__enter__()
+    assert _LOCAL_LOCKS.claim(holder.local_key, 1)  # The failed attempt dropped its local claim.
+    _LOCAL_LOCKS.release(holder.local_key)
+
+
+def test_leaked():
+    """Test that local claims of lock managers which never exited expire with the lock, or on reset_lock()."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    plan = single_instance(lock_timeout=0.1)(lambda: None).lock_plan(task)
+    plan.manager((), dict()).__enter__()
+    with pytest.raises(OtherInstanceError):
+        plan.manager((), dict()).__enter__()
+    time.sleep(0.15)
+    manager = plan.manager((), dict())
+    manager.__enter__()
+    manager.reset_lock()
+    with plan.manager((), dict()):
+        pass
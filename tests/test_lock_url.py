@@ -0,0 +1,101 @@
+"""Test lock stores independent of the result backend, and the lock manager registry."""
+
+import os
+
+import pytest
+
+from flask_celery import (
+    _LOCK_MANAGERS, _LockManagerDB, _LockManagerFile, _LockManagerRedis, _LockTable, OtherInstanceError,
+    register_lock_manager, single_instance, single_instance_status,
+)
+from tests.fakes import FakeRedis, FakeTask, RedisBackend, sqlite_backend
+
+
+class FakeRedisLockManager(_LockManagerRedis):
+    """Redis lock manager keeping locks in one FakeRedis per fakeredis:// URL or task."""
+
+    @classmethod
+    def backend_store(cls, backend):
+        """Return a new FakeRedis, called once per task."""
+        return FakeRedis()
+
+    @classmethod
+    def open_store(cls, url):
+        """Return a new FakeRedis, called once per URL."""
+        return FakeRedis()
+
+
+@pytest.fixture
+def registered(request):
+    """Register FakeRedisLockManager for fakeredis:// URLs for the duration of the test."""
+    register_lock_manager('fakeredis', FakeRedisLockManager)
+    assert 'fakeredis' in _LOCK_MANAGERS
+    request.addfinalizer(lambda: _LOCK_MANAGERS.pop('fakeredis'))
+    return FakeRedisLockManager
+
+
+def test_registered(registered, tmpdir):
+    """Test that a lock URL selects its registered manager regardless of the result backend, sharing one store."""
+    conf = dict(CELERY_SINGLE_INSTANCE_LOCK_URL='fakeredis://locks:6379/0')
+    task = FakeTask('tests.fake.add', sqlite_backend(str(tmpdir)), conf=conf)
+    plan = single_instance(lambda: None).lock_plan(task)
+    manager = plan.manager((), dict())
+    assert manager.__class__ is registered
+    assert isinstance(manager.store, FakeRedis)
+
+    other = FakeTask('tests.fake.add', RedisBackend(), conf=conf, run=single_instance(lambda: None))
+    other_plan = other.run.lock_plan(other)
+    assert other_plan.store is plan.store
+    with manager:
+        with pytest.raises(OtherInstanceError):
+            other_plan.manager((), dict()).acquire()
+        assert single_instance_status([(other, (), dict())])[0][0] is True
+        assert not other.backend.client.exists(manager.redis_key)  # Not in the result backend.
+
+
+def test_database(tmpdir):
+    """Test a db+ lock URL with a result backend having no lock manager."""
+    url = 'sqlite:///' + os.path.join(str(tmpdir), 'locks.sqlite')
+    task = FakeTask('tests.fake.add', object(), conf=dict(CELERY_SINGLE_INSTANCE_LOCK_URL='db+' + url))
+    wrapped = single_instance(lambda x, y: x + y)
+    manager = wrapped.lock_plan(task).manager((), dict())
+    assert manager.__class__ is _LockManagerDB
+    assert manager.lock_table is _LockTable.for_url(url)
+    with manager:
+        with pytest.raises(OtherInstanceError):
+            wrapped(task, 4, 4)
+    assert 8 == wrapped(task, 4, 4)
+
+
+def test_file(tmpdir):
+    """Test file:// lock URLs and that they override CELERY_SINGLE_INSTANCE_LOCK_DIR."""
+    directory = str(tmpdir.join('url'))
+    conf = dict(CELERY_SINGLE_INSTANCE_LOCK_URL='file://' + directory,
+                CELERY_SINGLE_INSTANCE_LOCK_DIR=str(tmpdir.join('dir')))
+    manager = single_instance(lambda: None).lock_plan(FakeTask('tests.fake.add', object(), conf=conf)).manager((), {})
+    assert manager.__class__ is _LockManagerFile
+    assert os.path.dirname(manager.path) == directory
+    assert os.path.isdir(directory)
+
+
+def test_redis_url():
+    """Test that redis:// lock URLs get a redis-py client, without connecting."""
+    client = _LockManagerRedis.open_store('redis://locks.example.com:6380/3')
+    params = client.connection_pool.connection_kwargs
+    assert ('locks.example.com', 6380, 3) == (params['host'], params['port'], params['db'])
+
+
+def test_unsupported(registered):
+    """Test lock URLs and result backends without a lock manager."""
+    task = FakeTask('tests.fake.add', RedisBackend(), conf=dict(CELERY_SINGLE_INSTANCE_LOCK_URL='etcd://locks:2379'))
+    with pytest.raises(NotImplementedError):
+        single_instance(lambda: None)(task)
+    with pytest.raises(NotImplementedError):
+        single_instance(lambda: None)(FakeTask('tests.fake.add', object()))
+
+    # Result backends can be registered too.
+    assert register_lock_manager('object', registered) is registered
+    try:
+        assert 8 == single_instance(lambda x, y: x + y)(FakeTask('tests.fake.add', object()), 4, 4)
+    finally:
+        _LOCK_MANAGERS.pop('object')
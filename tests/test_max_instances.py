@@ -0,0 +1,107 @@
+"""Test single_instance(max_instances=N) semaphores on every lock manager."""
+
+import time
+
+import pytest
+
+from flask_celery import (
+    _SemaphoreManagerDB, _SemaphoreManagerFile, _SemaphoreManagerRedis, OtherInstanceError, single_instance,
+    single_instance_status,
+)
+from tests.fakes import FakeTask, RedisBackend, sqlite_backend
+
+MANAGERS = dict(redis=_SemaphoreManagerRedis, db=_SemaphoreManagerDB, file=_SemaphoreManagerFile)
+
+
+@pytest.fixture(params=['redis', 'db', 'file'])
+def make_task(request, tmpdir):
+    """Return a function building a task on one of the lock managers, with single_instance() arguments."""
+    backend, conf = object(), dict(CELERY_SINGLE_INSTANCE_LOCK_DIR=str(tmpdir.join('locks')))
+    if request.param != 'file':
+        backend, conf = RedisBackend() if request.param == 'redis' else sqlite_backend(str(tmpdir)), None
+
+    def make(**kwargs):
+        return FakeTask('tests.fake.add', backend, conf=conf, run=single_instance(**kwargs)(lambda x, y: x + y))
+    make.manager_class = MANAGERS[request.param]
+    return make
+
+
+def test_limit(make_task):
+    """Test that up to max_instances instances hold a slot and that the next one waits for a free slot."""
+    task = make_task(max_instances=3, lock_timeout=20)
+    plan = task.run.lock_plan(task)
+    managers = [plan.manager((), dict()) for _ in range(4)]
+    assert managers[0].__class__ is make_task.manager_class
+
+    for manager in managers[:2]:
+        manager.__enter__()
+    assert managers[0].is_already_running is False
+    assert [(False, None)] == single_instance_status([(task, (), dict())])
+    managers[2].__enter__()
+    assert managers[0].is_already_running is True
+    running, remaining = single_instance_status([(task, (), dict())])[0]
+    assert running is True
+    assert 19 < remaining <= 20
+    with pytest.raises(OtherInstanceError):
+        managers[3].__enter__()
+
+    managers[1].__exit__(None, None, None)
+    with managers[3]:
+        with pytest.raises(OtherInstanceError):
+            task.run(task, 4, 4)
+    assert 8 == task.run(task, 4, 4)
+    for manager in (managers[0], managers[2]):
+        manager.__exit__(None, None, None)
+    assert managers[0].is_already_running is False
+
+
+def test_same_process(make_task):
+    """Test that instances in one process are not limited to one by local claims."""
+    def nested(x, y):
+        """Return the nesting depth reached, up to y."""
+        if x == y:
+            return x
+        try:
+            return task.run(task, x + 1, y)
+        except OtherInstanceError:
+            return x
+
+    task = make_task(max_instances=2)
+    task.run = single_instance(max_instances=2)(nested)
+    assert 2 == task.run(task, 1, 5)
+    task.run = single_instance(max_instances=3)(nested)
+    assert 3 == task.run(task, 1, 5)
+    assert 2 == task.run(task, 1, 2)
+
+
+def test_expired(make_task):
+    """Test that expired slots are reclaimed and that their previous owner no longer releases or extends them."""
+    task = make_task(max_instances=2, lock_timeout=0.2)
+    plan = task.run.lock_plan(task)
+    first, second, third = [plan.manager((), dict()) for _ in range(3)]
+    first.acquire()
+    second.acquire()
+    with pytest.raises(OtherInstanceError):
+        third.acquire()
+    time.sleep(0.3)
+    third.acquire()
+    assert third.extend() is True
+    assert first.extend() is False
+    assert first.release() is False  # Logs a warning, slot no longer owned.
+    third.release()
+    plan.manager((), dict()).reset_lock()  # Frees all slots.
+    for manager in (first, second):
+        manager.acquire()
+    assert third.is_already_running is True
+
+
+def test_invalid(make_task):
+    """Test options max_instances does not support."""
+    with pytest.raises(ValueError):
+        single_instance(max_instances=0)
+    for options in (dict(coalesce=True), dict(join=True), dict(publish='claim')):
+        with pytest.raises(ValueError):
+            single_instance(max_instances=2, **options)
+    assert single_instance(max_instances=2, publish='check')
+    task = make_task(max_instances=1)
+    assert task.run.lock_plan(task).manager((), dict()).__class__ in make_task.manager_class.__bases__
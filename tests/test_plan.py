@@ -0,0 +1,44 @@
+"""Test per-task lock plans."""
+
+from flask_celery import _LockManagerRedis, single_instance
+from tests.fakes import FakeTask, RedisBackend
+
+
+def test_reused():
+    """Test that the plan is built once per task instance and reused."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    wrapped = single_instance(lambda x, y: x + y)
+    assert 8 == wrapped(task, 4, 4)
+    plan = wrapped.lock_plan(task)
+    assert 8 == wrapped(task, 4, 4)
+    assert plan is wrapped.lock_plan(task)
+    assert plan.manager_class is _LockManagerRedis
+
+    # Another task instance (e.g. another Celery app) gets its own plan.
+    other = FakeTask('tests.fake.add', RedisBackend())
+    assert plan is not wrapped.lock_plan(other)
+
+
+def test_timeout():
+    """Test that only global limits are looked up on every call."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    plan = single_instance(lambda: None).lock_plan(task)
+    assert 300 == plan.timeout
+    task.app.conf['CELERYD_TASK_TIME_LIMIT'] = 200
+    assert 200 == plan.timeout
+
+    task = FakeTask('tests.fake.add', RedisBackend(), time_limit=70)
+    plan = single_instance(lock_timeout=20)(lambda: None).lock_plan(task)
+    assert 20 == plan.timeout
+    assert 20 == plan.manager((), dict()).timeout
+
+
+def test_identifier():
+    """Test that the task identifier is computed once per manager and matches the plan's."""
+    task = FakeTask('tests.fake.mul', RedisBackend())
+    plan = single_instance(include_args=True)(lambda x, y: x * y).lock_plan(task)
+    manager = plan.manager((4, 4), dict())
+    assert manager.task_identifier == plan.task_identifier((4, 4), dict())
+    assert manager.task_identifier.startswith('tests.fake.mul.args.')
+    assert manager.redis_key == '_celery.single_instance.' + manager.task_identifier
+    assert manager.task_identifier != plan.task_identifier((5, 4), dict())
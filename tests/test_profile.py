@@ -0,0 +1,99 @@
+"""Test profiling slow tasks with CELERY_PROFILE_THRESHOLD."""
+
+import cProfile
+import os
+import pstats
+import time
+
+from flask import Flask
+
+from flask_celery import Celery, single_instance
+
+
+def make_celery(tmpdir, **config):
+    """Return a Celery extension with file locks, profiles collected in its `profiles` list.
+
+    :param tmpdir: pytest tmpdir.
+    :param dict config: Flask config values.
+    """
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_SINGLE_INSTANCE_LOCK_DIR'] = str(tmpdir.join('locks'))
+    flask_app.config.update(config)
+    celery = Celery(flask_app)
+    celery.profiles = list()
+    celery.on_slow_task(celery.profiles.append)
+    return celery
+
+
+def test_slow(tmpdir):
+    """Test that executions above the threshold are profiled with separate timings and written to the directory."""
+    directory = str(tmpdir.join('profiles'))
+    celery = make_celery(tmpdir, CELERY_PROFILE_THRESHOLD=0.05, CELERY_PROFILE_DIR=directory)
+
+    @celery.task(bind=True)
+    @single_instance
+    def nap(seconds):
+        time.sleep(seconds)
+        return seconds
+
+    assert 0 == nap.apply(args=(0, ), task_id='fast').get()
+    assert not celery.profiles
+    assert 0.1 == nap.apply(args=(0.1, ), task_id='slow-1').get()
+    assert 1 == len(celery.profiles)
+    profile = celery.profiles[0]
+    assert (nap.name, 'slow-1') == (profile.task_name, profile.task_id)
+    assert 0.1 <= profile.duration < 1
+    assert 0 < profile.timings['lock'] < profile.timings['body']
+    assert 0.1 <= profile.timings['body'] < profile.duration
+    assert 0 < profile.timings['app_context'] < profile.duration
+
+    assert [nap.name + '.slow-1.prof'] == os.listdir(directory)
+    stats = pstats.Stats(os.path.join(directory, nap.name + '.slow-1.prof'))
+    assert any('sleep' in function for _, _, function in stats.stats)
+
+
+def test_sample(tmpdir):
+    """Test that unsampled executions and nested tasks are not profiled separately, and that it's off by default."""
+    celery = make_celery(tmpdir, CELERY_PROFILE_THRESHOLD=0, CELERY_PROFILE_SAMPLE=0)
+
+    @celery.task
+    def inner():
+        return 'inner'
+
+    @celery.task
+    def outer():
+        return inner()
+
+    assert 'inner' == outer()
+    assert not celery.profiles
+
+    celery = make_celery(tmpdir, CELERY_PROFILE_THRESHOLD=0)
+    inner, outer = celery.task(inner.run), celery.task(outer.run)
+    assert 'inner' == outer()
+    assert [outer.name] == [p.task_name for p in celery.profiles]
+
+    celery = make_celery(tmpdir)
+    assert 'inner' == celery.task(inner.run)()
+    assert not celery.profiles
+
+
+def test_other_profiler(tmpdir, monkeypatch):
+    """Test that tasks run unprofiled if the profiler can't be enabled, e.g. another one is active (Python 3.12+)."""
+    class ActiveProfile(cProfile.Profile):
+        def enable(self, *_, **__):
+            raise ValueError('Another profiling tool is already active')
+
+    monkeypatch.setattr(cProfile, 'Profile', ActiveProfile)
+    celery = make_celery(tmpdir, CELERY_PROFILE_THRESHOLD=0)
+
+    @celery.task
+    def inner():
+        return 'inner'
+
+    @celery.task
+    def outer():
+        return inner()
+
+    assert 'inner' == outer()
+    assert not celery.profiles
@@ -0,0 +1,165 @@
+"""Test publish-time deduplication."""
+
+import os
+
+import pytest
+from celery.exceptions import Retry
+from flask import Flask
+
+from flask_celery import Celery, OtherInstanceError, single_instance
+from tests.fakes import FakeTask, RedisBackend, sqlite_backend
+
+
+class Publisher(object):
+    """Record apply_async() calls instead of publishing."""
+
+    def __init__(self, fail=False):
+        """Constructor.
+
+        :param bool fail: Raise instead of publishing, like an unreachable broker.
+        """
+        self.fail = fail
+        self.published = list()
+
+    def __call__(self, args, kwargs, task_id=None, **options):
+        """Mimic apply_async()."""
+        if self.fail:
+            raise IOError('Broker unreachable.')
+        self.published.append((args, kwargs, task_id, options))
+        return task_id
+
+
+def test_check():
+    """Test that publish='check' refuses to publish while an instance is running."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    plan = single_instance(publish='check')(lambda x, y: x + y).lock_plan(task)
+    publisher = Publisher()
+    assert plan.apply_async(publisher, (4, 4), None, countdown=1) is None
+    assert [((4, 4), None, None, dict(countdown=1))] == publisher.published
+
+    with plan.manager((4, 4), dict()):
+        with pytest.raises(OtherInstanceError) as exc:
+            plan.apply_async(publisher, (4, 4))
+    assert 'Not publishing, tests.fake.add already running.' == str(exc.value)
+    assert 1 == len(publisher.published)
+
+
+def test_claim():
+    """Test that publish='claim' holds the lock for the published task, which adopts it when it runs."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    wrapped = single_instance(publish='claim')(lambda x, y: x + y)
+    plan = wrapped.lock_plan(task)
+    publisher = Publisher()
+    task_id = plan.apply_async(publisher, [4, 4])
+    assert task_id
+    assert plan.manager((4, 4), dict()).is_already_running is True
+
+    # Duplicates are rejected while the first one is queued.
+    with pytest.raises(OtherInstanceError):
+        plan.apply_async(publisher, (4, 4))
+    assert 1 == len(publisher.published)
+
+    # Another task id can't run, the published one adopts the lock and releases it.
+    task.request.id = 'other'
+    with pytest.raises(OtherInstanceError):
+        wrapped(task, 4, 4)
+    task.request.id = task_id
+    assert 8 == wrapped(task, 4, 4)
+    assert plan.manager((4, 4), dict()).is_already_running is False
+    assert plan.apply_async(publisher, (4, 4), task_id='explicit') == 'explicit'
+
+
+def test_claim_failed():
+    """Test that the claimed lock is released if publishing fails."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    plan = single_instance(publish='claim')(lambda x, y: x + y).lock_plan(task)
+    with pytest.raises(IOError):
+        plan.apply_async(Publisher(fail=True), (4, 4))
+    assert plan.manager((4, 4), dict()).is_already_running is False
+
+
+def test_extension(tmpdir):
+    """Test apply_async() and delay() of the extension's tasks, in eager mode with a SQLite result backend."""
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_RESULT_BACKEND'] = 'db+sqlite:///' + os.path.join(str(tmpdir), 'results.sqlite')
+    flask_app.config['CELERY_ALWAYS_EAGER'] = True
+    celery = Celery(flask_app)
+
+    @celery.task(bind=True)
+    @single_instance(publish='claim', include_args=True)
+    def add(x, y):
+        return x + y
+
+    assert 8 == add.delay(4, 4).get()
+    assert 8 == add.apply_async(args=(4, 4)).get()
+    with add.run.lock_plan(add).manager((4, 4), dict()):
+        with pytest.raises(OtherInstanceError):
+            add.delay(4, 4)
+        assert 9 == add.delay(5, 4).get()
+    assert 8 == add.delay(4, 4).get()
+
+
+@pytest.mark.parametrize('store', ['redis', 'db', 'file'])
+def test_redelivered(store, tmpdir):
+    """Test that a redelivered message with the task id of the running instance is rejected, claimed or not."""
+    if store == 'redis':
+        task = FakeTask('tests.fake.add', RedisBackend())
+    elif store == 'db':
+        task = FakeTask('tests.fake.add', sqlite_backend(str(tmpdir)))
+    else:
+        task = FakeTask('tests.fake.add', object(), conf=dict(CELERY_SINGLE_INSTANCE_LOCK_DIR=str(tmpdir)))
+    plan = single_instance(lambda x, y: x + y).lock_plan(task)
+    task.request.id = 'abc-123'
+    with plan.manager((4, 4), dict()):
+        with pytest.raises(OtherInstanceError):
+            plan.manager((4, 4), dict()).acquire()
+
+    claim = single_instance(publish='claim')(lambda x, y: x + y).lock_plan(task)
+    task.request.id = claim.apply_async(Publisher(), (4, 4))
+    with claim.manager((4, 4), dict()):  # Adopts the claim.
+        with pytest.raises(OtherInstanceError):
+            claim.manager((4, 4), dict()).acquire()
+        with pytest.raises(OtherInstanceError):
+            plan.manager((4, 4), dict()).acquire()
+
+
+def test_no_publish():
+    """Test that tasks not deduplicated at publish time don't build their lock plan when published."""
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_RESULT_BACKEND'] = 'rpc://'  # Not a lock store, fails only when the task runs.
+    celery = Celery(flask_app)
+
+    @celery.task(bind=True)
+    @single_instance
+    def add(x, y):
+        return x + y
+
+    assert add.delay(4, 4).id
+    assert add.apply_async(args=(5, 4), task_id='explicit').id == 'explicit'
+
+
+@pytest.mark.parametrize('publish', ['check', 'claim'])
+def test_retry(publish, tmpdir):
+    """Test that a running task retrying itself is published again, while duplicates are still refused."""
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_SINGLE_INSTANCE_LOCK_DIR'] = str(tmpdir.join('locks'))
+    celery = Celery(flask_app)
+
+    @celery.task(bind=True)
+    @single_instance(publish=publish)
+    def job():
+        return None
+
+    plan = job.run.lock_plan(job)
+    job.push_request(id='job-1', called_directly=False, args=[], kwargs=dict(), delivery_info=dict())
+    try:
+        with plan.manager((), dict()):
+            with pytest.raises(Retry):
+                job.retry(countdown=1)
+            with pytest.raises(OtherInstanceError):
+                job.apply_async(task_id='job-2')
+    finally:
+        job.pop_request()
@@ -0,0 +1,121 @@
+"""Test quorum locks on several independent in-process Redis stand-ins."""
+
+import uuid
+
+import pytest
+
+from flask_celery import (
+    _LOCK_MANAGERS, _LockManagerRedisQuorum, OtherInstanceError, rate_limit, register_lock_manager, single_instance,
+    single_instance_status,
+)
+from tests.fakes import FakeRedis, FakeTask
+
+
+class BrokenRedis(object):
+    """Redis client of a server which is down."""
+
+    def __getattr__(self, name):
+        """Every command fails, scripts fail when called."""
+        def fail(*_, **__):
+            raise IOError('Connection refused.')
+        if name == 'register_script':
+            return lambda _: fail
+        return fail
+
+
+class FakeQuorum(_LockManagerRedisQuorum):
+    """Quorum lock manager on FakeRedis servers, BrokenRedis for servers named broken."""
+
+    @classmethod
+    def open_store(cls, url):
+        """Return one client per server of the URL."""
+        hosts = [u.split('://')[1].split('/')[0] for u in url.split(';')]
+        return tuple(BrokenRedis() if h == 'broken' else FakeRedis() for h in hosts)
+
+
+@pytest.fixture
+def make_task(request):
+    """Return a function building a task locking on new servers, 'up' or 'broken' ones."""
+    register_lock_manager('fakequorum', FakeQuorum)
+    request.addfinalizer(lambda: _LOCK_MANAGERS.pop('fakequorum'))
+
+    def make(*servers, **kwargs):
+        db = uuid.uuid4().hex  # New stores.
+        url = 'fakequorum+' + ';'.join('redis://{0}/{1}'.format(s, db) for s in servers)
+        conf = dict(CELERY_SINGLE_INSTANCE_LOCK_URL=url)
+        return FakeTask('tests.fake.add', object(), conf=conf, run=single_instance(**kwargs)(lambda x, y: x + y))
+    return make
+
+
+def test_majority(make_task):
+    """Test that the lock is held on all servers and that duplicates are rejected."""
+    task = make_task('a', 'b', 'c', lock_timeout=20)
+    plan = task.run.lock_plan(task)
+    first, second = plan.manager((), dict()), plan.manager((), dict())
+    assert 2 == first.quorum
+    with first:
+        assert [first.owner.encode('utf-8')] * 3 == [c.get(first.redis_key) for c in plan.store]
+        with pytest.raises(OtherInstanceError):
+            second.acquire()
+        assert first.owner == second.other_owner == second.current_owner()
+        assert second.is_already_running is True
+        running, remaining = single_instance_status([(task, (), dict())])[0]
+        assert running is True
+        assert 19 < remaining <= 20
+        assert first.extend() is True
+    assert [None] * 3 == [c.get(first.redis_key) for c in plan.store]
+    assert [(False, None)] == single_instance_status([(task, (), dict())])
+    assert 8 == task.run(task, 4, 4)
+
+
+def test_minority(make_task):
+    """Test that a lock held by another owner on a minority of servers is taken, and a majority rejects."""
+    task = make_task('a', 'b', 'c')
+    plan = task.run.lock_plan(task)
+    manager = plan.manager((), dict())
+    plan.store[0].set(manager.redis_key, 'stale-owner')
+    with manager:
+        assert manager.is_already_running is True
+    assert b'stale-owner' == plan.store[0].get(manager.redis_key)
+
+    plan.store[1].set(manager.redis_key, 'stale-owner')
+    with pytest.raises(OtherInstanceError):
+        manager.acquire()
+    assert 'stale-owner' == manager.other_owner
+    assert plan.store[2].get(manager.redis_key) is None  # Partial grant released.
+
+
+def test_servers_down(make_task):
+    """Test that locking works with a minority of the servers down, and fails with the error without a majority."""
+    task = make_task('a', 'broken', 'c', coalesce=True)
+    task.apply_async = lambda args, kwargs: republished.append(args)
+    republished = list()
+    plan = task.run.lock_plan(task)
+    with plan.manager((4, 4), dict()):
+        duplicate = plan.manager((4, 4), dict())
+        with pytest.raises(OtherInstanceError):
+            duplicate.__enter__()
+        assert duplicate.coalesced is True
+    assert [(4, 4)] == republished
+
+    task = make_task('a', 'broken', 'broken')
+    with pytest.raises(IOError):
+        task.run(task, 4, 4)
+
+
+def test_unsupported(make_task):
+    """Test that semaphores and rate limits are not available on quorum locks."""
+    with pytest.raises(NotImplementedError):
+        task = make_task('a', 'b', 'c', max_instances=2)
+        task.run(task, 4, 4)
+    wrapped = rate_limit(rate=1)(lambda: None)
+    with pytest.raises(NotImplementedError):
+        wrapped(make_task('a', 'b', 'c'))
+
+
+def test_url():
+    """Test that quorum+ lock URLs get a redis-py client per server, without connecting."""
+    clients = _LockManagerRedisQuorum.open_store('quorum+redis://redis-a:6379/1;redis://redis-b:6380/1')
+    assert [('redis-a', 6379), ('redis-b', 6380)] == [
+        (c.connection_pool.connection_kwargs['host'], c.connection_pool.connection_kwargs['port']) for c in clients
+    ]
@@ -0,0 +1,81 @@
+"""Test the rate_limit() decorator on Redis and database stores."""
+
+import os
+import time
+
+import pytest
+from celery.exceptions import Retry
+from flask import Flask
+
+from flask_celery import _RateLimiterDB, _RateLimiterRedis, Celery, rate_limit
+from tests.fakes import FakeTask, RedisBackend
+
+
+def test_burst(backend):
+    """Test that `burst` calls run at once, then one per interval, sleeping when called directly."""
+    wrapped = rate_limit(rate='20/s', burst=3)(lambda x, y: x + y)
+    task = FakeTask('tests.fake.add', backend, run=wrapped)
+    limiter = wrapped.rate_limiter(task)
+    assert limiter.__class__ is (_RateLimiterRedis if isinstance(backend, RedisBackend) else _RateLimiterDB)
+    assert 0.05 == limiter.interval
+
+    assert [8, 8, 8] == [wrapped(task, 4, 4) for _ in range(3)]
+    wait = limiter.throttle('tests.fake.add')
+    assert 0 < wait <= 0.05
+    start = time.time()
+    assert 8 == wrapped(task, 4, 4)
+    assert wait - 0.01 < time.time() - start < 0.2
+
+    # Idle time refills the burst, but no more than `burst`.
+    time.sleep(0.2)
+    assert [0, 0, 0] == [limiter.throttle('tests.fake.add') for _ in range(3)]
+    assert limiter.throttle('tests.fake.add') > 0
+
+
+def test_include_args(backend):
+    """Test that arguments are limited separately with include_args."""
+    wrapped = rate_limit(rate=1, include_args=True)(lambda x: x)
+    task = FakeTask('tests.fake.echo', backend, run=wrapped)
+    limiter = wrapped.rate_limiter(task)
+    first, second = [limiter.plan.task_identifier((x, ), dict()) for x in (1, 2)]
+    assert 0 == limiter.throttle(first)
+    assert 0 == limiter.throttle(second)
+    assert 0.9 < limiter.throttle(first) <= 1
+
+
+@pytest.mark.parametrize('celery3', [False, True])
+def test_reschedule(tmpdir, monkeypatch, celery3):
+    """Test that throttled tasks in a worker are published again with a countdown, keeping their task id."""
+    flask_app = Flask(__name__)
+    flask_app.config['CELERY_BROKER_URL'] = 'memory://'
+    flask_app.config['CELERY_RESULT_BACKEND'] = 'db+sqlite:///' + os.path.join(str(tmpdir), 'results.sqlite')
+    celery = Celery(flask_app)
+
+    @celery.task(bind=True)
+    @rate_limit(rate='1/m', delay=0.5)
+    def ping():
+        return 'pong'
+
+    if celery3:  # Celery < 4 only has subtask_from_request().
+        monkeypatch.setattr(ping, 'subtask_from_request', ping.signature_from_request, raising=False)
+        monkeypatch.setattr(ping, 'signature_from_request', None)
+    ping.push_request(called_directly=False, id='ping-1', args=[], kwargs=dict(), delivery_info=dict())
+    try:
+        assert 'pong' == ping()
+        with pytest.raises(Retry) as exc:
+            ping()
+    finally:
+        ping.pop_request()
+    assert 59 < exc.value.when <= 60
+    assert 'ping-1' == exc.value.sig.options['task_id']
+    assert 59 < exc.value.sig.options['countdown'] <= 60
+
+
+def test_invalid():
+    """Test that invalid rates are rejected and unsupported stores raise NotImplementedError."""
+    for options in (dict(), dict(rate='0/s'), dict(rate=-1), dict(rate=1, burst=0)):
+        with pytest.raises(ValueError):
+            rate_limit(lambda: None, **options)
+    with pytest.raises(NotImplementedError):
+        rate_limit(rate=1)(lambda: None)(FakeTask('tests.fake.add', object(), conf=dict(
+            CELERY_SINGLE_INSTANCE_LOCK_DIR='/tmp/locks')))
@@ -0,0 +1,90 @@
+"""Test the Redis lock manager against an in-process stand-in."""
+
+import time
+
+import pytest
+
+from flask_celery import OtherInstanceError, single_instance
+from tests.fakes import FakeRedis, FakeTask, RedisBackend
+
+
+def make_plan(lock_timeout=20, include_args=False):
+    """Return a lock plan for a task using a fresh FakeRedis."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    return single_instance(lock_timeout=lock_timeout, include_args=include_args)(lambda: None).lock_plan(task)
+
+
+def test_round_trips():
+    """Test that acquire and release are one round trip each."""
+    plan = make_plan()
+    client = plan.celery_self.backend.client
+    manager = plan.manager((), dict())
+    manager.scripts  # Register scripts.
+    before = client.round_trips
+    with manager:
+        assert 1 == client.round_trips - before
+        assert manager.is_already_running is True
+    assert 3 == client.round_trips - before
+    assert manager.is_already_running is False
+
+    # Scripts are registered once per task.
+    assert manager.scripts is plan.manager((), dict()).scripts
+
+
+def test_collision():
+    """Test that a second instance is rejected while the first holds the lock."""
+    plan = make_plan()
+    first, second = plan.manager((), dict()), plan.manager((), dict())
+    with first:
+        with pytest.raises(OtherInstanceError) as exc:
+            with second:
+                pass
+        assert 'Failed to acquire lock, tests.fake.add already running.' == str(exc.value)
+        assert first.is_already_running is True
+    with second:
+        pass
+
+
+def test_owner():
+    """Test that releasing an expired lock does not delete another owner's lock."""
+    plan = make_plan(lock_timeout=0.05)
+    first, second = plan.manager((), dict()), plan.manager((), dict())
+    first.__enter__()
+    time.sleep(0.1)
+    second.__enter__()
+    first.__exit__(None, None, None)
+    assert second.is_already_running is True
+    second.__exit__(None, None, None)
+    assert second.is_already_running is False
+
+
+def test_reset():
+    """Test reset_lock()."""
+    plan = make_plan(include_args=True)
+    manager = plan.manager((1, 2), dict())
+    manager.__enter__()
+    assert manager.is_already_running is True
+    assert plan.manager((2, 1), dict()).is_already_running is False
+    manager.reset_lock()
+    assert manager.is_already_running is False
+    with plan.manager((1, 2), dict()):
+        pass
+
+
+def test_keys():
+    """Test the key namespace setting and hash tags, which a Redis Cluster store implies."""
+    class RedisCluster(FakeRedis):
+        """Stand-in for redis.cluster.RedisCluster, only its class name matters."""
+
+    def make(conf=None, client=None):
+        task = FakeTask('tests.fake.add', RedisBackend(client), conf=conf)
+        return single_instance(lambda: None).lock_plan(task).manager((), dict())
+
+    assert '_celery.single_instance.tests.fake.add' == make().redis_key
+    manager = make(dict(CELERY_SINGLE_INSTANCE_KEY_PREFIX='app1.locks', CELERY_SINGLE_INSTANCE_HASH_TAGS=True))
+    assert 'app1.locks.{tests.fake.add}' == manager.redis_key
+    assert 'app1.locks.{tests.fake.add}.dirty' == manager.dirty_key
+    manager = make(client=RedisCluster())
+    assert '_celery.single_instance.{tests.fake.add}' == manager.redis_key
+    with manager:
+        assert manager.is_already_running is True
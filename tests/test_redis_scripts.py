@@ -0,0 +1,128 @@
+"""Test the Lua scripts of the Redis lock managers on a real Redis server, skipped if none is reachable.
+
+The other Redis tests run against tests.fakes.FakeRedis, which emulates the scripts in Python. Set REDIS_URL to use
+another server than redis://localhost/1 (the server of BROKER=redis test runs), its database is flushed.
+"""
+
+import os
+import time
+
+import pytest
+
+from flask_celery import _RateLimiterRedis, OtherInstanceError, rate_limit, single_instance
+from tests.fakes import FakeTask, RedisBackend
+
+
+@pytest.fixture
+def backend():
+    """Return a RedisBackend stand-in with a client of the real Redis server, flushed."""
+    redis = pytest.importorskip('redis')
+    url = os.environ.get('REDIS_URL', 'redis://localhost/1')
+    client = redis.StrictRedis.from_url(url)
+    try:
+        client.flushdb()
+    except redis.ConnectionError:
+        pytest.skip('No Redis server at {0}.'.format(url))
+    return RedisBackend(client)
+
+
+def test_acquire_release(backend):
+    """Test that the lock holds the owner token with the timeout, rejects others and is deleted on release."""
+    task = FakeTask('tests.fake.add', backend)
+    plan = single_instance(lock_timeout=20)(lambda: None).lock_plan(task)
+    client, manager, other = backend.client, plan.manager((), dict()), plan.manager((), dict())
+
+    manager.acquire()
+    assert manager.owner.encode('utf-8') == client.get(manager.redis_key)
+    assert 19000 < client.pttl(manager.redis_key) <= 20000
+    with pytest.raises(OtherInstanceError):
+        other.acquire()
+    assert manager.owner == other.other_owner
+
+    assert manager.release() is False
+    assert client.exists(manager.redis_key) == 0
+    other.acquire()
+    assert other.release() is False
+
+
+def test_compare_and_delete(backend):
+    """Test that only the owner releases or extends the lock, e.g. not a worker whose lock expired and was taken."""
+    task = FakeTask('tests.fake.add', backend)
+    plan = single_instance(lock_timeout=20)(lambda: None).lock_plan(task)
+    client, manager = backend.client, plan.manager((), dict())
+    manager.acquire()
+
+    stale = plan.manager((), dict())
+    stale.owner = 'expired-owner'
+    assert stale.extend() is False
+    assert stale.release() is False
+    assert manager.owner.encode('utf-8') == client.get(manager.redis_key)
+
+    client.pexpire(manager.redis_key, 1000)
+    assert manager.extend() is True
+    assert 19000 < client.pttl(manager.redis_key) <= 20000
+    manager.release()
+    assert client.exists(manager.redis_key) == 0
+
+
+def test_mark_dirty(backend):
+    """Test that duplicates mark a held lock dirty, expiring with it, and that release reports and clears the mark."""
+    task = FakeTask('tests.fake.add', backend)
+    plan = single_instance(lock_timeout=20, coalesce=True)(lambda: None).lock_plan(task)
+    client, manager = backend.client, plan.manager((), dict())
+    assert manager.mark_dirty() is False
+    assert client.exists(manager.dirty_key) == 0
+
+    manager.acquire()
+    assert manager.mark_dirty() is True
+    assert 0 < client.pttl(manager.dirty_key) <= client.pttl(manager.redis_key)
+    assert manager.release() is True
+    assert client.exists(manager.redis_key, manager.dirty_key) == 0
+
+
+def test_claim(backend):
+    """Test that a claimed lock is only adopted by its task id, and not acquired again by a redelivery after that."""
+    task = FakeTask('tests.fake.add', backend)
+    plan = single_instance(lock_timeout=20, publish='claim')(lambda: None).lock_plan(task)
+    client = backend.client
+    task_id = plan.apply_async(lambda args, kwargs, task_id=None, **_: task_id, ())
+    key = plan.manager((), dict()).redis_key
+    assert 'claim:{0}'.format(task_id).encode('utf-8') == client.get(key)
+
+    task.request.id = 'other'
+    with pytest.raises(OtherInstanceError):
+        plan.manager((), dict()).acquire()
+    task.request.id = task_id
+    manager = plan.manager((), dict())
+    manager.acquire()
+    assert task_id.encode('utf-8') == client.get(key)
+    with pytest.raises(OtherInstanceError):
+        plan.manager((), dict()).acquire()
+    manager.release()
+
+
+def test_semaphore(backend):
+    """Test that max_instances holders each take a slot, the next one is rejected, and released slots are free."""
+    task = FakeTask('tests.fake.add', backend)
+    plan = single_instance(lock_timeout=20, max_instances=2)(lambda: None).lock_plan(task)
+    managers = [plan.manager((), dict()) for _ in range(3)]
+    managers[0].acquire()
+    managers[1].acquire()
+    with pytest.raises(OtherInstanceError):
+        managers[2].acquire()
+    managers[0].release()
+    managers[2].acquire()
+    assert 2 == backend.client.zcard(managers[2].redis_key)
+
+
+def test_throttle(backend):
+    """Test the rate limiter's script: a burst at once, then one call per interval."""
+    wrapped = rate_limit(rate='10/s', burst=2)(lambda: None)
+    task = FakeTask('tests.fake.ping', backend, run=wrapped)
+    limiter = wrapped.rate_limiter(task)
+    assert limiter.__class__ is _RateLimiterRedis
+    assert [0, 0] == [limiter.throttle('tests.fake.ping') for _ in range(2)]
+    wait = limiter.throttle('tests.fake.ping')
+    assert 0 < wait <= 0.1
+    time.sleep(wait)
+    assert 0 == limiter.throttle('tests.fake.ping')
@@ -0,0 +1,104 @@
+"""Test lock signals and the LockStats collector."""
+
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from flask_celery import (
+    LockStats, OtherInstanceError, single_instance, single_instance_acquired, single_instance_error,
+    single_instance_reclaimed,
+)
+from tests.fakes import FakeTask, RedisBackend, sqlite_backend
+
+
+@pytest.fixture
+def stats(request):
+    """Return a connected LockStats, disconnected after the test."""
+    collector = LockStats().connect()
+    request.addfinalizer(collector.disconnect)
+    return collector
+
+
+def test_signals():
+    """Test the signals sent around a lock, and that nothing is sent without receivers."""
+    task = FakeTask('tests.fake.add', RedisBackend())
+    wrapped = single_instance(lambda x, y: x + y)
+    received = list()
+
+    def receiver(signal, sender, **named):
+        received.append((signal, sender, named))
+
+    assert 8 == wrapped(task, 4, 4)
+    single_instance_acquired.connect(receiver, weak=False)
+    try:
+        assert 8 == wrapped(task, 4, 4)
+    finally:
+        single_instance_acquired.disconnect(receiver)
+    assert 1 == len(received)
+    signal, sender, named = received[0]
+    assert signal is single_instance_acquired
+    assert sender is task
+    assert 'tests.fake.add' == named['task_identifier']
+    assert 0 <= named['latency'] < 1
+
+
+def test_collector(stats):
+    """Test counters and histograms per task name."""
+    task = FakeTask('tests.fake.sleep', RedisBackend())
+    wrapped = single_instance(time.sleep)
+    wrapped(task, 0.02)
+    wrapped(task, 0.02)
+    with wrapped.lock_plan(task).manager((), dict()):
+        with pytest.raises(OtherInstanceError):
+            wrapped(task, 0)
+
+    assert dict(acquired={'tests.fake.sleep': 3}, rejected={'tests.fake.sleep': 1}) == stats.counters
+    hold = stats.histograms['hold_seconds']['tests.fake.sleep']
+    assert 3 == hold[-2]
+    assert 0.04 <= hold[-1] < 1
+
+    text = stats.prometheus()
+    assert '# TYPE single_instance_acquired_total counter\n' in text
+    assert 'single_instance_acquired_total{task="tests.fake.sleep"} 3\n' in text
+    assert 'single_instance_rejected_total{task="tests.fake.sleep"} 1\n' in text
+    assert 'single_instance_hold_seconds_bucket{task="tests.fake.sleep",le="0.005"} 1\n' in text
+    assert 'single_instance_hold_seconds_bucket{task="tests.fake.sleep",le="+Inf"} 3\n' in text
+    assert 'single_instance_hold_seconds_count{task="tests.fake.sleep"} 3\n' in text
+
+    lines = stats.statsd(prefix='locks')
+    assert 'locks.tests.fake.sleep.acquired:3|g' in lines
+    assert 'locks.tests.fake.sleep.hold_seconds.count:3|g' in lines
+
+    stats.disconnect()
+    wrapped(task, 0)
+    assert 3 == stats.counters['acquired']['tests.fake.sleep']
+
+
+def test_reclaimed(stats, tmpdir):
+    """Test that taking over an expired database lock is counted."""
+    task = FakeTask('tests.fake.add', sqlite_backend(str(tmpdir)))
+    wrapped = single_instance(lambda x, y: x + y)
+    manager = wrapped.lock_plan(task).manager((), dict())
+    lock_table = manager.lock_table
+    lock_table.acquire(manager.task_identifier, 'crashed-worker', 60)
+    with lock_table.engine.begin() as connection:
+        connection.execute(lock_table.table.update().values(expires=datetime.utcnow() - timedelta(seconds=1)))
+
+    assert 8 == wrapped(task, 4, 4)
+    assert 8 == wrapped(task, 4, 4)
+    assert dict(acquired={'tests.fake.add': 2}, reclaimed={'tests.fake.add': 1}) == stats.counters
+    assert single_instance_reclaimed.receivers
+
+
+def test_error(stats):
+    """Test that lock backend failures are counted and re-raised."""
+    class BrokenRedis(object):
+        def register_script(self, _):
+            raise IOError('Connection refused.')
+
+    task = FakeTask('tests.fake.add', RedisBackend(client=BrokenRedis()))
+    with pytest.raises(IOError):
+        single_instance(lambda: None)(task)
+    assert dict(errors={'tests.fake.add': 1}) == stats.counters
+    assert single_instance_error.receivers
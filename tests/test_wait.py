@@ -0,0 +1,50 @@
+"""Test waiting for locks instead of failing right away."""
+
+import threading
+import time
+
+import pytest
+
+from flask_celery import OtherInstanceError, single_instance
+from tests.fakes import FakeTask
+
+
+def hold(task, seconds):
+    """Hold the task's lock for some time in a background thread.
+
+    :return: Started thread, and event set once the lock is held.
+    """
+    held = threading.Event()
+
+    def run():
+        with single_instance(lambda: None).lock_plan(task).manager((), dict()):
+            held.set()
+            time.sleep(seconds)
+    thread = threading.Thread(target=run)
+    thread.start()
+    held.wait()
+    return thread
+
+
+def test_wait(backend):
+    """Test that a waiting instance runs once the other instance releases the lock."""
+    task = FakeTask('tests.fake.add', backend)
+    wrapped = single_instance(wait=5)(lambda x, y: x + y)
+    thread = hold(task, 0.3)
+    start = time.time()
+    assert 8 == wrapped(task, 4, 4)
+    assert 0.2 < time.time() - start < 3
+    thread.join()
+
+
+def test_deadline(backend):
+    """Test that a waiting instance gives up at its deadline."""
+    task = FakeTask('tests.fake.add', backend)
+    wrapped = single_instance(wait=0.2)(lambda x, y: x + y)
+    thread = hold(task, 1)
+    start = time.time()
+    with pytest.raises(OtherInstanceError):
+        wrapped(task, 4, 4)
+    assert 0.2 <= time.time() - start < 0.8
+    thread.join()
+    assert 8 == wrapped(task, 4, 4)